@@ -1,4 +1,6 @@
 from typing import Callable
+from collections import OrderedDict
+import asyncio
 from Model import User, Message, Response
 import json
 import socket
@@ -7,15 +9,27 @@ import time
 import hashlib
 import threading
 import Crypto.PublicKey.RSA
+import Crypto.PublicKey.ECC
+import Crypto.Protocol.DH
+import Crypto.Protocol.KDF
+import Crypto.Hash.SHA256
 import Crypto.Cipher.PKCS1_v1_5
 import Crypto.Random
 import Crypto.Cipher.AES
 import base64
-from stegano import lsb
-import random
+import Stego
+import Framing
 import datetime
 from PIL import Image
 import io
+import os
+import queue
+import random
+import selectors
+import struct
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from enum import Enum
+import sqlite3
 
 
 class FriendListener:
@@ -26,7 +40,8 @@ class FriendListener:
                  new_callback: Callable[[User], None],
                  add_callback: Callable[[User], None],
                  delete_callback: Callable[[User], None],
-                 init_callback: Callable[[list[User]], None]):
+                 init_callback: Callable[[list[User]], None],
+                 delta_callback: Callable[[list[User], list[User], list[User], set[str]], None] = None):
         """初始化好友监听器
 
         Args:
@@ -35,72 +50,128 @@ class FriendListener:
             add_callback (Callable[[User], None]): 新好友请求通过时，回调此函数
             delete_callback (Callable[[User], None]): 好友被删除时，回调此函数
             init_callback (Callable[[list[User]], None]): 初始化好友列表时，回调此函数
+            delta_callback (Callable[[list[User], list[User], list[User], set[str]], None]): 增量同步好友列表时，
+                回调此函数，参数依次为新增、删除、改名的好友与在线好友的邮件地址
         """
         self.status_callback = status_callback
         self.new_callback = new_callback
         self.add_callback = add_callback
         self.delete_callback = delete_callback
         self.init_callback = init_callback
-        self.port = 20000
-        not_found_port = True
-        while not_found_port:
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.bind(('0.0.0.0', self.port))
-                not_found_port = False
-            except:
-                self.port += 1
-        self.__sock = sock
+        self.delta_callback = delta_callback
+        self.version: str | None = None
+        """好友列表版本号，绑定时发给服务器以请求增量同步"""
+        self.port: int | None = None
+        """监听端口，调用 run 或交给 ClientListener 后确定"""
+        self.__sock = None
 
     def __handle_conn(self, conn: socket.socket, addr: tuple[str, int]) -> None:
-        hold_conn = True
-        while hold_conn:
+        # The server closes after pushing, so read to the end: batch pushes may exceed buf_len
+        msg_bytes = b''
+        while True:
             try:
-                msg_bytes = conn.recv(Const.buf_len)
-                msg = json.loads(msg_bytes.decode('utf-8'))
+                chunk = conn.recv(65536)
             except:
-                hold_conn = False
                 break
-            if msg['op'] == 'status':
+            if not chunk:
+                break
+            msg_bytes += chunk
+        conn.close()
+        self.handle_push(msg_bytes)
+
+    def handle_push(self, msg_bytes: bytes) -> None:
+        """处理服务器一次推送的全部内容，可能是连续的多条消息
+
+        Args:
+            msg_bytes (bytes): 推送连接上收到的全部字节
+        """
+        decoder = json.JSONDecoder()
+        try:
+            msg_str = msg_bytes.decode('utf-8')
+            pos = 0
+            while pos < len(msg_str):
+                msg, pos = decoder.raw_decode(msg_str, pos)
+                if not self.dispatch(msg['op'], msg['content']):
+                    break
+        except:
+            pass
+
+    def dispatch(self, op: str, content: dict) -> bool:
+        """处理一条好友消息，回调对应的函数
+
+        Args:
+            op (str): 消息类型
+            content (dict): 消息内容
+
+        Returns:
+            bool: 消息类型是否已知
+        """
+        if op == 'status':
+            # Going offline or logging in again may change the address
+            route_cache.invalidate(content['email'])
+            user = User()
+            user.email = content['email']
+            user.status = content['status']
+            # print('FriendListener: Call status_callback.')
+            self.status_callback(user)
+        elif op == 'new':
+            user = User()
+            user.email = content['email']
+            user.username = content['username']
+            # print('FriendListener: Call new_callback.')
+            self.new_callback(user)
+        elif op == 'add':
+            user = User()
+            user.email = content['email']
+            user.username = content['username']
+            user.status = content['status']
+            # print('FriendListener: Call add_callback.')
+            self.add_callback(user)
+        elif op == 'delete':
+            route_cache.invalidate(content['email'])
+            user = User()
+            user.email = content['email']
+            # print('FriendListener: Call delete_callback.')
+            self.delete_callback(user)
+        elif op == 'init':
+            users = []
+            for friend in content['friends']:
                 user = User()
-                user.email = msg['content']['email']
-                user.status = msg['content']['status']
-                # print('FriendListener: Call status_callback.')
-                self.status_callback(user)
-            elif msg['op'] == 'new':
+                user.email = friend['email']
+                user.username = friend['username']
+                user.status = friend['status']
+                users.append(user)
+            # print('FriendListener: Call init_callback.')
+            self.version = content.get('version', None)
+            self.init_callback(users)
+        elif op == 'delta':
+            added, removed, renamed = [], [], []
+            for friend in content['added']:
                 user = User()
-                user.email = msg['content']['email']
-                user.username = msg['content']['username']
-                # print('FriendListener: Call new_callback.')
-                self.new_callback(user)
-            elif msg['op'] == 'add':
+                user.email = friend['email']
+                user.username = friend['username']
+                user.status = friend['status']
+                added.append(user)
+            for email in content['removed']:
                 user = User()
-                user.email = msg['content']['email']
-                user.username = msg['content']['username']
-                user.status = msg['content']['status']
-                # print('FriendListener: Call add_callback.')
-                self.add_callback(user)
-            elif msg['op'] == 'delete':
+                user.email = email
+                removed.append(user)
+            for friend in content['renamed']:
                 user = User()
-                user.email = msg['content']['email']
-                # print('FriendListener: Call delete_callback.')
-                self.delete_callback(user)
-            elif msg['op'] == 'init':
-                users = []
-                for friend in msg['content']['friends']:
-                    user = User()
-                    user.email = friend['email']
-                    user.username = friend['username']
-                    user.status = friend['status']
-                    users.append(user)
-                # print('FriendListener: Call init_callback.')
-                self.init_callback(users)
-            else:
-                hold_conn = False
-        conn.close()
+                user.email = friend['email']
+                user.username = friend['username']
+                renamed.append(user)
+            self.version = content['version']
+            self.delta_callback(added, removed, renamed, set(content['online']))
+        elif op == 'batch':
+            # Several notifications combined into one push
+            for item in content['ops']:
+                self.dispatch(item['op'], item['content'])
+        else:
+            return False
+        return True
 
     def __listen(self) -> None:
-        self.__sock.listen(8)
         while True:
             conn, addr = self.__sock.accept()
             handle_thread = threading.Thread(target=self.__handle_conn, args=(conn, addr))
@@ -108,143 +179,1136 @@ class FriendListener:
             handle_thread.start()
 
     def run(self) -> None:
-        """启动好友监听器"""
+        """在临时端口上单独启动好友监听器，与伙伴监听器共用端口时改用 `ClientListener`"""
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__sock.bind(('0.0.0.0', 0))
+        self.__sock.listen(8)
+        self.port = self.__sock.getsockname()[1]
         listen_thread = threading.Thread(target=self.__listen)
         listen_thread.daemon = True
         listen_thread.start()
 
 
+peer_header = struct.Struct('!BI')
+"""伙伴间每条消息的帧头：标志位、图片字节数"""
+peer_flag_ack = 0x01
+"""标志位：要求接收方收完后回复 1 字节确认"""
+peer_flag_raw = 0x02
+"""标志位：载荷是加密后的 JSON 原文，不经隐写"""
+peer_flag_hello = 0x04
+"""标志位：能力协商，载荷是 `{'modes': [...]}`，与 peer_flag_raw 同用时为 JSON 原文，否则藏在图片中；
+接收方以同样的标志回复"""
+
+
+def hello_frame(hello: dict, raw: bool) -> bytes:
+    """把协商内容打包成一帧，raw 为 False 时藏进图片，与隐写的消息帧看不出区别"""
+    payload = json.dumps(hello).encode()
+    if not raw:
+        bytes_io = io.BytesIO()
+        Stego.hide(cover_pool.fit(len(payload)), payload).save(bytes_io, format="PNG")
+        payload = bytes_io.getvalue()
+    return peer_header.pack(peer_flag_hello | (peer_flag_raw if raw else 0), len(payload)) + payload
+
+
+def read_hello(flags: int, payload: bytes | bytearray) -> dict:
+    """解出 `hello_frame` 打包的协商内容"""
+    if flags & peer_flag_raw:
+        return json.loads(payload)
+    return json.loads(Stego.reveal(io.BytesIO(payload)))
+peer_max_len = 64 * 1024 * 1024
+"""单条消息图片的最大字节数，超过时视为数据错误"""
+peer_session_lifetime = 3600
+"""会话密钥的使用时长（秒），到期后发送方重新协商"""
+
+
+def import_public_key(public_key: str) -> Crypto.PublicKey.RSA.RsaKey | Crypto.PublicKey.ECC.EccKey:
+    """解析 PEM 公钥，RSA 与椭圆曲线密钥均可"""
+    try:
+        return Crypto.PublicKey.RSA.importKey(public_key)
+    except ValueError:
+        return Crypto.PublicKey.ECC.import_key(public_key)
+
+
+def export_public_key(key: Crypto.PublicKey.RSA.RsaKey | Crypto.PublicKey.ECC.EccKey) -> str:
+    """导出 PEM 公钥，私钥也只导出其公钥部分"""
+    if isinstance(key, Crypto.PublicKey.ECC.EccKey):
+        return key.public_key().export_key(format='PEM')
+    return key.publickey().exportKey().decode()
+
+
+def session_kdf(secret: bytes) -> bytes:
+    """由椭圆曲线密钥协商的共享秘密导出会话密钥"""
+    return Crypto.Protocol.KDF.HKDF(secret, 16, b'', Crypto.Hash.SHA256, context=b'ChatAPP peer session')
+
+
+def session_aad(sender: str, attrs: dict) -> bytes:
+    """会话密钥加密时一并认证的附加数据：发送方与消息属性"""
+    return json.dumps([sender, attrs], sort_keys=True).encode()
+
+
+def recv_exact(conn: socket.socket, size: int) -> bytearray | None:
+    """从 conn 读满 size 字节
+
+    Args:
+        conn (socket.socket): 连接
+        size (int): 字节数
+
+    Returns:
+        bytearray | None: 读到的数据，对方提前关闭连接时为 None
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = conn.recv_into(view[received:])
+        if count == 0:
+            return None
+        received += count
+    return buffer
+
+
+class KeyStore:
+    """本机私钥存储，按账号保存到磁盘，下次登录沿用同一公钥
+
+    新账号登录时取用后台预先生成的备用密钥；已保存的密钥超过 rotate_after 秒时，
+    本次登录照常使用，同时在后台生成新密钥，下次登录时换用。
+    """
+
+    def __init__(self, directory: str = 'keys', key_type: str | None = None, rotate_after: float = 30 * 86400):
+        """初始化私钥存储
+
+        Args:
+            directory (str): 私钥文件所在目录
+            key_type (str | None): 新密钥的类型，'rsa' 或 'ecc'，默认取 `Const.key_type`
+            rotate_after (float): 密钥使用多久后更换（秒）
+        """
+        self.directory = directory
+        self.key_type = Const.key_type if key_type is None else key_type
+        self.rotate_after = rotate_after
+        self.lock = threading.Lock()
+        self.spare = None
+        """后台生成的备用私钥"""
+        self.spare_ready = threading.Event()
+        self.generating = False
+
+    def generate(self) -> Crypto.PublicKey.RSA.RsaKey | Crypto.PublicKey.ECC.EccKey:
+        """同步生成一个新私钥"""
+        if self.key_type == 'ecc':
+            return Crypto.PublicKey.ECC.generate(curve='P-256')
+        return Crypto.PublicKey.RSA.generate(1024, Crypto.Random.new().read)
+
+    def __generate_spare(self) -> None:
+        key = self.generate()
+        with self.lock:
+            self.spare = key
+            self.generating = False
+            self.spare_ready.set()
+
+    def prepare(self) -> None:
+        """在后台生成备用私钥，已有或正在生成时不做任何事"""
+        with self.lock:
+            if self.spare is not None or self.generating:
+                return
+            self.generating = True
+            self.spare_ready.clear()
+        generate_thread = threading.Thread(target=self.__generate_spare)
+        generate_thread.daemon = True
+        generate_thread.start()
+
+    def __take_spare(self) -> Crypto.PublicKey.RSA.RsaKey | Crypto.PublicKey.ECC.EccKey:
+        self.prepare()
+        self.spare_ready.wait()
+        with self.lock:
+            key, self.spare = self.spare, None
+        return key if key is not None else self.generate()
+
+    def __path(self, email: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(email.encode('utf-8')).hexdigest() + '.pem')
+
+    def __save(self, email: str, key: Crypto.PublicKey.RSA.RsaKey | Crypto.PublicKey.ECC.EccKey) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        if isinstance(key, Crypto.PublicKey.ECC.EccKey):
+            pem = key.export_key(format='PEM').encode()
+        else:
+            pem = key.exportKey()
+        # Write then rename, so a crash never leaves a truncated key behind
+        temp_path = self.__path(email) + '.tmp'
+        with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as key_file:
+            key_file.write(pem)
+        os.replace(temp_path, self.__path(email))
+
+    def __rotate(self, email: str) -> None:
+        self.__save(email, self.__take_spare())
+
+    def find(self, email: str) -> Crypto.PublicKey.RSA.RsaKey | Crypto.PublicKey.ECC.EccKey | None:
+        """取出已保存的 email 的私钥，不生成也不写盘，可以在登录验证之前调用
+
+        Args:
+            email (str): 账号邮件地址
+
+        Returns:
+            Crypto.PublicKey.RSA.RsaKey | Crypto.PublicKey.ECC.EccKey | None: 私钥，没有保存时为 None
+        """
+        try:
+            with open(self.__path(email), 'rb') as key_file:
+                pem = key_file.read()
+            try:
+                return Crypto.PublicKey.RSA.importKey(pem)
+            except ValueError:
+                return Crypto.PublicKey.ECC.import_key(pem)
+        except (OSError, ValueError):
+            return None
+
+    def load(self, email: str) -> Crypto.PublicKey.RSA.RsaKey | Crypto.PublicKey.ECC.EccKey:
+        """取出 email 的私钥，没有时取用备用私钥并保存，应在服务器验证登录之后调用
+
+        Args:
+            email (str): 账号邮件地址
+
+        Returns:
+            Crypto.PublicKey.RSA.RsaKey | Crypto.PublicKey.ECC.EccKey: 私钥
+        """
+        path = self.__path(email)
+        key = self.find(email)
+        if key is None:
+            key = self.__take_spare()
+            self.__save(email, key)
+            self.prepare()
+            return key
+        age = time.time() - os.path.getmtime(path)
+        is_ecc = isinstance(key, Crypto.PublicKey.ECC.EccKey)
+        if age > self.rotate_after or is_ecc != (self.key_type == 'ecc'):
+            rotate_thread = threading.Thread(target=self.__rotate, args=(email,))
+            rotate_thread.daemon = True
+            rotate_thread.start()
+        return key
+
+
+decoder_cipher = None
+"""解码进程中的 RSA 解密器，由 `init_decoder` 设置"""
+
+
+def init_decoder(private_key: bytes | None) -> None:
+    """解码进程的初始化函数，只导入一次私钥
+
+    Args:
+        private_key (bytes | None): PEM 格式的 RSA 私钥，椭圆曲线私钥不用于逐条解密，为 None
+    """
+    global decoder_cipher
+    if private_key is not None:
+        decoder_cipher = Crypto.Cipher.PKCS1_v1_5.new(Crypto.PublicKey.RSA.importKey(private_key))
+
+
+def decode_post(frame: bytes, flags: int, session_key: bytes | None, cipher=None) -> tuple[str, dict, bytes | None, bytes, dict[str, float]]:
+    """从一帧中取出并解密伙伴消息，通常在解码进程中运行
+
+    Args:
+        frame (bytes): 帧的载荷，PNG 图片或 JSON 原文
+        flags (int): 帧头的标志位
+        session_key (bytes | None): 帧所属会话的密钥
+        cipher: RSA 解密器，默认使用 `init_decoder` 设置的
+
+    Raises:
+        ValueError: 无法解出或认证失败
+
+    Returns:
+        tuple[str, dict, bytes | None, bytes, dict[str, float]]: 发送方、消息属性、会话 nonce、明文、
+            各步耗时（秒）
+    """
+    cipher = decoder_cipher if cipher is None else cipher
+    start = time.perf_counter()
+    if flags & peer_flag_raw:
+        post = json.loads(frame)
+    else:
+        post = json.loads(Stego.reveal(io.BytesIO(frame)))
+    revealed = time.perf_counter()
+    nonce = None
+    if 'nonce' in post:
+        nonce = base64.b64decode(post['nonce'])
+        if session_key is None or len(nonce) != 12:
+            raise ValueError('No session for this message.')
+        aes = Crypto.Cipher.AES.new(session_key, Crypto.Cipher.AES.MODE_GCM, nonce=nonce)
+        aes.update(session_aad(post['sender'], post['attrs']))
+        msg = aes.decrypt_and_verify(base64.b64decode(post['msg']), base64.b64decode(post['tag']))
+    else:
+        # Elliptic-curve keys only agree on session keys, they cannot decrypt per-message keys
+        if cipher is None:
+            raise ValueError('No RSA key for this message.')
+        aes_key = cipher.decrypt(base64.b64decode(post['key']), 0)
+        iv = base64.b64decode(post['iv'])
+        aes = Crypto.Cipher.AES.new(aes_key, Crypto.Cipher.AES.MODE_CFB, iv)
+        msg = aes.decrypt(base64.b64decode(post['msg']))
+    timings = {'reveal': revealed - start, 'decrypt': time.perf_counter() - revealed}
+    return post['sender'], post['attrs'], nonce, msg, timings
+
+
+class DecodePipeline:
+    """伙伴消息解码流水线
+
+    连接线程把收到的隐写帧交给进程池，并行完成隐写提取与解密，不再在 GIL 下串行；
+    投递线程按到达顺序逐条取回结果、检查 nonce，解出后才确认收到，随后回调；
+    解不出的帧回复拒收并关闭连接，发送方据此重发。
+    原文帧以及 workers 为 0 时在投递线程中解码，仍保持到达顺序。
+    发送方重发的消息带有相同的 id 属性，已投递过的不再回调。
+    """
+
+    def __init__(self, recv_callback: Callable[[str, float, Message], None], workers: int | None = None):
+        """初始化解码流水线
+
+        Args:
+            recv_callback (Callable[[str, float, Message], None]): 解出消息后，回调此函数，参数依次为邮件地址、时间戳、消息
+            workers (int | None): 解码进程数，默认为 CPU 核数减一，最多 4 个，单核时不用解码进程
+        """
+        self.callback = recv_callback
+        self.workers = min(4, (os.cpu_count() or 1) - 1) if workers is None else workers
+        self.lock = threading.Lock()
+        self.executor: ProcessPoolExecutor | None = None
+        self.cipher = None
+        self.queue: queue.Queue = queue.Queue()
+        """按到达顺序排列的 (提交时间, future, 帧, 标志位, 会话, 回复函数)"""
+        self.seen: OrderedDict[tuple[str, str], None] = OrderedDict()
+        """最近投递过的 (发送方, 消息 id)，最多保留 seen_limit 条"""
+        self.seen_limit = 4096
+        self.stats = {'submitted': 0, 'delivered': 0, 'dropped': 0, 'duplicates': 0, 'callback_errors': 0, 'max_depth': 0,
+                      'queued': 0.0, 'reveal': 0.0, 'decrypt': 0.0, 'callback': 0.0}
+        """累计计数与各步累计耗时（秒）：queued 为排队到开始投递，reveal、decrypt 在解码进程中"""
+        deliver_thread = threading.Thread(target=self.__deliver)
+        deliver_thread.daemon = True
+        deliver_thread.start()
+
+    def use_key(self, private_key: Crypto.PublicKey.RSA.RsaKey | Crypto.PublicKey.ECC.EccKey) -> None:
+        """换用私钥，解码进程随之重建
+
+        Args:
+            private_key (Crypto.PublicKey.RSA.RsaKey | Crypto.PublicKey.ECC.EccKey): 本机私钥
+        """
+        is_ecc = isinstance(private_key, Crypto.PublicKey.ECC.EccKey)
+        executor = None
+        if self.workers > 0:
+            # Worker processes start on the first message
+            executor = ProcessPoolExecutor(self.workers, initializer=init_decoder,
+                                           initargs=(None if is_ecc else private_key.exportKey(),))
+        with self.lock:
+            self.cipher = None if is_ecc else Crypto.Cipher.PKCS1_v1_5.new(private_key)
+            executor, self.executor = self.executor, executor
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def submit(self, frame: bytes | bytearray, flags: int, session: dict, reply: Callable[[bytes, bool], None]) -> None:
+        """提交一帧
+
+        Args:
+            frame (bytes | bytearray): 帧的载荷
+            flags (int): 帧头的标志位
+            session (dict): 帧所属的会话，含 key 与 last_counter，只由投递线程修改
+            reply (Callable[[bytes, bool], None]): 向帧来自的连接回复，参数依次为字节与回复后是否关闭连接，
+                在投递线程中调用
+        """
+        frame = bytes(frame)
+        with self.lock:
+            future = None
+            # Raw posts under a session decrypt faster than a round trip to a worker
+            if self.executor is not None and not flags & peer_flag_raw:
+                future = self.executor.submit(decode_post, frame, flags, session['key'])
+            self.stats['submitted'] += 1
+            self.queue.put((time.perf_counter(), future, frame, flags, session, reply))
+            self.stats['max_depth'] = max(self.stats['max_depth'], self.queue.qsize())
+
+    def depth(self) -> int:
+        """排队等待投递的消息数"""
+        return self.queue.qsize()
+
+    def snapshot(self) -> dict:
+        """当前统计，含队列深度"""
+        with self.lock:
+            return dict(self.stats, depth=self.queue.qsize())
+
+    def __deliver(self) -> None:
+        while True:
+            submitted_at, future, frame, flags, session, reply = self.queue.get()
+            started_at = time.perf_counter()
+            try:
+                if future is None:
+                    result = decode_post(frame, flags, session['key'], self.cipher)
+                else:
+                    result = future.result()
+                sender, attrs, nonce, msg, timings = result
+                if nonce is not None:
+                    # Nonces count up within a session, anything else is a replay
+                    counter = int.from_bytes(nonce, 'big')
+                    if counter <= session['last_counter']:
+                        raise ValueError('Replayed message.')
+                    session['last_counter'] = counter
+            except Exception:
+                with self.lock:
+                    self.stats['dropped'] += 1
+                # Rejected, the sender resends on a fresh connection
+                self.__reply(reply, b'\x00' if flags & peer_flag_ack else b'', True)
+                continue
+            # Decoded, the sender may now reuse the connection
+            if flags & peer_flag_ack:
+                self.__reply(reply, b'\x01', False)
+            if 'id' in attrs:
+                # A resend after a lost ack, the first copy was already delivered
+                if (sender, attrs['id']) in self.seen:
+                    with self.lock:
+                        self.stats['duplicates'] += 1
+                    continue
+                self.seen[(sender, attrs['id'])] = None
+                if len(self.seen) > self.seen_limit:
+                    self.seen.popitem(last=False)
+            message = Message()
+            message.content = msg
+            message.attributes = attrs
+            try:
+                self.callback(sender, time.time(), message)
+                if not flags & peer_flag_raw:
+                    img_io = io.BytesIO(frame)
+                    Image.open(img_io).show()
+            except Exception:
+                # A failing callback must not stop delivery of later messages
+                with self.lock:
+                    self.stats['callback_errors'] += 1
+            finished_at = time.perf_counter()
+            with self.lock:
+                self.stats['delivered'] += 1
+                self.stats['queued'] += started_at - submitted_at
+                self.stats['reveal'] += timings['reveal']
+                self.stats['decrypt'] += timings['decrypt']
+                self.stats['callback'] += finished_at - started_at
+
+    def __reply(self, reply: Callable[[bytes, bool], None], data: bytes, close: bool) -> None:
+        try:
+            reply(data, close)
+        except Exception:
+            # The connection is already gone
+            pass
+
+
 class PeerListener:
     """伙伴监听器"""
 
-    def __init__(self, recv_callback: Callable[[str, float, Message], None]):
+    def __init__(self,
+                 recv_callback: Callable[[str, float, Message], None],
+                 allow_raw: bool | None = None,
+                 private_key: Crypto.PublicKey.RSA.RsaKey | Crypto.PublicKey.ECC.EccKey | None = None,
+                 workers: int | None = None):
         """初始化伙伴监听器
 
         Args:
             recv_callback (Callable[[str, float, Message], None]): 收到消息后，回调此函数，参数依次为邮件地址、时间戳、消息
+            allow_raw (bool | None): 是否接受不经隐写的消息，默认在未开启 `Const.covert` 时接受
+            private_key (Crypto.PublicKey.RSA.RsaKey | Crypto.PublicKey.ECC.EccKey | None): 本机私钥，
+                通常取自 `KeyStore`，默认当场生成 RSA 私钥
+            workers (int | None): 解码进程数，见 `DecodePipeline`
         """
         self.callback = recv_callback
-        self.port = 30000
-        not_found_port = True
-        while not_found_port:
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.bind(('0.0.0.0', self.port))
-                not_found_port = False
-            except:
-                self.port -= 1
-        self.__sock = sock
-        # Generate RSA key
-        self.__gen_rand_bytes = Crypto.Random.new().read
-        rsa = Crypto.PublicKey.RSA.generate(1024, self.__gen_rand_bytes)
-        self.__private_key = rsa
-        self.public_key = rsa.publickey()
-
-    def __handle_conn(self, conn: socket.socket, addr: tuple[str, int], cipher):
-        hold_conn = True
-        while hold_conn:
+        self.pipeline = DecodePipeline(recv_callback, workers)
+        self.allow_raw = not Const.covert if allow_raw is None else allow_raw
+        self.port: int | None = None
+        """监听端口，调用 run 或交给 ClientListener 后确定"""
+        self.handshakes = ThreadPoolExecutor(max_workers=2)
+        """协商会话密钥的线程，私钥运算不占用收帧的线程"""
+        self.__sock = None
+        if private_key is None:
+            # Generate RSA key
+            self.__gen_rand_bytes = Crypto.Random.new().read
+            private_key = Crypto.PublicKey.RSA.generate(1024, self.__gen_rand_bytes)
+        self.use_key(private_key)
+
+    def use_key(self, private_key: Crypto.PublicKey.RSA.RsaKey | Crypto.PublicKey.ECC.EccKey) -> None:
+        """换用私钥，如切换账号时，之后建立的连接使用新私钥
+
+        Args:
+            private_key (Crypto.PublicKey.RSA.RsaKey | Crypto.PublicKey.ECC.EccKey): 本机私钥
+        """
+        self.__private_key = private_key
+        self.pipeline.use_key(private_key)
+        self.public_key = private_key.public_key() if isinstance(private_key, Crypto.PublicKey.ECC.EccKey) else private_key.publickey()
+
+    def handle_frame(self, flags: int, frame: bytes | bytearray, state: dict, reply: Callable[[bytes, bool], None]) -> None:
+        """处理连接上的一帧，回复一律经 reply 发出，可能在其他线程中
+
+        Args:
+            flags (int): 帧头的标志位
+            frame (bytes | bytearray): 帧的载荷
+            state (dict): 连接的状态，`state['session']` 为当前会话
+            reply (Callable[[bytes, bool], None]): 向该连接回复，参数依次为字节与回复后是否关闭连接，
+                见 `DecodePipeline.submit`
+
+        Raises:
+            ValueError: 帧不合法，应关闭连接
+        """
+        if flags & peer_flag_hello:
+            # The sender waits for the hello reply before sending messages under the new session
+            self.handshakes.submit(self.__handshake, flags, frame, state, reply)
+            return
+        if flags & peer_flag_raw and not self.allow_raw:
+            raise ValueError('Raw messages are not allowed.')
+        # Decoding and decrypting happen in the pipeline, in arrival order, which also acks
+        self.pipeline.submit(frame, flags, state['session'], reply)
+
+    def __handshake(self, flags: int, frame: bytes | bytearray, state: dict, reply: Callable[[bytes, bool], None]) -> None:
+        try:
+            private_key = self.__private_key
+            is_ecc = isinstance(private_key, Crypto.PublicKey.ECC.EccKey)
+            hello = read_hello(flags, frame)
+            # One RSA operation per session instead of per message
+            session_key = None
+            if 'ephemeral_key' in hello and is_ecc:
+                session_key = Crypto.Protocol.DH.key_agreement(
+                    static_priv=private_key,
+                    eph_pub=Crypto.PublicKey.ECC.import_key(hello['ephemeral_key']),
+                    kdf=session_kdf)
+            elif 'session_key' in hello and not is_ecc:
+                cipher = Crypto.Cipher.PKCS1_v1_5.new(private_key)
+                session_key = cipher.decrypt(base64.b64decode(hello['session_key']), None)
+                if session_key is not None and len(session_key) != 16:
+                    session_key = None
+        except Exception:
+            # Not a valid hello, drop the connection
+            data, close = b'', True
+        else:
+            # Messages already queued keep the session they arrived in
+            state['session'] = {'key': session_key, 'last_counter': 0}
+            modes = ['covert', 'raw'] if self.allow_raw else ['covert']
+            # Answered the way it was asked, a covert hello gets a covert reply
+            data, close = hello_frame({'modes': modes, 'session': session_key is not None}, bool(flags & peer_flag_raw)), False
+        try:
+            reply(data, close)
+        except Exception:
+            # The connection is already gone
+            pass
+
+    def __handle_conn(self, conn: socket.socket, addr: tuple[str, int]):
+        # A pooled PeerSender keeps the connection open for many messages
+        state = {'session': {'key': None, 'last_counter': 0}}
+        send_lock = threading.Lock()
+
+        def reply(data: bytes, close: bool) -> None:
+            with send_lock:
+                conn.sendall(data)
+                if close:
+                    # Unblocks this thread, which then closes the connection
+                    conn.shutdown(socket.SHUT_RDWR)
+        while True:
             try:
                 # msg_bytes = conn.recv(Const.buf_len)
                 # post = json.loads(msg_bytes.decode('utf-8'))
-                hold_conn = False
-                group_len = int(conn.recv(Const.buf_len).decode())
-                full_msg = b''
-                for i in range(group_len):
-                    conn.send(f'{i}'.encode())
-                    full_msg += conn.recv(Const.buf_len)
-                img_io = io.BytesIO(full_msg)
-                img = Image.open(img_io)
-                post_str = lsb.reveal(img_io)
-                post_str = post_str[2:] + '\"}'
-                post = json.loads(post_str)
+                header = recv_exact(conn, peer_header.size)
+                if header is None:
+                    break
+                flags, full_len = peer_header.unpack(header)
+                if full_len > peer_max_len:
+                    break
+                full_msg = recv_exact(conn, full_len)
+                if full_msg is None:
+                    break
+                self.handle_frame(flags, full_msg, state, reply)
             except:
                 break
-            aes_key = cipher.decrypt(base64.b64decode(post['key']), 0)
-            iv = base64.b64decode(post['iv'])
-            aes = Crypto.Cipher.AES.new(aes_key, Crypto.Cipher.AES.MODE_CFB, iv)
-            msg = aes.decrypt(base64.b64decode(post['msg']))
-            message = Message()
-            message.content = msg
-            message.attributes = post['attrs']
-            self.callback(post['sender'], time.time(), message)
         conn.close()
-        img_io = io.BytesIO(full_msg)
-        Image.open(img_io).show()
 
     def __listen(self):
-        self.__sock.listen(8)
         while True:
             conn, addr = self.__sock.accept()
-            cipher = Crypto.Cipher.PKCS1_v1_5.new(self.__private_key)
-            handle_thread = threading.Thread(target=self.__handle_conn, args=(conn, addr, cipher))
+            handle_thread = threading.Thread(target=self.__handle_conn, args=(conn, addr))
             handle_thread.daemon = True
             handle_thread.start()
 
     def run(self) -> None:
-        """启动伙伴监听器"""
+        """在临时端口上单独启动伙伴监听器，与好友监听器共用端口时改用 `ClientListener`"""
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__sock.bind(('0.0.0.0', 0))
+        self.__sock.listen(8)
+        self.port = self.__sock.getsockname()[1]
         listen_thread = threading.Thread(target=self.__listen)
         listen_thread.daemon = True
         listen_thread.start()
 
 
-class ServerConnection:
-    """服务器连接"""
+class ClientListener:
+    """客户端监听器，服务器推送与伙伴消息共用一个临时端口
 
-    def __init__(self):
-        """初始化服务器连接"""
+    按连接的第一个字节分流：服务器推送是 JSON，以 '{' 开头；伙伴消息以帧头开头，标志位小于 0x10。
+    全部连接由一个线程用 selector 处理，推送交给一个派发线程回调，伙伴消息交给解码流水线，
+    线程数不随连接数增长。
+    """
+
+    def __init__(self, friend_listener: FriendListener, peer_listener: PeerListener | None = None):
+        """初始化客户端监听器
+
+        Args:
+            friend_listener (FriendListener): 处理服务器推送的好友监听器，不必再调用其 run
+            peer_listener (PeerListener | None): 处理伙伴消息的伙伴监听器，也可以之后用 `serve_peer` 指定
+        """
+        self.friend_listener = friend_listener
+        self.peer_listener: PeerListener | None = None
+        self.port: int | None = None
+        """监听端口，run 后确定"""
+        self.selector = selectors.DefaultSelector()
+        self.pushes: queue.Queue = queue.Queue()
+        """待派发的推送内容"""
+        self.replies: queue.Queue = queue.Queue()
+        """其他线程要写给连接的 (连接状态, 字节, 是否随后关闭)，由 selector 线程写出"""
+        self.__wake_r, self.__wake_w = socket.socketpair()
+        self.__sock = None
+        if peer_listener is not None:
+            self.serve_peer(peer_listener)
+
+    def serve_peer(self, peer_listener: PeerListener) -> None:
+        """改由 peer_listener 处理之后到来的伙伴消息，不必再调用其 run"""
+        peer_listener.port = self.port
+        self.peer_listener = peer_listener
+
+    def __accept(self) -> None:
+        try:
+            conn, addr = self.__sock.accept()
+        except BlockingIOError:
+            return
+        except OSError:
+            # Out of descriptors and the like, the listener stays up and retries shortly
+            time.sleep(0.1)
+            return
+        conn.setblocking(False)
+        state = {'conn': conn, 'kind': None, 'buffer': bytearray(), 'out': bytearray(),
+                 'events': selectors.EVENT_READ, 'session': {'key': None, 'last_counter': 0}}
+        self.selector.register(conn, selectors.EVENT_READ, state)
+
+    def __close(self, state: dict) -> None:
+        if state['conn'].fileno() == -1:
+            return
+        self.selector.unregister(state['conn'])
+        state['conn'].close()
+
+    def __reply(self, state: dict, data: bytes, close: bool) -> None:
+        # Any thread; the selector thread owns the socket, hand the bytes over and wake it up
+        self.replies.put((state, data, close))
+        try:
+            self.__wake_w.send(b'\x00')
+        except BlockingIOError:
+            # A wake-up is already pending
+            pass
+
+    def __drain_replies(self) -> None:
+        self.__wake_r.recv(4096)
+        while not self.replies.empty():
+            state, data, close = self.replies.get()
+            if state['conn'].fileno() == -1:
+                continue
+            state['out'] += data
+            if close:
+                state['closing'] = True
+            try:
+                self.__flush(state)
+            except Exception:
+                self.__close(state)
+
+    def __flush(self, state: dict) -> None:
+        out = state['out']
+        if len(out) > 0:
+            try:
+                sent = state['conn'].send(out)
+            except BlockingIOError:
+                sent = 0
+            del out[:sent]
+        if len(out) == 0 and state.get('closing', False):
+            self.__close(state)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if len(out) > 0 else 0)
+        if events != state['events']:
+            self.selector.modify(state['conn'], events, state)
+            state['events'] = events
+
+    def __read(self, state: dict) -> None:
+        try:
+            chunk = state['conn'].recv(65536)
+        except BlockingIOError:
+            return
+        if not chunk:
+            # The server closes after pushing
+            if state['kind'] == 'push':
+                self.pushes.put(bytes(state['buffer']))
+            self.__close(state)
+            return
+        buffer = state['buffer']
+        buffer += chunk
+        if state['kind'] is None:
+            if buffer[0] == ord('{'):
+                state['kind'] = 'push'
+            elif buffer[0] < 0x10 and self.peer_listener is not None:
+                state['kind'] = 'peer'
+            else:
+                raise ValueError('Unknown protocol.')
+        if len(buffer) > peer_header.size + peer_max_len:
+            raise ValueError('Message too long.')
+        if state['kind'] == 'push':
+            return
+        while len(buffer) >= peer_header.size:
+            flags, full_len = peer_header.unpack_from(buffer)
+            if full_len > peer_max_len:
+                raise ValueError('Message too long.')
+            end = peer_header.size + full_len
+            if len(buffer) < end:
+                break
+            frame = bytes(buffer[peer_header.size:end])
+            del buffer[:end]
+            reply = lambda data, close, state=state: self.__reply(state, data, close)
+            self.peer_listener.handle_frame(flags, frame, state, reply)
+        self.__flush(state)
+
+    def __loop(self) -> None:
+        while True:
+            for key, mask in self.selector.select():
+                if key.data is None:
+                    self.__accept()
+                    continue
+                if key.data == 'wake':
+                    self.__drain_replies()
+                    continue
+                state = key.data
+                try:
+                    if mask & selectors.EVENT_WRITE:
+                        self.__flush(state)
+                    if mask & selectors.EVENT_READ:
+                        self.__read(state)
+                except Exception:
+                    self.__close(state)
+
+    def __dispatch(self) -> None:
+        while True:
+            self.friend_listener.handle_push(self.pushes.get())
+
+    def run(self) -> None:
+        """在临时端口上启动客户端监听器"""
         self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.__is_sock_closed = True
-        self.last_response = Response()
-        """上一次的消息响应"""
-        self.username = ''
-        """用户名"""
-        self.email = ''
+        self.__sock.bind(('0.0.0.0', 0))
+        self.__sock.listen(64)
+        self.__sock.setblocking(False)
+        self.port = self.__sock.getsockname()[1]
+        self.friend_listener.port = self.port
+        if self.peer_listener is not None:
+            self.peer_listener.port = self.port
+        self.selector.register(self.__sock, selectors.EVENT_READ, None)
+        self.__wake_r.setblocking(False)
+        self.__wake_w.setblocking(False)
+        self.selector.register(self.__wake_r, selectors.EVENT_READ, 'wake')
+        loop_thread = threading.Thread(target=self.__loop)
+        loop_thread.daemon = True
+        loop_thread.start()
+        dispatch_thread = threading.Thread(target=self.__dispatch)
+        dispatch_thread.daemon = True
+        dispatch_thread.start()
+
+
+class KeyCache:
+    """好友公钥缓存，按指纹校验，命中时服务器不再发送公钥"""
 
-    def connect(self) -> Response:
+    def __init__(self):
+        """初始化公钥缓存"""
+        self.lock = threading.Lock()
+        self.keys: dict[str, tuple[str, Crypto.PublicKey.RSA.RsaKey | Crypto.PublicKey.ECC.EccKey]] = {}
+        """邮件地址到 (指纹, 公钥)"""
+
+    def get(self, email: str) -> tuple[str, Crypto.PublicKey.RSA.RsaKey | Crypto.PublicKey.ECC.EccKey] | None:
+        """缓存的 email 的 (指纹, 公钥)，一次取出，不会被并发的 put 拆开；未缓存时为 None"""
+        with self.lock:
+            return self.keys.get(email, None)
+
+    def put(self, email: str, fingerprint: str, public_key: str) -> Crypto.PublicKey.RSA.RsaKey | Crypto.PublicKey.ECC.EccKey:
+        """缓存 PEM 公钥，返回解析后的公钥"""
+        key = import_public_key(public_key)
+        with self.lock:
+            self.keys[email] = (fingerprint, key)
+        return key
+
+
+key_cache = KeyCache()
+"""所有服务器连接共用的公钥缓存，重新登录后仍然有效"""
+
+
+class RouteCache:
+    """好友路由缓存，保存 start_chat 得到的地址与公钥
+
+    好友状态变化或发送失败时作废，平时发消息不必再经过服务器。
+    """
+
+    def __init__(self):
+        """初始化路由缓存"""
+        self.lock = threading.Lock()
+        self.routes: dict[str, dict] = {}
+        """邮件地址到 start_chat 的响应内容"""
+
+    def get(self, email: str) -> dict | None:
+        """缓存的到 email 的路由，未缓存时为 None"""
+        with self.lock:
+            route = self.routes.get(email, None)
+        return None if route is None else dict(route)
+
+    def put(self, email: str, route: dict) -> None:
+        """缓存到 email 的路由"""
+        with self.lock:
+            self.routes[email] = dict(route)
+
+    def invalidate(self, email: str) -> None:
+        """作废到 email 的路由"""
+        with self.lock:
+            self.routes.pop(email, None)
+
+    def clear(self) -> None:
+        """作废全部路由，如重新登录后可能漏掉了状态推送时"""
+        with self.lock:
+            self.routes.clear()
+
+
+route_cache = RouteCache()
+"""所有服务器连接共用的路由缓存"""
+
+
+class AsyncServerConnection:
+    """异步服务器连接
+
+    每个请求带递增的 id，服务器在响应中原样带回；读取任务按 id 把响应交给在途请求的 future，
+    因此可以同时有多个请求在途，互不串线。不带回 id 的旧版服务器按先后顺序对应。
+    """
+
+    def __init__(self, timeout: float | None = None, on_close: Callable[[], None] | None = None):
+        """初始化异步服务器连接
+
+        Args:
+            timeout (float | None): 请求的默认超时（秒），默认取 `Const.request_timeout`
+            on_close (Callable[[], None] | None): 连接断开后在事件循环中调用，不得阻塞
+        """
+        self.timeout = Const.request_timeout if timeout is None else timeout
+        self.on_close = on_close
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self.next_id = 0
+        self.pending: dict[int, asyncio.Future] = {}
+        """在途请求的 id 到 future，按发送顺序排列"""
+        self.read_task: asyncio.Task | None = None
+
+    async def connect(self) -> Response:
         """连接到服务器
 
         Returns:
             Response: 响应
         """
-        errno = self.__sock.connect_ex((Const.server_ip, Const.server_port))
         retval = Response()
         retval.source = Response.Source.Server
-        if errno != 0:
+        try:
+            self.reader, self.writer = await asyncio.open_connection(Const.server_ip, Const.server_port)
+        except OSError as e:
             retval.status = Response.Status.BadConnection
-            retval.content = {'errno': errno, 'message': 'Connecting socket failed.'}
+            retval.content = {'errno': e.errno, 'message': 'Connecting socket failed.'}
             return retval
-        self.__is_sock_closed = False
+        self.read_task = asyncio.get_running_loop().create_task(self.__read_loop())
         retval.status = Response.Status.Positive
-        self.last_response = retval
-        return self.last_response
+        return retval
 
-    def __send(self, op: str = 'hello', **kwargs) -> Response:
+    async def __read_loop(self) -> None:
+        # Only the new bytes of each chunk are scanned, a large reply is not decoded again and again
+        replies = Framing.JsonReader()
+        while True:
+            try:
+                chunk = await self.reader.read(65536)
+            except OSError:
+                chunk = b''
+            if not chunk:
+                break
+            replies.feed(chunk)
+            try:
+                while True:
+                    echo = replies.next()
+                    if echo is None:
+                        break
+                    self.__resolve(echo)
+            except ValueError:
+                # Out of step with the server, nothing more can be matched
+                break
+        self.__fail_all('Receiving failed.')
+        if self.on_close is not None:
+            self.on_close()
+
+    def __resolve(self, echo: dict) -> None:
+        request_id = echo.get('id', None) if isinstance(echo, dict) else None
+        if request_id is None:
+            # A server without request ids answers in order
+            request_id = next(iter(self.pending), None)
+        future = self.pending.pop(request_id, None)
+        # Replies to requests that already timed out are dropped
+        if future is not None and not future.done():
+            future.set_result(echo)
+
+    def __fail_all(self, message: str) -> None:
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(message))
+
+    async def request(self, op: str = 'hello', timeout: float | None = None, **kwargs) -> Response:
+        """发送一个请求并等待其响应
+
+        Args:
+            op (str): 请求类型
+            timeout (float | None): 超时（秒），默认取连接的默认超时
+
+        Returns:
+            Response: 响应，超时时状态为 `Response.Status.Timeout`
+        """
         retval = Response()
         retval.source = Response.Source.Server
         retval.status = Response.Status.BadConnection
-        if self.__is_sock_closed:
+        if self.writer is None or self.writer.is_closing() or self.read_task.done():
             retval.content = {'message': 'Socket closed.'}
             return retval
-        msg = {'op': op, 'content': kwargs}
+        self.next_id += 1
+        request_id = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
         try:
-            self.__sock.send(json.dumps(msg).encode('utf-8'))
-        except:
+            self.writer.write(json.dumps({'op': op, 'id': request_id, 'content': kwargs}).encode('utf-8'))
+            await self.writer.drain()
+        except OSError:
+            self.pending.pop(request_id, None)
             retval.content = {'message': 'Sending failed.'}
             return retval
         try:
-            echo = self.__sock.recv(Const.buf_len)
-        except:
+            echo = await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            self.pending.pop(request_id, None)
+            retval.status = Response.Status.Timeout
+            retval.content = {'message': 'Request timed out.'}
+            return retval
+        except ConnectionError:
             retval.content = {'message': 'Receiving failed.'}
             return retval
         try:
-            echo = json.loads(echo.decode('utf-8'))
             retval.status = Response.Status(echo['status'])
             retval.content = echo['content']
         except:
-            retval.Status = Response.Status.OtherError
+            retval.status = Response.Status.OtherError
             retval.content = {'message': 'Parsing message failed.'}
         return retval
 
+    async def close(self) -> None:
+        """关闭连接，在途请求以 BadConnection 结束"""
+        if self.writer is not None:
+            self.writer.close()
+        if self.read_task is not None:
+            await self.read_task
+
+
+class EventLoopThread:
+    """在后台线程中运行的事件循环，供同步代码提交协程"""
+
+    def __init__(self):
+        """初始化并启动事件循环线程"""
+        self.loop = asyncio.new_event_loop()
+        loop_thread = threading.Thread(target=self.loop.run_forever)
+        loop_thread.daemon = True
+        loop_thread.start()
+
+    def run(self, coro):
+        """在事件循环中运行协程，阻塞到其完成并返回结果"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+client_loop_lock = threading.Lock()
+client_loop_thread: EventLoopThread | None = None
+
+
+def client_loop() -> EventLoopThread:
+    """所有服务器连接共用的事件循环线程，第一次用到时启动"""
+    global client_loop_thread
+    with client_loop_lock:
+        if client_loop_thread is None:
+            client_loop_thread = EventLoopThread()
+        return client_loop_thread
+
+
+replayable_ops = frozenset({'hello', 'bind_friend_listener', 'bind_peer_listener', 'find_user', 'find_users', 'start_chat',
+                            'suggest_friends', 'presence_query', 'subscribe', 'unsubscribe', 'search_users'})
+"""断线时可能已被服务器执行、但重发也无害的请求；其余请求只在确定没有发出时才重发"""
+
+
+class ServerConnection:
+    """服务器连接
+
+    `AsyncServerConnection` 的同步接口。各线程可以同时调用，请求在同一连接上并发，
+    last_response 按线程分别保存，不会读到别的线程的响应。
+    """
+
+    def __init__(self):
+        """初始化服务器连接"""
+        self.__client = AsyncServerConnection(on_close=self.__on_close)
+        self.__local = threading.local()
+        self.__last_response = Response()
+        self.__lock = threading.Lock()
+        self.__generation = 0
+        """连接代数，每次重连加一，用来判断断线报告是否针对当前连接"""
+        self.__supervisor: threading.Thread | None = None
+        self.__on_reconnect: Callable[[Response], None] | None = None
+        self.__lost = threading.Event()
+        self.__ready = threading.Event()
+        self.__ready.set()
+        self.__closed = False
+        self.__last_reply = time.monotonic()
+        self.__credential: dict | None = None
+        """密码登录的凭据，令牌失效时用来重新登录"""
+        self.__listeners: tuple[FriendListener, PeerListener | None] | None = None
+        self.username = ''
+        """用户名"""
+        self.email = ''
+        self.token: str | None = None
+        """会话恢复令牌"""
+
+    @property
+    def last_response(self) -> Response:
+        """本线程上一次的消息响应，本线程还没有请求过时为任一线程最近的响应"""
+        return getattr(self.__local, 'last_response', self.__last_response)
+
+    @last_response.setter
+    def last_response(self, response: Response) -> None:
+        self.__local.last_response = response
+        self.__last_response = response
+
+    def connect(self) -> Response:
+        """连接到服务器
+
+        Returns:
+            Response: 响应
+        """
+        retval = client_loop().run(self.__client.connect())
+        if retval.status == Response.Status.Positive:
+            self.last_response = retval
+        return retval
+
+    def __request(self, op: str, timeout: float | None = None, **kwargs) -> Response:
+        response = client_loop().run(self.__client.request(op, timeout, **kwargs))
+        if response.status not in (Response.Status.BadConnection, Response.Status.Timeout):
+            self.__last_reply = time.monotonic()
+        return response
+
+    def __send(self, op: str = 'hello', **kwargs) -> Response:
+        generation = self.__generation
+        response = self.__request(op, **kwargs)
+        if (response.status != Response.Status.BadConnection or self.__supervisor is None or self.__closed
+                or threading.current_thread() is self.__supervisor):
+            return response
+        self.__mark_lost(generation)
+        if op not in replayable_ops and response.content.get('message', None) != 'Socket closed.':
+            # The server may have run it before the connection broke, running it twice is not safe
+            return response
+        # Queue behind the supervisor and replay the request on the new connection
+        if not self.__ready.wait(Const.request_timeout) or self.__supervisor is None:
+            return response
+        return self.__request(op, **kwargs)
+
+    def __on_close(self) -> None:
+        # Runs in the event loop, the read loop of the current client ended
+        self.__mark_lost(self.__generation)
+
+    def __mark_lost(self, generation: int) -> None:
+        with self.__lock:
+            if self.__closed or self.__supervisor is None or generation != self.__generation or self.__lost.is_set():
+                return
+            self.__ready.clear()
+            self.__lost.set()
+
+    def supervise(self, on_reconnect: Callable[[Response], None] | None = None) -> None:
+        """登录成功后开始监督连接
+
+        请求失败、连接断开或心跳没有回应都视为断线。监督线程按带随机抖动的指数退避重连，
+        服务器重启后各客户端不会同时涌入；重连后先凭令牌恢复会话，令牌失效时用密码登录的凭据
+        重新登录并绑定监听器。断线期间发出的请求排队等待，重连成功后在新连接上重发；
+        已经发出的请求只有在 `replayable_ops` 中时才重发，其余以 BadConnection 结束，由调用方决定是否重试。
+
+        Args:
+            on_reconnect (Callable[[Response], None] | None): 每次重连结束后在监督线程中调用，
+                成功时响应为正向反馈；无法恢复会话时为负向反馈，监督随之停止，需要重新登录
+        """
+        self.__on_reconnect = on_reconnect
+        self.__last_reply = time.monotonic()
+        if self.__supervisor is not None:
+            return
+        self.__supervisor = threading.Thread(target=self.__supervise)
+        self.__supervisor.daemon = True
+        self.__supervisor.start()
+
+    def __supervise(self) -> None:
+        while not self.__closed:
+            if not self.__lost.wait(Const.heartbeat_interval):
+                if time.monotonic() - self.__last_reply < Const.heartbeat_interval:
+                    # Recent replies prove the connection alive
+                    continue
+                generation = self.__generation
+                response = self.__request('hello', timeout=Const.request_timeout)
+                if response.status in (Response.Status.BadConnection, Response.Status.Timeout):
+                    self.__mark_lost(generation)
+                continue
+            if self.__closed:
+                break
+            response = self.__recover()
+            if response.status != Response.Status.Positive:
+                with self.__lock:
+                    self.__supervisor = None
+                    self.__ready.set()
+            if self.__on_reconnect is not None:
+                self.__on_reconnect(response)
+            if response.status != Response.Status.Positive:
+                break
+
+    def __reconnect(self) -> Response:
+        old_client = self.__client
+        client = AsyncServerConnection(on_close=self.__on_close)
+        response = client_loop().run(client.connect())
+        if response.status == Response.Status.Positive:
+            with self.__lock:
+                self.__client = client
+                self.__generation += 1
+        client_loop().run(old_client.close())
+        return response
+
+    def __recover(self) -> Response:
+        attempt = 0
+        while not self.__closed:
+            # Full jitter spreads the clients of a restarted server over the whole window
+            time.sleep(random.uniform(0, min(Const.reconnect_max_delay, Const.reconnect_base_delay * 2 ** attempt)))
+            attempt += 1
+            if self.__reconnect().status != Response.Status.Positive:
+                continue
+            response = self.__reauthenticate()
+            if response.status in (Response.Status.BadConnection, Response.Status.Timeout):
+                continue
+            if response.status == Response.Status.Positive:
+                with self.__lock:
+                    self.__lost.clear()
+                    self.__ready.set()
+            return response
+        response = Response()
+        response.source = Response.Source.Client
+        response.status = Response.Status.BadConnection
+        response.content = {'message': 'Socket closed.'}
+        return response
+
+    def __reauthenticate(self) -> Response:
+        response = Response()
+        response.source = Response.Source.Client
+        response.status = Response.Status.Negative
+        response.content = {'message': 'No session to resume.'}
+        if self.token is not None:
+            response = self.resume(self.token)
+            if response.status == Response.Status.Positive or self.__credential is None:
+                return response
+            # The server drops the connection after rejecting the token
+            if self.__reconnect().status != Response.Status.Positive:
+                response.status = Response.Status.BadConnection
+                return response
+        if self.__credential is not None and self.__listeners is not None:
+            response = self.__login_and_bind(self.__listeners[0], self.__listeners[1], self.__credential)
+        return response
+
     def refresh(self) -> Response:
         """刷新连接
 
@@ -295,6 +1359,7 @@ class ServerConnection:
         response = self.__send('password_login', email=email, pwdhash=hashlib.sha256(password.encode('utf-8')).hexdigest())
         if response.status == Response.Status.Positive:
             self.username = response.content['name']
+            self.token = response.content.get('token', None)
         self.last_response = response
         return self.last_response
 
@@ -312,6 +1377,75 @@ class ServerConnection:
         response = self.__send('vericode_login', email=email, vericode=vericode)
         if response.status == Response.Status.Positive:
             self.username = response.content['name']
+            self.token = response.content.get('token', None)
+        self.last_response = response
+        return self.last_response
+
+    def resume(self, token: str) -> Response:
+        """断线重连后凭令牌接回原会话，无需重新登录和绑定监听器
+
+        Args:
+            token (str): 上一个连接登录或恢复时得到的令牌
+
+        Returns:
+            Response: 响应，令牌无效或已过期时为负向反馈，需要重新登录
+        """
+        response = self.__send('resume', token=token)
+        if response.status == Response.Status.Positive:
+            self.username = response.content['name']
+            self.token = response.content['token']
+        self.last_response = response
+        return self.last_response
+
+    def login_and_bind(self,
+                       email: str,
+                       friend_listener: FriendListener,
+                       peer_listener: PeerListener | None,
+                       password: str | None = None,
+                       vericode: str | None = None) -> Response:
+        """登录并绑定好友监听器与伙伴监听器，一次往返完成
+
+        好友列表与未处理的好友请求随响应一并返回，直接交给 friend_listener 处理，
+        服务器不再回连好友监听器推送。
+
+        Args:
+            email (str): 邮件地址
+            friend_listener (FriendListener): 好友监听器
+            peer_listener (PeerListener | None): 伙伴监听器，为 None 时只绑定好友监听器，
+                登录后再调用 `bind_peer_listener`
+            password (str | None): 密码原文，为 None 时用验证码登录
+            vericode (str | None): 验证码
+
+        Returns:
+            Response: 响应
+        """
+        self.email = email
+        if password is not None:
+            credential = {'pwdhash': hashlib.sha256(password.encode('utf-8')).hexdigest()}
+        else:
+            credential = {'vericode': vericode}
+        response = self.__login_and_bind(friend_listener, peer_listener, credential)
+        if response.status == Response.Status.Positive:
+            # A vericode is used up, only a password login can be replayed
+            self.__credential = credential if password is not None else None
+            self.__listeners = (friend_listener, peer_listener)
+        return response
+
+    def __login_and_bind(self, friend_listener: FriendListener, peer_listener: PeerListener | None, credential: dict) -> Response:
+        version = friend_listener.version if friend_listener.delta_callback is not None else None
+        if peer_listener is not None:
+            credential = dict(credential, peer_port=peer_listener.port, public_key=export_public_key(peer_listener.public_key))
+        response = self.__send('login_and_bind',
+                               email=self.email,
+                               friend_port=friend_listener.port,
+                               version=version,
+                               **credential)
+        if response.status == Response.Status.Positive:
+            self.username = response.content['name']
+            self.token = response.content['token']
+            friend_listener.dispatch(response.content['sync']['op'], response.content['sync']['content'])
+            for request in response.content['requests']:
+                friend_listener.dispatch('new', request)
         self.last_response = response
         return self.last_response
 
@@ -324,7 +1458,8 @@ class ServerConnection:
         Returns:
             Response: 响应
         """
-        self.last_response = self.__send('bind_friend_listener', port=friend_listener.port)
+        version = friend_listener.version if friend_listener.delta_callback is not None else None
+        self.last_response = self.__send('bind_friend_listener', port=friend_listener.port, version=version)
         return self.last_response
 
     def bind_peer_listener(self, peer_listener: PeerListener) -> Response:
@@ -336,7 +1471,10 @@ class ServerConnection:
         Returns:
             Response: 响应
         """
-        self.last_response = self.__send('bind_peer_listener', port=peer_listener.port, public_key=peer_listener.public_key.exportKey().decode())
+        self.last_response = self.__send('bind_peer_listener', port=peer_listener.port, public_key=export_public_key(peer_listener.public_key))
+        if self.last_response.status == Response.Status.Positive and self.__listeners is not None:
+            # A later re-login binds this one too
+            self.__listeners = (self.__listeners[0], peer_listener)
         return self.last_response
 
     def find_user(self, user_email: str) -> Response:
@@ -387,17 +1525,162 @@ class ServerConnection:
         self.last_response = self.__send('delete_friend', email=friend_email)
         return self.last_response
 
-    def start_chat(self, friend_email: str) -> Response:
-        """发起对话
+    def start_chat(self, friend_email: str, use_cache: bool = True) -> Response:
+        """发起对话，已缓存路由时不经过服务器，已缓存对方公钥时服务器只返回指纹
 
         Args:
             friend_email (str): 邮箱地址
+            use_cache (bool): 是否使用缓存的路由
+
+        Returns:
+            Response: 响应，成功时 `content['public_key']` 为解析后的对方公钥，
+                来自路由缓存时 `source` 为 `Response.Source.Client`
+        """
+        route = route_cache.get(friend_email) if use_cache else None
+        if route is not None:
+            response = Response()
+            response.source = Response.Source.Client
+            response.status = Response.Status.Positive
+            response.content = route
+            response.content['my_email'] = self.email
+            self.last_response = response
+            return self.last_response
+        cached = key_cache.get(friend_email)
+        response = self.__send('start_chat', email=friend_email, fingerprint=None if cached is None else cached[0])
+        if response.status == Response.Status.Positive:
+            # The server omits the key when the cached fingerprint is current
+            if 'public_key' in response.content:
+                public_key = key_cache.put(friend_email, response.content['fingerprint'], response.content['public_key'])
+            else:
+                public_key = cached[1]
+            response.content['public_key'] = public_key
+            route_cache.put(friend_email, response.content)
+        response.content['my_email'] = self.email
+        self.last_response = response
+        return self.last_response
+
+    def suggest_friends(self, limit: int = 10) -> Response:
+        """按共同好友数推荐好友
+
+        Args:
+            limit (int): 最多返回的候选人数
+
+        Returns:
+            Response: 响应，`content['users']` 为含 email、username、mutual 的字典列表
+        """
+        self.last_response = self.__send('suggest_friends', limit=limit)
+        return self.last_response
+
+    def __send_batch(self, op: str, emails: list[str], chunk_size: int = 50) -> Response:
+        # Split long lists so that every request stays well below buf_len, then merge the results
+        results = []
+        for i in range(0, max(len(emails), 1), chunk_size):
+            response = self.__send(op, emails=emails[i:i + chunk_size])
+            if response.status != Response.Status.Positive:
+                return response
+            results.extend(response.content['results'])
+        response.content = {'results': results}
+        return response
+
+    def find_users(self, emails: list[str]) -> Response:
+        """批量查找用户
+
+        Args:
+            emails (list[str]): 邮件地址列表，过长时分批发送
+
+        Returns:
+            Response: 响应，`content['results']` 为逐项结果，含 email、ok，
+                成功时含 username，失败时含 message
+        """
+        self.last_response = self.__send_batch('find_users', emails)
+        return self.last_response
+
+    def add_friends(self, emails: list[str]) -> Response:
+        """批量发送好友请求，无需先查找用户
+
+        Args:
+            emails (list[str]): 邮件地址列表，过长时分批发送
+
+        Returns:
+            Response: 响应，`content['results']` 为逐项结果，含 email、ok，失败时含 message
+        """
+        self.last_response = self.__send_batch('add_friends', emails)
+        return self.last_response
+
+    def confirm_friends(self, emails: list[str]) -> Response:
+        """批量通过好友请求，全部新好友合并为一次推送
+
+        Args:
+            emails (list[str]): 邮件地址列表，过长时分批发送
+
+        Returns:
+            Response: 响应，`content['results']` 为逐项结果，含 email、ok，失败时含 message
+        """
+        self.last_response = self.__send_batch('confirm_friends', emails)
+        return self.last_response
+
+    def delete_friends(self, emails: list[str]) -> Response:
+        """批量删除好友，全部删除合并为一次推送
+
+        Args:
+            emails (list[str]): 邮件地址列表，过长时分批发送
+
+        Returns:
+            Response: 响应，`content['results']` 为逐项结果，含 email、ok，失败时含 message
+        """
+        self.last_response = self.__send_batch('delete_friends', emails)
+        return self.last_response
+
+    def presence_query(self, emails: list[str]) -> Response:
+        """批量查询好友的在线状态
+
+        Args:
+            emails (list[str]): 邮件地址列表，过长时应分批查询，使请求不超过 buf_len
+
+        Returns:
+            Response: 响应，`content` 中 online、offline、unknown 为邮件地址列表，
+                非好友的地址归入 unknown
+        """
+        self.last_response = self.__send('presence_query', emails=emails)
+        return self.last_response
+
+    def subscribe(self, emails: list[str]) -> Response:
+        """订阅好友的在线状态变化，登录时已自动订阅全部好友
+
+        Args:
+            emails (list[str]): 邮件地址列表
+
+        Returns:
+            Response: 响应，内容同 presence_query，非好友不会被订阅
+        """
+        self.last_response = self.__send('subscribe', emails=emails)
+        return self.last_response
+
+    def unsubscribe(self, emails: list[str]) -> Response:
+        """取消订阅在线状态变化
+
+        Args:
+            emails (list[str]): 邮件地址列表
 
         Returns:
             Response: 响应
         """
-        self.last_response = self.__send('start_chat', email=friend_email)
-        self.last_response.content['my_email'] = self.email
+        self.last_response = self.__send('unsubscribe', emails=emails)
+        return self.last_response
+
+    def search_users(self, query: str, offset: int = 0, limit: int = 20) -> Response:
+        """按邮件地址或用户名前缀搜索用户，容许少量拼写错误
+
+        Args:
+            query (str): 搜索词
+            offset (int): 跳过的结果数
+            limit (int): 本页最多返回的结果数
+
+        Returns:
+            Response: 响应，`content['users']` 为含 email、username 的字典列表，
+                `content['next']` 为下一页的 offset，没有下一页时为 None
+        """
+        self.last_response = self.__send('search_users', query=query, offset=offset, limit=limit)
         return self.last_response
 
     def close(self) -> Response:
@@ -406,72 +1689,152 @@ class ServerConnection:
         Returns:
             Response: 响应
         """
+        with self.__lock:
+            # Stop the supervisor first, the server closing the socket is expected now
+            self.__closed = True
+            self.__lost.set()
         self.last_response = self.__send('close')
+        client_loop().run(self.__client.close())
         return self.last_response
 
 
+cover_pool = Stego.CoverPool()
+"""所有 PeerSender 共用的载体图片池"""
+
+
 class PeerSender:
     """伙伴发送器"""
 
-    def __init__(self, server_response: Response):
-        """初始化伙伴发送器
+    def __init__(self, server_response: Response, covert: bool | None = None):
+        """初始化伙伴发送器，连接后与对方协商传输方式
 
         Args:
             server_response (Response): `ServerConnection.start_chat` 的返回值
+            covert (bool | None): 是否一律藏进图片发送，默认取 `Const.covert`
         """
         self.dest_email: str = server_response.content['email']
         self.dest_ip: str = server_response.content['ip']
         self.dest_port: int = server_response.content['port']
         self.email = server_response.content['my_email']
-        self.dest_pub_key = Crypto.PublicKey.RSA.importKey(server_response.content['public_key'])
+        public_key = server_response.content['public_key']
+        if isinstance(public_key, str):
+            public_key = import_public_key(public_key)
+        self.dest_pub_key = public_key
         self.last_response = Response()
+        self.closed = False
+        """对方是否已关闭连接，关闭后不能再复用"""
+        self.sent_bytes = 0
+        """已发送的消息帧字节数"""
         self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.__sock.connect((self.dest_ip, self.dest_port))
-
-    def __send_pic(self, post: str):
-        pic_no = random.randint(1, 100)
-        secret_img = lsb.hide(f'imgs/{pic_no}.jpg', post)
+        self.covert = Const.covert if covert is None else covert
+        self.session_key: bytes | None = None
+        """协商得到的会话密钥，为 None 时每条消息各用 RSA 加密一个密钥"""
+        self.session_start = 0.0
+        self.nonce_counter = 0
+        # Covert senders negotiate too, with the hello hidden in an image like their messages
+        self.raw = self.__hello() and not self.covert
+        """是否发送不经隐写的原文"""
+
+    def __hello(self) -> bool:
+        # Until the reply confirms a new session, the listener on this connection holds no key for us
+        self.session_key = None
+        self.nonce_counter = 0
+        hello = {'modes': ['covert', 'raw']}
+        if isinstance(self.dest_pub_key, Crypto.PublicKey.ECC.EccKey):
+            ephemeral_key = Crypto.PublicKey.ECC.generate(curve=self.dest_pub_key.curve)
+            session_key = Crypto.Protocol.DH.key_agreement(eph_priv=ephemeral_key, static_pub=self.dest_pub_key, kdf=session_kdf)
+            hello['ephemeral_key'] = ephemeral_key.public_key().export_key(format='PEM')
+        else:
+            session_key = Crypto.Random.new().read(16)
+            rsa_cipher = Crypto.Cipher.PKCS1_v1_5.new(self.dest_pub_key)
+            hello['session_key'] = base64.b64encode(rsa_cipher.encrypt(session_key)).decode()
+        self.__sock.sendall(hello_frame(hello, not self.covert))
+        header = recv_exact(self.__sock, peer_header.size)
+        if header is None:
+            # A listener without negotiation drops the connection, reconnect and stay covert
+            self.__sock.close()
+            self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.__sock.connect((self.dest_ip, self.dest_port))
+            return False
+        reply_flags, reply_len = peer_header.unpack(header)
+        reply = recv_exact(self.__sock, reply_len)
+        if reply is None:
+            raise ConnectionError('Peer closed the connection.')
+        reply = read_hello(reply_flags, reply)
+        if reply.get('session', False):
+            self.session_key = session_key
+            self.session_start = time.time()
+        return 'raw' in reply['modes']
+
+    def __send_frame(self, frame: bytes | memoryview, ack: bool):
+        self.__sock.sendall(frame)
+        self.sent_bytes += len(frame)
+        if ack:
+            reply = self.__sock.recv(1)
+            if reply != b'\x01':
+                # Closed, or rejected by a listener that could not decode it
+                self.closed = True
+                raise ConnectionError('Peer closed the connection.' if not reply else 'Peer rejected the message.')
+
+    def __send_raw(self, post: bytes, ack: bool):
+        flags = peer_flag_raw | (peer_flag_ack if ack else 0)
+        self.__send_frame(peer_header.pack(flags, len(post)) + post, ack)
+
+    def __send_pic(self, post: bytes, ack: bool):
+        secret_img = Stego.hide(cover_pool.fit(len(post)), post)
+        # Reserve the header and save the image right after it, so the frame is sent without copying
         bytes_io = io.BytesIO()
+        bytes_io.write(bytes(peer_header.size))
         secret_img.save(bytes_io, format="PNG")
-        full_msg = bytes_io.getvalue()
-        full_len = len(full_msg)
-        msg_group = []
-        start_index = 0
-        end_index = 3072 if full_len >= 3072 else full_len
-        while True:
-            msg_group.append(full_msg[start_index:end_index])
-            if end_index == full_len:
-                break
-            else:
-                start_index += 3072
-                end_index = min(3072 + end_index, full_len)
-        self.__sock.send(f'{len(msg_group)}'.encode())
-        for i in range(len(msg_group)):
-            self.__sock.recv(Const.buf_len)
-            self.__sock.send(msg_group[i])
-        self.__sock.recv(Const.buf_len)
+        frame = bytes_io.getbuffer()
+        peer_header.pack_into(frame, 0, peer_flag_ack if ack else 0, len(frame) - peer_header.size)
+        try:
+            self.__send_frame(frame, ack)
+        finally:
+            frame.release()
         secret_img.show()
 
-    def send(self, message: Message) -> Response:
+    def send(self, message: Message, ack: bool = True) -> Response:
         """发送消息
 
         Args:
             message (Message): 消息对象
+            ack (bool): 是否等待对方确认收到，不等待时无法得知对方是否已关闭连接
 
         Returns:
             Response: 响应
         """
-        iv = Crypto.Random.new().read(16)
-        aes_key = Crypto.Random.new().read(16)
-        aes = Crypto.Cipher.AES.new(aes_key, Crypto.Cipher.AES.MODE_CFB, iv)
-        rsa_cipher = Crypto.Cipher.PKCS1_v1_5.new(self.dest_pub_key)
+        if self.session_key is not None and time.time() - self.session_start > peer_session_lifetime:
+            self.raw = self.__hello() and not self.covert
         post = {}
-        post['key'] = base64.b64encode(rsa_cipher.encrypt(aes_key)).decode()
-        post['attrs'] = message.attributes
-        post['msg'] = base64.b64encode(aes.encrypt(message.content)).decode()
-        post['sender'] = self.email
-        post['iv'] = base64.b64encode(iv).decode()
-        self.__send_pic(json.dumps(post).encode())
+        if self.session_key is not None:
+            self.nonce_counter += 1
+            nonce = self.nonce_counter.to_bytes(12, 'big')
+            aes = Crypto.Cipher.AES.new(self.session_key, Crypto.Cipher.AES.MODE_GCM, nonce=nonce)
+            aes.update(session_aad(self.email, message.attributes))
+            ciphertext, tag = aes.encrypt_and_digest(message.content)
+            post['attrs'] = message.attributes
+            post['msg'] = base64.b64encode(ciphertext).decode()
+            post['sender'] = self.email
+            post['nonce'] = base64.b64encode(nonce).decode()
+            post['tag'] = base64.b64encode(tag).decode()
+        else:
+            if isinstance(self.dest_pub_key, Crypto.PublicKey.ECC.EccKey):
+                raise ConnectionError('Peer did not agree on a session key.')
+            iv = Crypto.Random.new().read(16)
+            aes_key = Crypto.Random.new().read(16)
+            aes = Crypto.Cipher.AES.new(aes_key, Crypto.Cipher.AES.MODE_CFB, iv)
+            rsa_cipher = Crypto.Cipher.PKCS1_v1_5.new(self.dest_pub_key)
+            post['key'] = base64.b64encode(rsa_cipher.encrypt(aes_key)).decode()
+            post['attrs'] = message.attributes
+            post['msg'] = base64.b64encode(aes.encrypt(message.content)).decode()
+            post['sender'] = self.email
+            post['iv'] = base64.b64encode(iv).decode()
+        if self.raw:
+            self.__send_raw(json.dumps(post).encode(), ack)
+        else:
+            self.__send_pic(json.dumps(post).encode(), ack)
         #self.__sock.send(json.dumps(post).encode())
 
     def close(self) -> Response:
@@ -480,12 +1843,387 @@ class PeerSender:
         Returns:
             Response: 响应
         """
+        self.closed = True
         self.__sock.close()
 
 
+class PeerPool:
+    """伙伴连接池，按好友邮件地址复用 PeerSender
+
+    发送时取出连接，发送完放回；空闲超过 idle_timeout 的连接由后台线程关闭。
+    复用的连接已失效时，重新发起对话并重发一次。对方可能在连接断开前已经收到，
+    因此每条消息带上 id 属性，重发时不变，由对方的 `DecodePipeline` 去重。
+    """
+
+    def __init__(self, idle_timeout: float = 60):
+        """初始化伙伴连接池
+
+        Args:
+            idle_timeout (float): 连接空闲多久后关闭（秒）
+        """
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.senders: dict[str, tuple[PeerSender, float]] = {}
+        """空闲连接及其上次使用时间"""
+        evict_thread = threading.Thread(target=self.__evict_loop)
+        evict_thread.daemon = True
+        evict_thread.start()
+
+    def __evict_loop(self) -> None:
+        while True:
+            time.sleep(self.idle_timeout / 2)
+            self.evict(time.time() - self.idle_timeout)
+
+    def evict(self, before: float = float('inf')) -> None:
+        """关闭上次使用早于 before 的空闲连接，默认全部关闭"""
+        with self.lock:
+            idle = [email for email, (_, last_used) in self.senders.items() if last_used < before]
+            evicted = [self.senders.pop(email)[0] for email in idle]
+        for sender in evicted:
+            sender.close()
+
+    def discard(self, email: str) -> None:
+        """关闭到 email 的空闲连接，如对方下线时"""
+        with self.lock:
+            pooled = self.senders.pop(email, None)
+        if pooled is not None:
+            pooled[0].close()
+
+    def send(self, email: str, message: Message, start_chat: Callable[[], Response]) -> Response:
+        """向 email 发送消息
+
+        Args:
+            email (str): 对方邮件地址
+            message (Message): 消息对象
+            start_chat (Callable[[], Response]): 没有可用连接时调用，返回 `ServerConnection.start_chat` 的结果
+
+        Returns:
+            Response: 响应，发起对话失败时为 start_chat 的响应
+        """
+        # Kept across retries, including later ones from the outbox
+        message.attributes.setdefault('id', Crypto.Random.get_random_bytes(12).hex())
+        with self.lock:
+            pooled = self.senders.pop(email, None)
+        sender = None
+        if pooled is not None:
+            sender = pooled[0]
+            try:
+                sender.send(message)
+            except OSError:
+                # The pooled connection is dead, though the frame may have arrived before the ack was lost;
+                # retry on a new one and let the receiver drop a duplicate by its id
+                sender.close()
+                sender = None
+        if sender is None:
+            response = start_chat()
+            if response.status != Response.Status.Positive:
+                return response
+            try:
+                sender = PeerSender(response)
+                sender.send(message)
+            except OSError:
+                if sender is not None:
+                    sender.close()
+                if response.source == Response.Source.Client:
+                    # The cached route is stale, ask the server once more
+                    route_cache.invalidate(email)
+                    return self.send(email, message, start_chat)
+                retval = Response()
+                retval.source = Response.Source.Peer
+                retval.status = Response.Status.BadConnection
+                retval.content = {'message': 'Sending to peer failed.'}
+                return retval
+        if not sender.closed:
+            with self.lock:
+                replaced = self.senders.get(email, None)
+                self.senders[email] = (sender, time.time())
+            if replaced is not None:
+                replaced[0].close()
+        retval = Response()
+        retval.source = Response.Source.Peer
+        retval.status = Response.Status.Positive
+        return retval
+
+
+class Outbox:
+    """待发送消息箱
+
+    发不出去的伙伴消息存入消息库的 outbox_T 表，客户端退出后也不会丢失。
+    后台线程在对方上线时逐个会话补发，每次从表中取出一批，按入箱顺序发送；
+    某条发送失败时，该会话其后的消息留在箱中等下次，同一会话内的先后顺序不会打乱。
+    补发期间新的消息直接入箱排在后面，不等补发结束。对方不在线时消息一直留在箱中，等上线通知再补发；
+    只有对方在线而发送失败才计入次数，一条消息这样失败 max_attempts 次后放弃，
+    通过 expired_callback 告知调用方，其后的消息照常补发。
+    """
+
+    class State(Enum):
+        """待发送消息的投递状态"""
+        Queued = 0
+        """等待发送"""
+        Sending = 1
+        """已被后台线程取出，正在发送"""
+
+    def __init__(self,
+                 deliver: Callable[[str, Message], Response],
+                 db_path: str = 'message.db',
+                 batch_size: int = 50,
+                 retry_interval: float = 60,
+                 max_attempts: int = 10,
+                 expired_callback: Callable[[str, list[Message]], None] | None = None):
+        """初始化待发送消息箱
+
+        Args:
+            deliver (Callable[[str, Message], Response]): 向对方发送一条消息，如 `PeerPool.send`，
+                对方在线而发送失败时返回来源为 `Response.Source.Peer` 的回复
+            db_path (str): 消息库路径
+            batch_size (int): 每次从表中取出的消息数
+            retry_interval (float): 没有上线通知时，隔多久把对方在线但发送失败的会话重试一遍（秒）
+            max_attempts (int): 对方在线时一条消息最多补发几次，之后从箱中删去
+            expired_callback (Callable[[str, list[Message]], None] | None): 放弃补发时在后台线程中回调，
+                参数依次为对方邮件地址、放弃的消息
+        """
+        self.deliver = deliver
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.expired_callback = expired_callback
+        self.account = ''
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.waiting: set[str] = set()
+        """箱中有消息的对方邮件地址"""
+        self.ready: set[str] = set()
+        """已上线、等待补发的对方邮件地址"""
+        self.offline: set[str] = set()
+        """上次补发时不在线的对方邮件地址，只等上线通知"""
+        self.conversation_locks: dict[str, threading.Lock] = {}
+        """每个会话一把锁，同一会话的直接发送依次进行"""
+        self.sender_thread: threading.Thread | None = None
+
+    def __connect(self) -> sqlite3.Connection:
+        db_conn = sqlite3.connect(self.db_path)
+        db_conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS outbox_T (
+                id          INTEGER     PRIMARY KEY AUTOINCREMENT,
+                account     CHAR(50)    NOT NULL,
+                recver      CHAR(50)    NOT NULL,
+                timestamp   FLOAT       NOT NULL,
+                attributes  TEXT        NOT NULL,
+                message     BLOB        NOT NULL,
+                state       INTEGER     NOT NULL,
+                attempts    INTEGER     NOT NULL DEFAULT 0
+            )
+            """
+        )
+        db_conn.execute('CREATE INDEX IF NOT EXISTS outbox_recver ON outbox_T (account, recver, id)')
+        return db_conn
+
+    def __conversation_lock(self, email: str) -> threading.Lock:
+        with self.lock:
+            return self.conversation_locks.setdefault(email, threading.Lock())
+
+    def open(self, account: str) -> None:
+        """登录后载入 account 的待发送消息并启动后台线程，先把箱中全部会话补发一遍
+
+        Args:
+            account (str): 本机登录的邮件地址
+        """
+        with self.__connect() as db_conn:
+            # Rows left in Sending by a client that exited mid-batch go out again
+            db_conn.execute('UPDATE outbox_T SET state=? WHERE account=? AND state=?',
+                            (Outbox.State.Queued.value, account, Outbox.State.Sending.value))
+            waiting = {email for email, in db_conn.execute('SELECT DISTINCT recver FROM outbox_T WHERE account=?', (account,))}
+        db_conn.close()
+        with self.lock:
+            self.account = account
+            self.waiting = waiting
+            self.ready = set(waiting)
+            self.offline = set()
+            self.wakeup.notify()
+            if self.sender_thread is None:
+                self.sender_thread = threading.Thread(target=self.__send_loop)
+                self.sender_thread.daemon = True
+                self.sender_thread.start()
+
+    def send(self, email: str, message: Message) -> Response:
+        """发送消息，发不出去时存入待发送消息箱
+
+        与 email 的会话中还有未发出的消息时，直接入箱排在其后，不等待正在进行的补发。
+
+        Args:
+            email (str): 对方邮件地址
+            message (Message): 消息对象，入箱时已序列化，调用后可以复用
+
+        Returns:
+            Response: 响应，入箱时为负向反馈，content 中 queued 为 True
+        """
+        with self.lock:
+            queued = email in self.waiting
+        if queued:
+            # Possibly being drained right now, the drain picks it up after the earlier ones
+            self.__enqueue(email, message, True)
+        else:
+            with self.__conversation_lock(email):
+                with self.lock:
+                    queued = email in self.waiting
+                if not queued:
+                    response = self.deliver(email, message)
+                    if response.status == Response.Status.Positive:
+                        return response
+                self.__enqueue(email, message, queued)
+        retval = Response()
+        retval.source = Response.Source.Client
+        retval.status = Response.Status.Negative
+        retval.content = {'queued': True, 'message': 'Queued for delivery.'}
+        return retval
+
+    def __enqueue(self, email: str, message: Message, behind: bool) -> None:
+        db_conn = self.__connect()
+        # Under the lock, so a drain that finds the box empty and this insert cannot interleave
+        with self.lock:
+            with db_conn:
+                db_conn.execute('INSERT INTO outbox_T (account, recver, timestamp, attributes, message, state) VALUES (?, ?, ?, ?, ?, ?)',
+                                (self.account, email, time.time(), json.dumps(message.attributes), message.content, Outbox.State.Queued.value))
+            if behind and email not in self.waiting:
+                # Queued behind a drain that has just emptied the box, the peer is likely reachable
+                self.ready.add(email)
+                self.wakeup.notify()
+            self.waiting.add(email)
+        db_conn.close()
+
+    def wake(self, email: str) -> None:
+        """email 上线时调用，箱中有发给对方的消息时立即补发"""
+        with self.lock:
+            self.offline.discard(email)
+            if email in self.waiting:
+                self.ready.add(email)
+                self.wakeup.notify()
+
+    def __send_loop(self) -> None:
+        while True:
+            with self.lock:
+                if len(self.ready) == 0 and not self.wakeup.wait(self.retry_interval):
+                    # No presence push for a while, retry the conversations whose peer was online
+                    self.ready = self.waiting - self.offline
+                ready, self.ready = self.ready, set()
+            for email in ready:
+                self.__drain(email)
+
+    def __drain(self, email: str) -> None:
+        # No conversation lock is held here, send only queues behind a conversation that is in the box
+        db_conn = self.__connect()
+        while True:
+            with self.lock:
+                rows = db_conn.execute('SELECT id, attributes, message, attempts FROM outbox_T WHERE account=? AND recver=? AND state=? ORDER BY id LIMIT ?',
+                                       (self.account, email, Outbox.State.Queued.value, self.batch_size)).fetchall()
+                if len(rows) == 0:
+                    self.waiting.discard(email)
+                    self.offline.discard(email)
+                    break
+            ids = [row[0] for row in rows]
+            db_conn.executemany('UPDATE outbox_T SET state=? WHERE id=?',
+                                [(Outbox.State.Sending.value, row_id) for row_id in ids])
+            db_conn.commit()
+            delivered = []
+            expired = []
+            peer_failed = False
+            for row_id, attributes, content, attempts in rows:
+                message = Message()
+                message.attributes = json.loads(attributes)
+                message.content = content
+                response = self.deliver(email, message)
+                if response.status == Response.Status.Positive:
+                    delivered.append(row_id)
+                    continue
+                peer_failed = response.source == Response.Source.Peer
+                if not peer_failed:
+                    # Offline or the server is unreachable, nothing was sent to the peer
+                    break
+                if attempts + 1 >= self.max_attempts:
+                    # Given up, the later messages of the conversation still go out
+                    expired.append((row_id, message))
+                    continue
+                break
+            done = delivered + [row_id for row_id, _ in expired]
+            failed = ids[len(done):]
+            db_conn.executemany('DELETE FROM outbox_T WHERE id=?', [(row_id,) for row_id in done])
+            db_conn.executemany('UPDATE outbox_T SET state=? WHERE id=?',
+                                [(Outbox.State.Queued.value, row_id) for row_id in failed])
+            if len(failed) > 0 and peer_failed:
+                # Only the message that was actually tried counts the attempt
+                db_conn.execute('UPDATE outbox_T SET attempts=attempts+1 WHERE id=?', (failed[0],))
+            db_conn.commit()
+            if len(expired) > 0 and self.expired_callback is not None:
+                self.expired_callback(email, [message for _, message in expired])
+            if len(failed) > 0:
+                if not peer_failed:
+                    with self.lock:
+                        self.offline.add(email)
+                # Still unreachable, the rest of the conversation waits for the next wake
+                break
+        db_conn.close()
+
+
 if __name__ == '__main__':
     hint = input('Hint:\n')
 
+    if hint == 'bench':
+        # Both modes over loopback, without the image viewers opened for every stego message
+        Image.Image.show = lambda self, *args, **kwargs: None
+        for covert in (True, False):
+            peer_listener = PeerListener(lambda email, t, msg: None)
+            peer_listener.run()
+            time.sleep(0.1)
+            r = Response()
+            r.status = Response.Status.Positive
+            r.content = {'email': 'peer', 'ip': '127.0.0.1', 'port': peer_listener.port,
+                         'my_email': 'me', 'public_key': peer_listener.public_key}
+            sender = PeerSender(r, covert=covert)
+            msg = Message()
+            msg.content = ('x' * 100).encode()
+            count = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < 3:
+                sender.send(msg)
+                count += 1
+            elapsed = time.perf_counter() - start
+            print(f'{"covert" if covert else "raw":6}: {count / elapsed:8.1f} msg/s, '
+                  f'{sender.sent_bytes / count:9.1f} bytes/msg')
+            sender.close()
+
+        # Receiving a burst of covert messages, inline and with decode workers
+        session_key = Crypto.Random.new().read(16)
+        frames = []
+        for i in range(1, 201):
+            nonce = i.to_bytes(12, 'big')
+            aes = Crypto.Cipher.AES.new(session_key, Crypto.Cipher.AES.MODE_GCM, nonce=nonce)
+            aes.update(session_aad('peer', {}))
+            ciphertext, tag = aes.encrypt_and_digest(('x' * 100).encode())
+            post = json.dumps({'attrs': {}, 'msg': base64.b64encode(ciphertext).decode(), 'sender': 'peer',
+                               'nonce': base64.b64encode(nonce).decode(), 'tag': base64.b64encode(tag).decode()})
+            bytes_io = io.BytesIO()
+            Stego.hide(cover_pool.fit(len(post)), post.encode()).save(bytes_io, format='PNG')
+            frames.append(bytes_io.getvalue())
+        for workers in (0, max(1, min(4, (os.cpu_count() or 1) - 1))):
+            delivered = []
+            pipeline = DecodePipeline(lambda email, t, msg: delivered.append(msg), workers)
+            pipeline.use_key(Crypto.PublicKey.RSA.generate(1024))
+            session = {'key': session_key, 'last_counter': 0}
+            start = time.perf_counter()
+            for frame in frames:
+                pipeline.submit(frame, 0, session, lambda data, close: None)
+            while len(delivered) < len(frames) and pipeline.snapshot()['dropped'] == 0:
+                time.sleep(0.001)
+            elapsed = time.perf_counter() - start
+            stats = pipeline.snapshot()
+            print(f'burst, {pipeline.workers} workers: {stats["delivered"] / elapsed:8.1f} msg/s, max depth {stats["max_depth"]}, '
+                  f'per message reveal {stats["reveal"] / stats["delivered"] * 1000:.2f}ms, '
+                  f'decrypt {stats["decrypt"] / stats["delivered"] * 1000:.2f}ms, '
+                  f'queued {stats["queued"] / stats["delivered"] * 1000:.1f}ms')
+        exit(0)
+
     def status_call(user):
         print(f'[{hint}]Receive status {user.__dict__}')
     def add_call(user):
@@ -1,3 +1,9 @@
 server_ip = '10.21.181.124'
 server_port = 2057
 buf_len = 4096
+covert = False  # 伙伴消息是否一律藏进图片发送，协商会话密钥的握手同样藏进图片；关闭时双方都允许才发送原文
+key_type = 'rsa'  # 新生成的本机密钥类型，'rsa' 或 'ecc'，椭圆曲线密钥生成快得多，但旧版客户端无法向其发消息
+request_timeout = 10  # 单个服务器请求的超时（秒），超时后响应状态为 Timeout
+heartbeat_interval = 30  # 与服务器连接空闲多久后发送心跳（秒），心跳超时视为断线
+reconnect_base_delay = 0.5  # 断线重连的初始退避上限（秒），每次失败翻倍
+reconnect_max_delay = 30  # 断线重连退避上限的最大值（秒）
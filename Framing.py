@@ -0,0 +1,87 @@
+import json
+import re
+
+
+json_token = re.compile(rb'[{}\[\]"]')
+"""最外层扫描时关心的字节，多字节 UTF-8 字符的各字节都不在其中"""
+json_string_token = re.compile(rb'["\\]')
+"""字符串内扫描时关心的字节"""
+
+
+class JsonReader:
+    """从字节流中逐个取出首尾相接的 JSON 对象
+
+    服务器与客户端之间的消息是不加分隔的 JSON 对象。每次收到数据后接着上次停下的位置扫描，
+    每个字节只扫描一次，对象收全后才解析，大的消息分成许多块到达时也不会反复解码。
+    """
+
+    def __init__(self):
+        """初始化读取器"""
+        self.buffer = bytearray()
+        """已收到、尚未取出的字节"""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+
+    def feed(self, chunk: bytes) -> None:
+        """追加收到的字节"""
+        self.buffer += chunk
+
+    def next(self) -> dict | list | None:
+        """取出下一个完整的 JSON 对象
+
+        Raises:
+            ValueError: 最外层出现对象或数组以外的内容，或对象无法解析
+
+        Returns:
+            dict | list | None: 解析出的对象，尚未收全时为 None
+        """
+        end = self.__scan()
+        if end is None:
+            return None
+        message = json.loads(self.buffer[:end])
+        del self.buffer[:end]
+        return message
+
+    def __scan(self) -> int | None:
+        buffer = self.buffer
+        pos, depth, in_string = self.pos, self.depth, self.in_string
+        end = None
+        while end is None:
+            if in_string:
+                match = json_string_token.search(buffer, pos)
+                if match is None:
+                    pos = len(buffer)
+                    break
+                if match.group() == b'"':
+                    in_string = False
+                    pos = match.end()
+                elif match.end() < len(buffer):
+                    # Skip the escaped byte
+                    pos = match.end() + 1
+                else:
+                    # The escaped byte has not arrived yet
+                    pos = match.start()
+                    break
+                continue
+            match = json_token.search(buffer, pos)
+            stop = len(buffer) if match is None else match.start()
+            if depth == 0 and (buffer[pos:stop].strip() or match is not None and match.group() not in (b'{', b'[')):
+                raise ValueError('Expected a JSON object.')
+            if match is None:
+                pos = stop
+                break
+            pos = match.end()
+            if match.group() == b'"':
+                in_string = True
+            elif match.group() in (b'{', b'['):
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    end = pos
+        if end is None:
+            self.pos, self.depth, self.in_string = pos, depth, in_string
+        else:
+            self.pos, self.depth, self.in_string = 0, 0, False
+        return end
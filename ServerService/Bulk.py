@@ -0,0 +1,144 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections.abc import Iterable, Iterator
+from typing import TextIO
+
+from ServerService import Database, Storage
+
+
+fields = {
+    'user': ('email', 'username', 'pwdhash'),
+    'friend': ('email1', 'email2'),
+    'request': ('inviter', 'invitee', 'request_time'),
+}
+
+
+def read_records(fp: TextIO, fmt: str = 'jsonl') -> Iterator[tuple[str, tuple]]:
+    """逐行解析 JSONL 或 CSV 流
+
+    JSONL 每行形如 {"type": "user", "email": ..., "username": ..., "pwdhash": ...}；
+    CSV 每行第一列为类型，其余列按 `fields` 中的顺序排列。
+    """
+    if fmt == 'jsonl':
+        for line in fp:
+            if line.strip() == '':
+                continue
+            record = json.loads(line)
+            kind = record['type']
+            yield kind, tuple(record[field] for field in fields[kind])
+    else:
+        for row in csv.reader(fp):
+            if len(row) == 0:
+                continue
+            kind = row[0]
+            if kind == 'request':
+                yield kind, (row[1], row[2], float(row[3]))
+            else:
+                yield kind, tuple(row[1:len(fields[kind]) + 1])
+
+
+def write_records(records: Iterable[tuple[str, tuple]], fp: TextIO, fmt: str = 'jsonl') -> dict[str, int]:
+    """把记录流写成 JSONL 或 CSV
+
+    Returns:
+        dict[str, int]: 各类型写出的行数
+    """
+    counts = dict.fromkeys(fields, 0)
+    writer = csv.writer(fp) if fmt == 'csv' else None
+    for kind, row in records:
+        if writer is None:
+            record = {'type': kind}
+            record.update(zip(fields[kind], row))
+            fp.write(json.dumps(record) + '\n')
+        else:
+            writer.writerow((kind, *row))
+        counts[kind] += 1
+    return counts
+
+
+def dump(storage: Storage.Storage, fp: TextIO, fmt: str = 'jsonl') -> dict[str, int]:
+    """导出后端中的全部用户、好友与好友请求"""
+    return write_records(storage.export_records(), fp, fmt)
+
+
+def load(storage: Storage.Storage, fp: TextIO, fmt: str = 'jsonl', chunk_size: int = 50000,
+         defer_index: bool = False) -> dict[str, int]:
+    """把 JSONL 或 CSV 流导入后端，defer_index 见 `Storage.import_records`"""
+    return storage.import_records(read_records(fp, fmt), chunk_size, defer_index)
+
+
+def synthetic_records(n_users: int, n_friends: int = 20) -> Iterator[tuple[str, tuple]]:
+    """生成基准测试用的数据集，用户排成环，每人与其后 n_friends 个用户互为好友"""
+    n_friends = min(n_friends, (n_users - 1) // 2)
+    for i in range(n_users):
+        yield 'user', (f'user{i}@bench.domain', f'user{i}', f'{i:064x}')
+    for i in range(n_users):
+        for j in range(1, n_friends + 1):
+            yield 'friend', (f'user{i}@bench.domain', f'user{(i + j) % n_users}@bench.domain')
+
+
+def open_storage(args) -> Storage.Storage:
+    if args.shards:
+        storage = Storage.ShardedSQLiteStorage(args.shards)
+    else:
+        storage = Storage.SQLiteStorage(os.path.abspath(args.db))
+    storage.init()
+    return storage
+
+
+def guess_format(path: str, fmt: str | None) -> str:
+    if fmt is not None:
+        return fmt
+    return 'csv' if path.endswith('.csv') else 'jsonl'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk import/export of users and the friend graph')
+    parser.add_argument('--db', default='server.db', help='SQLite database path')
+    parser.add_argument('--shard', action='append', dest='shards', help='sharded SQLite database path, repeat once per shard; overrides --db')
+    parser.add_argument('--format', choices=('jsonl', 'csv'), default=None)
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('export').add_argument('path', help="output file, '-' for stdout")
+    sub_import = sub.add_parser('import')
+    sub_import.add_argument('path', help="input file, '-' for stdin")
+    sub_import.add_argument('--chunk-size', type=int, default=50000)
+    sub_import.add_argument('--offline', action='store_true', help='drop the indexes during the import, only with the server stopped')
+    sub_seed = sub.add_parser('seed')
+    sub_seed.add_argument('users', type=int)
+    sub_seed.add_argument('--friends', type=int, default=20)
+    sub_seed.add_argument('--offline', action='store_true', help='drop the indexes during the import, only with the server stopped')
+    sub.add_parser('vacuum', help='rewrite the database files with incremental auto-vacuum, run with the server stopped')
+    args = parser.parse_args()
+
+    if args.command == 'vacuum':
+        for db_path in args.shards or [args.db]:
+            start = time.perf_counter()
+            Database.vacuum(db_path)
+            print(f'vacuum: {db_path} in {time.perf_counter() - start:.2f}s', file=sys.stderr)
+        sys.exit(0)
+
+    # A database created by this run has no server reading it yet
+    defer_index = getattr(args, 'offline', False) or not any(os.path.exists(db_path) for db_path in args.shards or [args.db])
+    storage = open_storage(args)
+    start = time.perf_counter()
+    if args.command == 'export':
+        fmt = guess_format(args.path, args.format)
+        if args.path == '-':
+            counts = dump(storage, sys.stdout, fmt)
+        else:
+            with open(args.path, 'w', newline='', encoding='utf-8') as fp:
+                counts = dump(storage, fp, fmt)
+    elif args.command == 'import':
+        fmt = guess_format(args.path, args.format)
+        if args.path == '-':
+            counts = load(storage, sys.stdin, fmt, args.chunk_size, defer_index)
+        else:
+            with open(args.path, newline='', encoding='utf-8') as fp:
+                counts = load(storage, fp, fmt, args.chunk_size, defer_index)
+    else:
+        counts = storage.import_records(synthetic_records(args.users, args.friends), defer_index=defer_index)
+    print(f'{args.command}: {counts} in {time.perf_counter() - start:.2f}s', file=sys.stderr)
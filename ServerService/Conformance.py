@@ -0,0 +1,174 @@
+import io
+import os
+import sqlite3
+import tempfile
+import time
+
+from ServerService import Bulk, Storage
+
+
+def make_storages(tmp_dir: str) -> dict[str, Storage.Storage]:
+    """构造所有后端的新实例"""
+    storages = {
+        'sqlite': Storage.SQLiteStorage(os.path.join(tmp_dir, 'server.db')),
+        'memory': Storage.MemoryStorage(),
+        'sharded': Storage.ShardedSQLiteStorage([os.path.join(tmp_dir, f'server.{i}.db') for i in range(4)]),
+    }
+    for storage in storages.values():
+        storage.init()
+    return storages
+
+
+def check(storage: Storage.Storage) -> None:
+    """对一个空后端运行一致性检查，失败时抛出 AssertionError"""
+    users = [(f'user{i}@demo.domain', f'name{i}', f'{i:064d}') for i in range(8)]
+    for email, username, pwdhash in users:
+        storage.register(email, username, pwdhash)
+    storage.init()
+    assert storage.find_user(users[0][0]) == users[0][1]
+    assert storage.find_user('nobody@demo.domain') is None
+    assert storage.get_pwdhash(users[1][0]) == users[1][2]
+    assert storage.get_pwdhash('nobody@demo.domain') is None
+    try:
+        storage.register(*users[0])
+    except sqlite3.IntegrityError:
+        pass
+    else:
+        raise AssertionError('duplicate register accepted')
+
+    a, b, c, d = (user[0] for user in users[:4])
+    storage.add_friend(a, b)
+    storage.add_friend(c, a)
+    assert storage.judge_friend(a, b) and storage.judge_friend(b, a)
+    assert storage.judge_friend(a, c) and storage.judge_friend(c, a)
+    assert not storage.judge_friend(b, c)
+    assert sorted(storage.get_friend_list(a)) == [(b, 'name1'), (c, 'name2')]
+    assert storage.get_friend_list(b) == [(a, 'name0')]
+    assert storage.get_friend_list(d) == []
+    storage.del_friend(b, a)
+    assert not storage.judge_friend(a, b) and not storage.judge_friend(b, a)
+    assert storage.get_friend_list(a) == [(c, 'name2')]
+    assert storage.get_friend_list(b) == []
+
+    storage.raise_friend_request(b, d)
+    storage.raise_friend_request(b, d)
+    storage.raise_friend_request(c, d)
+    assert sorted(storage.get_friend_request(d)) == [(b, 'name1'), (c, 'name2')]
+    assert storage.get_friend_request(d) == []
+    assert storage.get_friend_request(a) == []
+
+    storage.raise_friend_request(a, d)
+    storage.raise_friend_request(b, d)
+    assert storage.expire_friend_requests(time.time() - 3600) == 0
+    assert storage.expire_friend_requests(time.time() + 1, batch_size=1) == 1
+    assert storage.expire_friend_requests(time.time() + 1) == 1
+    assert storage.get_friend_request(d) == []
+
+    e, f, g = (user[0] for user in users[4:7])
+    assert storage.find_users([a, e, 'nobody@demo.domain']) == {a: 'name0', e: 'name4'}
+    storage.add_friends([(e, f), (e, g)])
+    storage.add_friends([(e, f)])
+    assert sorted(storage.get_friend_list(e)) == [(f, 'name5'), (g, 'name6')]
+    assert storage.judge_friend(f, e) and storage.judge_friend(g, e)
+    storage.del_friends([(f, e), (e, g)])
+    assert storage.get_friend_list(e) == [] and storage.get_friend_list(g) == []
+    storage.raise_friend_requests(e, [f, g])
+    storage.raise_friend_requests(e, [f])
+    assert storage.get_friend_request(f) == [(e, 'name4')]
+    assert storage.get_friend_request(g) == [(e, 'name4')]
+    storage.optimize()
+
+
+def normalized(records) -> list[tuple[str, tuple]]:
+    """好友关系无方向，比较前统一为 (较小邮件地址, 较大邮件地址)"""
+    return sorted((kind, tuple(sorted(row)) if kind == 'friend' else tuple(row)) for kind, row in records)
+
+
+def check_bulk(storage: Storage.Storage, other: Storage.Storage) -> None:
+    """检查批量导入导出：导入 storage，经 JSONL 与 CSV 往返导入 other 后两者一致"""
+    records = list(Bulk.synthetic_records(50, 4))
+    records.append(('request', ('user0@bench.domain', 'user9@bench.domain', 1700000000.5)))
+    counts = storage.import_records(iter(records), chunk_size=64)
+    assert counts == {'user': 50, 'friend': 200, 'request': 1}, counts
+    assert storage.import_records(iter(records), defer_index=True)['user'] == 0
+    # The same friendships listed the other way round are not new
+    assert storage.import_records((kind, row[::-1]) for kind, row in records if kind == 'friend')['friend'] == 0
+    assert [email for email, _ in storage.get_friend_list('user0@bench.domain')] == sorted(
+        f'user{i}@bench.domain' for i in (1, 2, 3, 4, 46, 47, 48, 49))
+    exported = normalized(storage.export_records())
+    assert exported == normalized(records), 'export does not match import'
+    for fmt in ('jsonl', 'csv'):
+        fp = io.StringIO()
+        Bulk.dump(storage, fp, fmt)
+        fp.seek(0)
+        Bulk.load(other, fp, fmt)
+        assert normalized(other.export_records()) == exported, f'{fmt} round trip differs'
+    assert other.get_friend_request('user9@bench.domain') == [('user0@bench.domain', 'user0')]
+
+
+def bench(storage: Storage.Storage, n_users: int = 2000, n_friends: int = 20) -> dict[str, float]:
+    """在一个空后端上测量各操作的吞吐量
+
+    Returns:
+        dict[str, float]: 操作名到每秒操作数的映射
+    """
+    emails = [f'bench{i}@demo.domain' for i in range(n_users)]
+    result = {}
+
+    start = time.perf_counter()
+    for i, email in enumerate(emails):
+        storage.register(email, f'bench{i}', '0' * 64)
+    result['register'] = n_users / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for email in emails:
+        storage.find_user(email)
+    result['find_user'] = n_users / (time.perf_counter() - start)
+
+    pairs = [(emails[i], emails[(i + j) % n_users]) for i in range(0, n_users, n_friends) for j in range(1, n_friends + 1)]
+    start = time.perf_counter()
+    for email1, email2 in pairs:
+        storage.add_friend(email1, email2)
+    result['add_friend'] = len(pairs) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for email in emails:
+        storage.get_friend_list(email)
+    result['get_friend_list'] = n_users / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for email1, email2 in pairs:
+        storage.judge_friend(email1, email2)
+    result['judge_friend'] = len(pairs) / (time.perf_counter() - start)
+
+    records = list(Bulk.synthetic_records(n_users * 10, n_friends))
+    start = time.perf_counter()
+    storage.import_records(iter(records))
+    result['import_records'] = len(records) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in storage.export_records():
+        pass
+    result['export_records'] = len(records) / (time.perf_counter() - start)
+    return result
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, storage in make_storages(tmp_dir).items():
+            check(storage)
+            os.mkdir(os.path.join(tmp_dir, name))
+            for path in storage.backup(os.path.join(tmp_dir, name)):
+                assert Storage.SQLiteStorage(path).find_user('user0@demo.domain') in ('name0', None)
+            print(f'{name}: conformance passed')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.mkdir(os.path.join(tmp_dir, 'a'))
+        os.mkdir(os.path.join(tmp_dir, 'b'))
+        pairs = zip(make_storages(os.path.join(tmp_dir, 'a')).items(), make_storages(os.path.join(tmp_dir, 'b')).values())
+        for (name, storage), other in pairs:
+            check_bulk(storage, other)
+            print(f'{name}: bulk conformance passed')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, storage in make_storages(tmp_dir).items():
+            result = bench(storage)
+            print(f'{name.ljust(8)} ' + ' '.join(f'{op}={ops:.0f}/s' for op, ops in result.items()))
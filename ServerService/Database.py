@@ -1,17 +1,36 @@
+import os
 import sqlite3
 import time
+from collections import Counter
+from collections.abc import Iterable, Iterator
 from threading import Lock
 
 
 db_lock = Lock()
+record_sql = {
+    'user': 'INSERT OR IGNORE INTO UserTable VALUES (?, ?, ?)',
+    # One directed row per friendship, an edge whose reverse is already stored is skipped
+    'friend': 'INSERT OR IGNORE INTO FriendTable SELECT ?1, ?2 '
+              'WHERE NOT EXISTS (SELECT 1 FROM FriendTable WHERE email1 = ?2 AND email2 = ?1)',
+    'request': 'INSERT OR IGNORE INTO FriendRequest VALUES (?, ?, ?)',
+}
+# Sharded files keep both directed rows of every friendship
+directed_record_sql = dict(record_sql, friend='INSERT OR IGNORE INTO FriendTable VALUES (?, ?)')
+index_sql = {
+    'FriendTable_email2': 'CREATE INDEX IF NOT EXISTS FriendTable_email2 ON FriendTable(email2)',
+    'FriendRequest_invitee': 'CREATE INDEX IF NOT EXISTS FriendRequest_invitee ON FriendRequest(invitee)',
+    'FriendRequest_time': 'CREATE INDEX IF NOT EXISTS FriendRequest_time ON FriendRequest(request_time)',
+}
 
 
 def init(db_path):
     with db_lock:
         with sqlite3.connect(db_path) as db_conn:
+            # Only takes effect on a new file, older files are converted offline by vacuum()
+            db_conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
             db_conn.execute(
                 """
-                CREATE TABLE UserTable (
+                CREATE TABLE IF NOT EXISTS UserTable (
                     email       VARCHAR(64) PRIMARY KEY,
                     username    VARCHAR(32) NOT NULL,
                     pwdhash     CHAR(64)    NOT NULL
@@ -20,7 +39,7 @@ def init(db_path):
             )
             db_conn.execute(
                 """
-                CREATE TABLE FriendTable (
+                CREATE TABLE IF NOT EXISTS FriendTable (
                     email1 VARCHAR(64),
                     email2 VARCHAR(64),
                     FOREIGN KEY (email1) REFERENCES UserTable(email)
@@ -35,7 +54,7 @@ def init(db_path):
             )
             db_conn.execute(
                 """
-                CREATE TABLE FriendRequest (
+                CREATE TABLE IF NOT EXISTS FriendRequest (
                     inviter         VARCHAR(64),
                     invitee         VARCHAR(64),
                     request_time    FLOAT   NOT NULL,
@@ -49,6 +68,10 @@ def init(db_path):
                 )
                 """
             )
+            for sql in index_sql.values():
+                db_conn.execute(sql)
+            # WAL lets bulk exports and backups read while the server writes
+            db_conn.execute('PRAGMA journal_mode = WAL')
 
 
 def find_user(db_path, email) -> str | None:
@@ -205,3 +228,161 @@ def del_friend(db_path, user, friend):
                 """
             )
             db_conn.commit()
+
+
+def find_users(db_path, emails: list[str]) -> dict[str, str]:
+    usernames = {}
+    with db_lock:
+        with sqlite3.connect(db_path) as db_conn:
+            for start in range(0, len(emails), 500):
+                chunk = emails[start:start + 500]
+                marks = ', '.join('?' * len(chunk))
+                usernames.update(db_conn.execute(f'SELECT email, username FROM UserTable WHERE email IN ({marks})', chunk))
+    return usernames
+
+
+def raise_friend_requests(db_path, inviter, invitees: list[str]):
+    request_time = time.time()
+    with db_lock:
+        with sqlite3.connect(db_path) as db_conn:
+            db_conn.executemany(record_sql['request'], [(inviter, invitee, request_time) for invitee in invitees])
+            db_conn.commit()
+
+
+def add_friends(db_path, pairs: list[tuple[str, str]]):
+    with db_lock:
+        with sqlite3.connect(db_path) as db_conn:
+            db_conn.executemany(record_sql['friend'], pairs)
+            db_conn.commit()
+
+
+def del_friends(db_path, pairs: list[tuple[str, str]]):
+    with db_lock:
+        with sqlite3.connect(db_path) as db_conn:
+            db_conn.executemany(
+                'DELETE FROM FriendTable WHERE email1 = ? AND email2 = ? OR email1 = ? AND email2 = ?',
+                [(user, friend, friend, user) for user, friend in pairs])
+            db_conn.commit()
+
+
+def write_records(db_conn, buffers: dict[str, list[tuple]], sql: dict[str, str] = record_sql) -> dict[str, int]:
+    counts = {}
+    for kind, rows in buffers.items():
+        if len(rows) == 0:
+            continue
+        counts[kind] = db_conn.executemany(sql[kind], rows).rowcount
+        rows.clear()
+    db_conn.commit()
+    return counts
+
+
+def drop_indexes(db_conn):
+    for name in index_sql:
+        db_conn.execute(f'DROP INDEX IF EXISTS {name}')
+    db_conn.commit()
+
+
+def create_indexes(db_conn):
+    for sql in index_sql.values():
+        db_conn.execute(sql)
+    db_conn.commit()
+
+
+def import_records(db_path, records: Iterable[tuple[str, tuple]],
+                   chunk_size: int = 50000, defer_index: bool = False) -> dict[str, int]:
+    counts = Counter(dict.fromkeys(record_sql, 0))
+    buffers = {kind: [] for kind in record_sql}
+    db_conn = sqlite3.connect(db_path)
+    db_conn.execute('PRAGMA synchronous = NORMAL')
+    try:
+        if defer_index:
+            with db_lock:
+                drop_indexes(db_conn)
+        pending = 0
+        for kind, row in records:
+            buffers[kind].append(row)
+            pending += 1
+            if pending >= chunk_size:
+                with db_lock:
+                    counts.update(write_records(db_conn, buffers))
+                pending = 0
+        with db_lock:
+            counts.update(write_records(db_conn, buffers))
+    finally:
+        if defer_index:
+            with db_lock:
+                create_indexes(db_conn)
+        db_conn.close()
+    return dict(counts)
+
+
+def export_records(db_path) -> Iterator[tuple[str, tuple]]:
+    db_conn = sqlite3.connect(db_path)
+    try:
+        # One read transaction keeps the three tables consistent without db_lock
+        db_conn.execute('BEGIN')
+        for row in db_conn.execute('SELECT email, username, pwdhash FROM UserTable'):
+            yield 'user', row
+        for row in db_conn.execute('SELECT email1, email2 FROM FriendTable'):
+            yield 'friend', row
+        for row in db_conn.execute('SELECT inviter, invitee, request_time FROM FriendRequest'):
+            yield 'request', row
+        db_conn.rollback()
+    finally:
+        db_conn.close()
+
+
+def expire_friend_requests(db_path, before: float, batch_size: int = 500) -> int:
+    with db_lock:
+        with sqlite3.connect(db_path) as db_conn:
+            cursor = db_conn.execute(
+                """
+                DELETE FROM FriendRequest
+                WHERE rowid IN (
+                    SELECT rowid FROM FriendRequest
+                    WHERE request_time < ?
+                    LIMIT ?
+                )
+                """,
+                (before, batch_size)
+            )
+            db_conn.commit()
+            return cursor.rowcount
+
+
+def optimize(db_path, vacuum_pages: int = 1000):
+    # Runs on its own connection without db_lock; SQLite's busy timeout handles contention
+    db_conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        # A full VACUUM would lock out writers for the whole rewrite, only free pages incrementally
+        if db_conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            db_conn.execute(f'PRAGMA incremental_vacuum({int(vacuum_pages)})').fetchall()
+        db_conn.execute('ANALYZE')
+        db_conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        db_conn.commit()
+    finally:
+        db_conn.close()
+
+
+def vacuum(db_path):
+    # Offline only: rewrites the whole file to switch it to incremental auto-vacuum
+    db_conn = sqlite3.connect(db_path)
+    try:
+        db_conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        db_conn.execute('VACUUM')
+    finally:
+        db_conn.close()
+
+
+def backup(db_path, dest_dir, pages: int = 256, sleep: float = 0.01) -> str:
+    stem = os.path.splitext(os.path.basename(db_path))[0]
+    dest_path = os.path.join(dest_dir, f'{stem}.{time.strftime("%Y%m%d-%H%M%S")}.db')
+    src_conn = sqlite3.connect(db_path, timeout=30)
+    dest_conn = sqlite3.connect(dest_path)
+    try:
+        # Copies a few pages at a time so writers only wait for one step
+        src_conn.backup(dest_conn, pages=pages, sleep=sleep)
+    finally:
+        dest_conn.close()
+        src_conn.close()
+    return dest_path
@@ -0,0 +1,75 @@
+import secrets
+from collections import deque
+from threading import Lock
+
+
+class FriendLog:
+    """好友列表版本号与变更历史
+
+    版本号形如 `<epoch>.<n>`，epoch 在服务器每次启动时重新生成，
+    因此重启前的版本号一律视为过旧，回退到全量列表。
+    """
+
+    def __init__(self, history_len: int = 256):
+        """初始化变更历史
+
+        Args:
+            history_len (int): 每个用户保留的变更条数，更早的版本只能全量同步
+        """
+        self.lock = Lock()
+        self.epoch = secrets.token_hex(4)
+        self.history_len = history_len
+        self.versions: dict[str, int] = {}
+        self.history: dict[str, deque[tuple[int, str, str, str | None]]] = {}
+
+    def record(self, email: str, op: str, friend_email: str, username: str | None = None) -> None:
+        """记录 email 的好友列表的一次变更
+
+        Args:
+            email (str): 好友列表所属用户
+            op (str): 'add'、'remove' 或 'rename'
+            friend_email (str): 变更的好友
+            username (str | None): 好友用户名，'remove' 时为 None
+        """
+        with self.lock:
+            version = self.versions.get(email, 0) + 1
+            self.versions[email] = version
+            history = self.history.setdefault(email, deque(maxlen=self.history_len))
+            history.append((version, op, friend_email, username))
+
+    def delta(self, email: str, since: str | None) -> tuple[str, dict | None]:
+        """计算自 since 以来的净变更
+
+        Args:
+            email (str): 好友列表所属用户
+            since (str | None): 客户端持有的版本号
+
+        Returns:
+            tuple[str, dict | None]: 当前版本号，以及含 added、removed、renamed 的净变更；
+                since 无效或过旧时为 None，需要全量同步
+        """
+        with self.lock:
+            version = self.versions.get(email, 0)
+            current = f'{self.epoch}.{version}'
+            if since is None:
+                return current, None
+            epoch, _, since_version = since.partition('.')
+            if epoch != self.epoch or not since_version.isdigit() or int(since_version) > version:
+                return current, None
+            since_version = int(since_version)
+            history = self.history.get(email, ())
+            if version - since_version > len(history):
+                return current, None
+            final: dict[str, tuple[str, str | None]] = {}
+            for entry_version, op, friend_email, username in history:
+                if entry_version > since_version:
+                    final[friend_email] = (op, username)
+        delta = {'added': {}, 'removed': [], 'renamed': {}}
+        for friend_email, (op, username) in final.items():
+            if op == 'add':
+                delta['added'][friend_email] = username
+            elif op == 'remove':
+                delta['removed'].append(friend_email)
+            else:
+                delta['renamed'][friend_email] = username
+        return current, delta
@@ -0,0 +1,90 @@
+import hashlib
+import sqlite3
+from threading import Lock
+
+
+def fingerprint(public_key: str) -> str:
+    """公钥指纹，即 PEM 文本（去掉首尾空白）的 SHA-256"""
+    return hashlib.sha256(public_key.strip().encode('utf-8')).hexdigest()
+
+
+class KeyDirectory:
+    """公钥目录，按指纹保存公钥并记录每个用户当前使用的指纹
+
+    全部内容常驻内存，写入时同步落盘到独立的 SQLite 文件，服务器重启后重新载入。
+    """
+
+    def __init__(self, db_path: str):
+        """初始化公钥目录
+
+        Args:
+            db_path (str): 数据库文件路径
+        """
+        self.db_path = db_path
+        self.lock = Lock()
+        self.keys: dict[str, str] = {}
+        """指纹到 PEM 公钥"""
+        self.fingerprints: dict[str, str] = {}
+        """邮件地址到当前指纹"""
+
+    def init(self) -> None:
+        """建表并载入全部公钥"""
+        with self.lock:
+            with sqlite3.connect(self.db_path) as db_conn:
+                db_conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS PublicKey (
+                        fingerprint CHAR(64)    PRIMARY KEY,
+                        public_key  TEXT        NOT NULL
+                    )
+                    """
+                )
+                db_conn.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS UserKey (
+                        email       VARCHAR(64) PRIMARY KEY,
+                        fingerprint CHAR(64)    NOT NULL
+                    )
+                    """
+                )
+                db_conn.execute('CREATE INDEX IF NOT EXISTS UserKey_fingerprint ON UserKey (fingerprint)')
+                # Keys replaced before pruning existed
+                db_conn.execute('DELETE FROM PublicKey WHERE fingerprint NOT IN (SELECT fingerprint FROM UserKey)')
+                db_conn.commit()
+                self.keys = dict(db_conn.execute('SELECT fingerprint, public_key FROM PublicKey'))
+                self.fingerprints = dict(db_conn.execute('SELECT email, fingerprint FROM UserKey'))
+
+    def put(self, email: str, public_key: str) -> str:
+        """登记 email 当前使用的公钥，被替换的旧公钥不再有人使用时一并删除
+
+        Returns:
+            str: 公钥指纹
+        """
+        key_fingerprint = fingerprint(public_key)
+        with self.lock:
+            old_fingerprint = self.fingerprints.get(email, None)
+            if old_fingerprint == key_fingerprint:
+                return key_fingerprint
+            with sqlite3.connect(self.db_path) as db_conn:
+                db_conn.execute('INSERT OR IGNORE INTO PublicKey VALUES (?, ?)', (key_fingerprint, public_key))
+                db_conn.execute('INSERT OR REPLACE INTO UserKey VALUES (?, ?)', (email, key_fingerprint))
+                pruned = db_conn.execute('DELETE FROM PublicKey WHERE fingerprint = ?1 AND NOT EXISTS '
+                                         '(SELECT 1 FROM UserKey WHERE fingerprint = ?1)', (old_fingerprint,)).rowcount
+                db_conn.commit()
+            self.keys[key_fingerprint] = public_key
+            self.fingerprints[email] = key_fingerprint
+            if pruned > 0:
+                del self.keys[old_fingerprint]
+        return key_fingerprint
+
+    def get(self, email: str) -> tuple[str, str] | None:
+        """获取 email 当前使用的公钥
+
+        Returns:
+            tuple[str, str] | None: (指纹, PEM 公钥)，未登记时为 None
+        """
+        with self.lock:
+            key_fingerprint = self.fingerprints.get(email, None)
+            if key_fingerprint is None:
+                return None
+            return key_fingerprint, self.keys[key_fingerprint]
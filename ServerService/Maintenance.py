@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+
+from ServerService import Storage, Survival
+
+
+class Maintainer:
+    """后台维护任务：分批清理过期好友请求，低峰期压缩数据库、更新统计信息并在线备份
+
+    每批删除只短暂持有存储锁，压缩与备份使用独立连接，不占用存储锁。
+    """
+
+    def __init__(self,
+                 storage: Storage.Storage,
+                 request_age: float = Survival.FriendRequest,
+                 batch_size: int = 500,
+                 batch_pause: float = 0.05,
+                 interval: float = 600,
+                 off_peak: tuple[int, int] = (3, 5),
+                 backup_dir: str | None = None,
+                 keep_backups: int = 7):
+        """初始化维护任务
+
+        Args:
+            storage (Storage.Storage): 存储后端
+            request_age (float): 好友请求的有效期（秒）
+            batch_size (int): 每批删除的好友请求数
+            batch_pause (float): 两批之间让出的时间（秒）
+            interval (float): 两轮维护之间的间隔（秒）
+            off_peak (tuple[int, int]): 低峰期的起止小时（本地时间，左闭右开）
+            backup_dir (str | None): 备份目录，为 None 时不备份
+            keep_backups (int): 每个数据库文件保留的最近备份份数
+        """
+        self.storage = storage
+        self.request_age = request_age
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.interval = interval
+        self.off_peak = off_peak
+        self.backup_dir = backup_dir
+        self.keep_backups = keep_backups
+        self.last_compaction = None
+        """上一次压缩的日期"""
+        self.__stop = threading.Event()
+
+    def expire_friend_requests(self) -> int:
+        """删除全部过期好友请求
+
+        Returns:
+            int: 删除的行数
+        """
+        before = time.time() - self.request_age
+        total = 0
+        while not self.__stop.is_set():
+            count = self.storage.expire_friend_requests(before, self.batch_size)
+            total += count
+            if count < self.batch_size:
+                break
+            self.__stop.wait(self.batch_pause)
+        return total
+
+    def is_off_peak(self, now: time.struct_time) -> bool:
+        start, end = self.off_peak
+        if start <= end:
+            return start <= now.tm_hour < end
+        return now.tm_hour >= start or now.tm_hour < end
+
+    def compact(self) -> None:
+        """压缩数据库、更新统计信息并备份"""
+        self.storage.optimize()
+        if self.backup_dir is not None:
+            for path in self.storage.backup(self.backup_dir):
+                print(f'\033[34mMaintenance\033[0m Backup written: {path}')
+                self.prune_backups(path)
+
+    def prune_backups(self, latest: str) -> list[str]:
+        """删除与 latest 同一数据库文件的旧备份，只保留最近 keep_backups 份
+
+        Args:
+            latest (str): 刚写出的备份路径，形如 `<文件名>.<日期-时间>.db`
+
+        Returns:
+            list[str]: 删除的备份路径
+        """
+        stem = os.path.basename(latest).rsplit('.', 2)[0]
+        # The timestamp sorts the same as the time it was taken
+        backups = sorted(name for name in os.listdir(self.backup_dir)
+                         if name.endswith('.db') and name.rsplit('.', 2)[0] == stem)
+        removed = [os.path.join(self.backup_dir, name) for name in backups[:max(len(backups) - self.keep_backups, 0)]]
+        for path in removed:
+            os.remove(path)
+            print(f'\033[34mMaintenance\033[0m Backup removed: {path}')
+        return removed
+
+    def run_once(self) -> None:
+        """执行一轮维护"""
+        expired = self.expire_friend_requests()
+        if expired > 0:
+            print(f'\033[34mMaintenance\033[0m Expired {expired} friend requests')
+        now = time.localtime()
+        today = time.strftime('%Y-%m-%d', now)
+        if self.is_off_peak(now) and self.last_compaction != today:
+            self.compact()
+            self.last_compaction = today
+
+    def __loop(self) -> None:
+        while not self.__stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f'\033[31mMaintenance\033[0m {e!r}')
+            self.__stop.wait(self.interval)
+
+    def run(self) -> None:
+        """启动后台维护线程"""
+        maintain_thread = threading.Thread(target=self.__loop)
+        maintain_thread.daemon = True
+        maintain_thread.start()
+
+    def stop(self) -> None:
+        """停止后台维护线程"""
+        self.__stop.set()
@@ -0,0 +1,57 @@
+from collections.abc import Iterable
+from threading import Lock
+
+
+class PresenceIndex:
+    """在线状态订阅的反向索引
+
+    watchers 记录每个用户被哪些在线用户订阅，状态变化时直接取出推送对象，
+    不必再读好友列表；watching 是正向索引，用于下线时一次撤销全部订阅。
+    """
+
+    def __init__(self):
+        """初始化订阅索引"""
+        self.lock = Lock()
+        self.watchers: dict[str, set[str]] = {}
+        """被订阅者到订阅者集合"""
+        self.watching: dict[str, set[str]] = {}
+        """订阅者到被订阅者集合"""
+
+    def subscribe(self, watcher: str, targets: Iterable[str]) -> None:
+        """watcher 订阅 targets 的在线状态"""
+        with self.lock:
+            watching = self.watching.setdefault(watcher, set())
+            for target in targets:
+                if target == watcher:
+                    continue
+                watching.add(target)
+                self.watchers.setdefault(target, set()).add(watcher)
+
+    def unsubscribe(self, watcher: str, targets: Iterable[str]) -> None:
+        """watcher 取消订阅 targets 的在线状态"""
+        with self.lock:
+            watching = self.watching.get(watcher, set())
+            for target in targets:
+                watching.discard(target)
+                watchers = self.watchers.get(target, None)
+                if watchers is None:
+                    continue
+                watchers.discard(watcher)
+                if len(watchers) == 0:
+                    del self.watchers[target]
+
+    def drop(self, watcher: str) -> None:
+        """撤销 watcher 的全部订阅，在其下线时调用"""
+        with self.lock:
+            for target in self.watching.pop(watcher, ()):
+                watchers = self.watchers.get(target, None)
+                if watchers is None:
+                    continue
+                watchers.discard(watcher)
+                if len(watchers) == 0:
+                    del self.watchers[target]
+
+    def watchers_of(self, target: str) -> list[str]:
+        """订阅了 target 的用户"""
+        with self.lock:
+            return list(self.watchers.get(target, ()))
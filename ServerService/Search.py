@@ -0,0 +1,246 @@
+import bisect
+import random
+import time
+from collections import Counter
+from collections.abc import Iterable, Iterator
+from threading import Lock
+
+
+class UserIndex:
+    """用户搜索索引，支持按邮件地址与用户名的前缀匹配及容错匹配
+
+    前缀匹配在有序键表上二分查找。查询长度不少于 4 时容许 1 处错误：首字符处的编辑
+    在去掉首字符的有序键表上做前缀查找，其余位置枚举单处编辑再逐个做前缀查找，每个位置
+    只试键表中该前缀之后实际出现的字符；不少于 8 时容许 2 处，仅在没有其他结果时用三元组
+    倒排表找候选，再用前缀编辑距离校验。新加入的键先放进小的有序表，攒够后再并入主表；
+    有序表都只整体替换，查询在锁内取快照后在锁外匹配，不阻塞注册。
+    """
+
+    def __init__(self, common_ratio: float = 0.05, merge_size: int = 1024):
+        """初始化搜索索引
+
+        Args:
+            common_ratio (float): 出现在超过这一比例的键中的三元组不用于找候选
+            merge_size (int): 新加入的键攒到多少个时并入主表
+        """
+        self.lock = Lock()
+        self.common_ratio = common_ratio
+        self.merge_size = merge_size
+        self.usernames: dict[str, str] = {}
+        self.runs: tuple[tuple[list[str], list], ...] = (([], []), ([], []))
+        """(有序键表, 对应的邮件地址) 的主表与新键表，只整体替换，不原地修改"""
+        self.tail_runs: tuple[tuple[list[str], list], ...] = (([], []), ([], []))
+        """(去掉首字符的有序键表, 对应的 (键, 邮件地址))，同样分主表与新键表"""
+        self.entries: list[tuple[str, str]] = []
+        """(键, 邮件地址)，下标即倒排表中的编号，只在末尾追加"""
+        self.postings: dict[str, list[int]] = {}
+
+    @staticmethod
+    def trigrams(key: str) -> list[str]:
+        # Only the start is padded since queries are prefixes
+        padded = '\x02\x02' + key
+        return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+    def __insert(self, runs, key: str, value) -> tuple[tuple[list[str], list], ...]:
+        (keys, values), (recent_keys, recent_values) = runs
+        index = bisect.bisect_right(recent_keys, key)
+        # Searches running outside the lock keep reading the old lists
+        recent = (recent_keys[:index] + [key] + recent_keys[index:], recent_values[:index] + [value] + recent_values[index:])
+        if len(recent[0]) < self.merge_size:
+            return (keys, values), recent
+        merged = sorted(zip(keys + recent[0], values + recent[1]))
+        return ([key for key, _ in merged], [value for _, value in merged]), ([], [])
+
+    def __add_key(self, key: str, email: str) -> None:
+        self.runs = self.__insert(self.runs, key, email)
+        self.tail_runs = self.__insert(self.tail_runs, key[1:], (key, email))
+        entry_id = len(self.entries)
+        self.entries.append((key, email))
+        for trigram in set(self.trigrams(key)):
+            self.postings.setdefault(trigram, []).append(entry_id)
+
+    def add(self, email: str, username: str) -> None:
+        """加入一个用户"""
+        with self.lock:
+            if email in self.usernames:
+                return
+            self.usernames[email] = username
+            self.__add_key(email.lower(), email)
+            if username.lower() != email.lower():
+                self.__add_key(username.lower(), email)
+
+    def rebuild(self, users: Iterable[tuple[str, str]]) -> None:
+        """从 (邮件地址, 用户名) 流全量重建索引"""
+        entries = []
+        usernames = {}
+        for email, username in users:
+            if email in usernames:
+                continue
+            usernames[email] = username
+            entries.append((email.lower(), email))
+            if username.lower() != email.lower():
+                entries.append((username.lower(), email))
+        postings: dict[str, list[int]] = {}
+        for entry_id, (key, _) in enumerate(entries):
+            for trigram in set(self.trigrams(key)):
+                postings.setdefault(trigram, []).append(entry_id)
+        ordered = sorted(entries)
+        tails = [(key[1:], (key, email)) for key, email in ordered]
+        # Stable on the ordered entries, so ties on the tail stay in key order without comparing tuples
+        tails.sort(key=lambda tail: tail[0])
+        with self.lock:
+            self.usernames = usernames
+            self.entries = entries
+            self.postings = postings
+            self.runs = (([key for key, _ in ordered], [email for _, email in ordered]), ([], []))
+            self.tail_runs = (([tail for tail, _ in tails], [entry for _, entry in tails]), ([], []))
+
+    @staticmethod
+    def prefix_distance(query: str, key: str, max_distance: int) -> int:
+        """query 与 key 的某个前缀之间的最小编辑距离，超过 max_distance 时返回 max_distance + 1"""
+        row = list(range(len(key) + 1))
+        for i, char in enumerate(query, 1):
+            previous, row = row, [i]
+            for j in range(1, len(key) + 1):
+                row.append(min(previous[j] + 1, row[j - 1] + 1, previous[j - 1] + (key[j - 1] != char)))
+            if min(row) > max_distance:
+                return max_distance + 1
+        return min(row)
+
+    @staticmethod
+    def prefixed(runs, prefix: str, limit: int | None = None) -> list[tuple[str, str]]:
+        """各有序键表中以 prefix 开头的前 limit 个 (键, 对应的值)，按键排序，limit 为 None 时不限"""
+        found = []
+        for keys, values in runs:
+            start = bisect.bisect_left(keys, prefix)
+            end = bisect.bisect_left(keys, prefix + '\U0010ffff', start)
+            if limit is not None:
+                end = min(end, start + limit)
+            found += zip(keys[start:end], values[start:end])
+        found.sort()
+        return found if limit is None else found[:limit]
+
+    @staticmethod
+    def next_chars(runs, prefix: str) -> set[str]:
+        """各有序键表中以 prefix 开头的键在 prefix 之后出现的字符，每个字符一次二分查找"""
+        chars = set()
+        for keys, _ in runs:
+            start = bisect.bisect_left(keys, prefix)
+            end = bisect.bisect_left(keys, prefix + '\U0010ffff', start)
+            while start < end:
+                key = keys[start]
+                if len(key) == len(prefix):
+                    start += 1
+                    continue
+                char = key[len(prefix)]
+                chars.add(char)
+                start = bisect.bisect_left(keys, prefix + char + '\U0010ffff', start, end)
+        return chars
+
+    def __one_edit(self, runs, tail_runs, query: str, limit: int) -> list[tuple[int, str, str]]:
+        # A key is within one edit of the query iff it starts with one of these variants,
+        # and a substitution or insertion at i can only match with a character that follows query[:i] in some key
+        variants = {query[1:]}
+        matches = set()
+        # Any character may come first, so a substituted or inserted first character is found on the tails instead
+        for tail in (query[1:], query):
+            for _, (key, email) in self.prefixed(tail_runs, tail):
+                if not key.startswith(query):
+                    matches.add((1, key, email))
+        for i in range(1, len(query)):
+            variants.add(query[:i] + query[i + 1:])
+            for char in self.next_chars(runs, query[:i]):
+                variants.add(query[:i] + char + query[i + 1:])
+                variants.add(query[:i] + char + query[i:])
+        variants.discard(query)
+        for variant in variants:
+            for key, email in self.prefixed(runs, variant, limit):
+                if not key.startswith(query):
+                    matches.add((1, key, email))
+        return sorted(matches)[:limit]
+
+    def __two_edits(self, entries: list[tuple[str, str]], postings: dict[str, list[int]],
+                    query: str, limit: int) -> list[tuple[int, str, str]]:
+        limit_common = max(1, int(len(entries) * self.common_ratio))
+        trigrams = [trigram for trigram in set(self.trigrams(query))
+                    if len(postings.get(trigram, ())) <= limit_common]
+        # Each edit destroys at most 3 trigrams of the query
+        need = len(trigrams) - 6
+        if need < 1:
+            return []
+        hits = Counter()
+        for trigram in trigrams:
+            hits.update(postings.get(trigram, ()))
+        matches = []
+        for entry_id, count in hits.items():
+            if count < need:
+                continue
+            key, email = entries[entry_id]
+            distance = self.prefix_distance(query, key[:len(query) + 2], 2)
+            if 0 < distance <= 2:
+                matches.append((distance, key, email))
+        matches.sort()
+        return matches[:limit]
+
+    def search(self, query: str, offset: int = 0, limit: int = 20) -> tuple[list[tuple[str, str]], bool]:
+        """搜索用户，前缀匹配排在容错匹配之前
+
+        Args:
+            query (str): 邮件地址或用户名的前缀
+            offset (int): 跳过的结果数
+            limit (int): 本页最多返回的结果数
+
+        Returns:
+            tuple[list[tuple[str, str]], bool]: (邮件地址, 用户名) 列表，以及是否还有下一页
+        """
+        query = query.strip().lower()
+        if query == '':
+            return [], False
+        want = offset + limit + 1
+        with self.lock:
+            # Entries and postings only grow, an entry is appended before its ids are posted
+            runs, tail_runs = self.runs, self.tail_runs
+            usernames, entries, postings = self.usernames, self.entries, self.postings
+        # Usernames and emails of one user may both match, so over-fetch by a factor of two
+        matches = [(0, key, email) for key, email in self.prefixed(runs, query, 2 * want)]
+        if len(matches) < 2 * want and len(query) >= 4:
+            matches += self.__one_edit(runs, tail_runs, query, 2 * want)
+        # Two edits are only a fallback since candidate generation is far more expensive
+        if len(matches) == 0 and len(query) >= 8:
+            matches += self.__two_edits(entries, postings, query, 2 * want)
+        emails: dict[str, None] = {}
+        for _, _, email in matches:
+            emails.setdefault(email, None)
+        found = [(email, usernames[email]) for email in emails]
+        return found[offset:offset + limit], len(found) > offset + limit
+
+
+if __name__ == '__main__':
+    rand = random.Random(0)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    domains = ['qq.com', 'bupt.edu.cn', '163.com', 'gmail.com']
+    users = []
+    for i in range(500000):
+        name = ''.join(rand.choice(letters) for _ in range(rand.randint(4, 10)))
+        users.append((f'{name}{i}@{rand.choice(domains)}', name.capitalize()))
+    index = UserIndex()
+    start = time.perf_counter()
+    index.rebuild(users)
+    print(f'rebuild: {len(users)} users in {time.perf_counter() - start:.2f}s')
+    start = time.perf_counter()
+    index.add('newcomer@qq.com', 'Newcomer')
+    print(f'add: {(time.perf_counter() - start) * 1000:.3f}ms')
+
+    email, username = users[12345]
+    queries = [email[:n] for n in range(1, len(email) + 1)]
+    typo = email[:2] + ('x' if email[2] != 'x' else 'y') + email[3:10]
+    queries += [typo, username.lower()[:4]]
+    worst = 0
+    for query in queries:
+        start = time.perf_counter()
+        found, more = index.search(query)
+        worst = max(worst, time.perf_counter() - start)
+    print(f'keystroke queries: worst {worst * 1000:.2f}ms over {len(queries)} prefixes')
+    found, _ = index.search(typo)
+    print(f'typo {typo!r} -> {found[:3]}')
+    assert (email, username) in found
@@ -0,0 +1,106 @@
+import secrets
+import threading
+from collections.abc import Callable
+
+from ServerService import Survival
+
+
+class SessionTable:
+    """会话恢复令牌
+
+    登录时发放令牌。连接意外断开后会话进入宽限期，期间用户仍视为在线；
+    客户端在宽限期内凭令牌重连即可接回原会话，不会向好友广播下线再上线。
+    每次恢复都换发新令牌，旧令牌立即失效。
+    """
+
+    def __init__(self, grace: float = Survival.Session):
+        """初始化会话表
+
+        Args:
+            grace (float): 断线后保留会话的时间（秒）
+        """
+        self.lock = threading.Lock()
+        self.grace = grace
+        self.tokens: dict[str, str] = {}
+        """令牌到邮件地址"""
+        self.current: dict[str, str] = {}
+        """邮件地址到当前令牌"""
+        self.pending: dict[str, threading.Timer] = {}
+        """处于宽限期的会话，到期时执行下线"""
+
+    def __cancel(self, email: str) -> bool:
+        timer = self.pending.pop(email, None)
+        if timer is None:
+            return False
+        timer.cancel()
+        return True
+
+    def __rotate(self, email: str) -> str:
+        self.tokens.pop(self.current.get(email, None), None)
+        token = secrets.token_urlsafe(24)
+        self.tokens[token] = email
+        self.current[email] = token
+        return token
+
+    def issue(self, email: str) -> str:
+        """登录成功后发放令牌，同一用户之前的令牌作废"""
+        with self.lock:
+            self.__cancel(email)
+            return self.__rotate(email)
+
+    def take_over(self, email: str) -> bool:
+        """处于宽限期的会话被重新登录接管时取消下线
+
+        Returns:
+            bool: 会话是否处于宽限期
+        """
+        with self.lock:
+            return self.__cancel(email)
+
+    def resume(self, token: str) -> tuple[str, str] | None:
+        """凭令牌接回会话
+
+        Returns:
+            tuple[str, str] | None: (邮件地址, 新令牌)，令牌无效或已过期时为 None
+        """
+        with self.lock:
+            email = self.tokens.get(token, None)
+            if email is None:
+                return None
+            self.__cancel(email)
+            return email, self.__rotate(email)
+
+    def detach(self, email: str, token: str, on_expire: Callable[[str], None]) -> None:
+        """连接意外断开，会话进入宽限期，到期仍未恢复时调用 on_expire(email)
+
+        token 已不是当前令牌（会话已在别的连接上恢复）时什么也不做。
+        """
+        def expire():
+            with self.lock:
+                if self.pending.get(email, None) is not timer:
+                    return
+                del self.pending[email]
+                self.tokens.pop(self.current.pop(email), None)
+            on_expire(email)
+
+        with self.lock:
+            if self.current.get(email, None) != token:
+                return
+            self.__cancel(email)
+            timer = threading.Timer(self.grace, expire)
+            timer.daemon = True
+            self.pending[email] = timer
+            timer.start()
+
+    def revoke(self, email: str, token: str) -> bool:
+        """主动退出，令牌立即失效
+
+        Returns:
+            bool: token 是否为当前令牌，否则会话已在别的连接上恢复，不应下线
+        """
+        with self.lock:
+            if self.current.get(email, None) != token:
+                return False
+            self.__cancel(email)
+            self.tokens.pop(self.current.pop(email), None)
+            return True
@@ -0,0 +1,524 @@
+import sqlite3
+import time
+import zlib
+from collections import Counter
+from collections.abc import Iterable, Iterator
+from threading import Lock
+
+from ServerService import Database
+
+
+class Storage:
+    """存储后端接口，覆盖用户、好友与好友请求"""
+
+    def init(self) -> None:
+        """建表（已存在时不做任何事）"""
+        raise NotImplementedError
+
+    def find_user(self, email: str) -> str | None:
+        """查找用户
+
+        Args:
+            email (str): 邮件地址
+
+        Returns:
+            str | None: 用户名，未注册时为 None
+        """
+        raise NotImplementedError
+
+    def get_pwdhash(self, email: str) -> str | None:
+        """获取密码哈希
+
+        Args:
+            email (str): 邮件地址
+
+        Returns:
+            str | None: 密码哈希，未注册时为 None
+        """
+        raise NotImplementedError
+
+    def register(self, email: str, username: str, pwdhash: str) -> None:
+        """注册用户"""
+        raise NotImplementedError
+
+    def raise_friend_request(self, inviter: str, invitee: str) -> None:
+        """记录一条离线好友请求，重复请求将被忽略"""
+        raise NotImplementedError
+
+    def get_friend_request(self, invitee: str) -> list[tuple[str, str]]:
+        """取出并删除发给 invitee 的全部好友请求
+
+        Returns:
+            list[tuple[str, str]]: (邀请者邮件地址, 邀请者用户名) 列表
+        """
+        raise NotImplementedError
+
+    def add_friend(self, email1: str, email2: str) -> None:
+        """添加好友关系"""
+        raise NotImplementedError
+
+    def get_friend_list(self, email: str) -> list[tuple[str, str]]:
+        """获取好友列表
+
+        Returns:
+            list[tuple[str, str]]: (好友邮件地址, 好友用户名) 列表
+        """
+        raise NotImplementedError
+
+    def judge_friend(self, email1: str, email2: str) -> bool:
+        """判断两人是否为好友"""
+        raise NotImplementedError
+
+    def del_friend(self, user: str, friend: str) -> None:
+        """删除好友关系"""
+        raise NotImplementedError
+
+    def find_users(self, emails: list[str]) -> dict[str, str]:
+        """批量查找用户
+
+        Returns:
+            dict[str, str]: 已注册用户的邮件地址到用户名的映射
+        """
+        raise NotImplementedError
+
+    def raise_friend_requests(self, inviter: str, invitees: list[str]) -> None:
+        """在一个事务中记录多条离线好友请求，重复请求将被忽略"""
+        raise NotImplementedError
+
+    def add_friends(self, pairs: list[tuple[str, str]]) -> None:
+        """在一个事务中添加多对好友关系，已是好友的将被忽略"""
+        raise NotImplementedError
+
+    def del_friends(self, pairs: list[tuple[str, str]]) -> None:
+        """在一个事务中删除多对好友关系"""
+        raise NotImplementedError
+
+    def import_records(self, records: Iterable[tuple[str, tuple]], chunk_size: int = 50000,
+                       defer_index: bool = False) -> dict[str, int]:
+        """批量导入记录，已存在的记录将被忽略
+
+        Args:
+            records (Iterable[tuple[str, tuple]]): (类型, 行) 流，类型为 'user'、'friend' 或 'request'
+            chunk_size (int): 每个事务写入的记录数
+            defer_index (bool): 先删去索引、导完再重建，只应在库为空或服务器停机时使用，
+                否则导入期间在线查询只能扫全表
+
+        Returns:
+            dict[str, int]: 各类型实际写入的行数
+        """
+        raise NotImplementedError
+
+    def export_records(self) -> Iterator[tuple[str, tuple]]:
+        """按用户、好友、好友请求的顺序流式导出全部记录，每对好友只导出一次"""
+        raise NotImplementedError
+
+    def expire_friend_requests(self, before: float, batch_size: int = 500) -> int:
+        """删除一批早于 before 的好友请求
+
+        Args:
+            before (float): 时间戳，更早的请求将被删除
+            batch_size (int): 本批最多删除的行数
+
+        Returns:
+            int: 实际删除的行数，小于 batch_size 说明已删完
+        """
+        raise NotImplementedError
+
+    def optimize(self) -> None:
+        """回收空闲页并更新查询统计信息"""
+        raise NotImplementedError
+
+    def backup(self, dest_dir: str) -> list[str]:
+        """在线备份到 dest_dir
+
+        Returns:
+            list[str]: 写出的备份文件路径
+        """
+        raise NotImplementedError
+
+
+class SQLiteStorage(Storage):
+    """单文件 SQLite 后端，即 `Database` 模块"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+
+    def init(self):
+        Database.init(self.db_path)
+
+    def find_user(self, email):
+        return Database.find_user(self.db_path, email)
+
+    def get_pwdhash(self, email):
+        return Database.get_pwdhash(self.db_path, email)
+
+    def register(self, email, username, pwdhash):
+        Database.register(self.db_path, email, username, pwdhash)
+
+    def raise_friend_request(self, inviter, invitee):
+        Database.raise_friend_request(self.db_path, inviter, invitee)
+
+    def get_friend_request(self, invitee):
+        return Database.get_friend_request(self.db_path, invitee)
+
+    def add_friend(self, email1, email2):
+        Database.add_friend(self.db_path, email1, email2)
+
+    def get_friend_list(self, email):
+        return Database.get_friend_list(self.db_path, email)
+
+    def judge_friend(self, email1, email2):
+        return Database.judge_friend(self.db_path, email1, email2)
+
+    def del_friend(self, user, friend):
+        Database.del_friend(self.db_path, user, friend)
+
+    def find_users(self, emails):
+        return Database.find_users(self.db_path, emails)
+
+    def raise_friend_requests(self, inviter, invitees):
+        Database.raise_friend_requests(self.db_path, inviter, invitees)
+
+    def add_friends(self, pairs):
+        Database.add_friends(self.db_path, pairs)
+
+    def del_friends(self, pairs):
+        Database.del_friends(self.db_path, pairs)
+
+    def import_records(self, records, chunk_size=50000, defer_index=False):
+        return Database.import_records(self.db_path, records, chunk_size, defer_index)
+
+    def export_records(self):
+        return Database.export_records(self.db_path)
+
+    def expire_friend_requests(self, before, batch_size=500):
+        return Database.expire_friend_requests(self.db_path, before, batch_size)
+
+    def optimize(self):
+        Database.optimize(self.db_path)
+
+    def backup(self, dest_dir):
+        return [Database.backup(self.db_path, dest_dir)]
+
+
+class MemoryStorage(Storage):
+    """内存后端，用于测试与基准"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.users: dict[str, tuple[str, str]] = {}
+        self.friends: dict[str, set[str]] = {}
+        self.requests: dict[str, dict[str, float]] = {}
+
+    def init(self):
+        pass
+
+    def find_user(self, email):
+        with self.lock:
+            user = self.users.get(email, None)
+        return None if user is None else user[0]
+
+    def get_pwdhash(self, email):
+        with self.lock:
+            user = self.users.get(email, None)
+        return None if user is None else user[1]
+
+    def register(self, email, username, pwdhash):
+        with self.lock:
+            if email in self.users:
+                raise sqlite3.IntegrityError(f'UNIQUE constraint failed: {email}')
+            self.users[email] = (username, pwdhash)
+
+    def raise_friend_request(self, inviter, invitee):
+        with self.lock:
+            self.requests.setdefault(invitee, {}).setdefault(inviter, time.time())
+
+    def get_friend_request(self, invitee):
+        with self.lock:
+            inviters = self.requests.pop(invitee, {})
+            return [(inviter, self.users[inviter][0]) for inviter in inviters if inviter in self.users]
+
+    def add_friend(self, email1, email2):
+        with self.lock:
+            self.friends.setdefault(email1, set()).add(email2)
+            self.friends.setdefault(email2, set()).add(email1)
+
+    def get_friend_list(self, email):
+        with self.lock:
+            return [(friend, self.users[friend][0])
+                    for friend in sorted(self.friends.get(email, ()))
+                    if friend in self.users]
+
+    def judge_friend(self, email1, email2):
+        with self.lock:
+            return email2 in self.friends.get(email1, ())
+
+    def del_friend(self, user, friend):
+        with self.lock:
+            self.friends.get(user, set()).discard(friend)
+            self.friends.get(friend, set()).discard(user)
+
+    def find_users(self, emails):
+        with self.lock:
+            return {email: self.users[email][0] for email in emails if email in self.users}
+
+    def raise_friend_requests(self, inviter, invitees):
+        request_time = time.time()
+        with self.lock:
+            for invitee in invitees:
+                self.requests.setdefault(invitee, {}).setdefault(inviter, request_time)
+
+    def add_friends(self, pairs):
+        with self.lock:
+            for email1, email2 in pairs:
+                self.friends.setdefault(email1, set()).add(email2)
+                self.friends.setdefault(email2, set()).add(email1)
+
+    def del_friends(self, pairs):
+        with self.lock:
+            for user, friend in pairs:
+                self.friends.get(user, set()).discard(friend)
+                self.friends.get(friend, set()).discard(user)
+
+    def import_records(self, records, chunk_size=50000, defer_index=False):
+        counts = dict.fromkeys(Database.record_sql, 0)
+        with self.lock:
+            for kind, row in records:
+                if kind == 'user':
+                    if row[0] in self.users:
+                        continue
+                    self.users[row[0]] = (row[1], row[2])
+                elif kind == 'friend':
+                    if row[1] in self.friends.get(row[0], ()):
+                        continue
+                    self.friends.setdefault(row[0], set()).add(row[1])
+                    self.friends.setdefault(row[1], set()).add(row[0])
+                else:
+                    if row[0] in self.requests.get(row[1], ()):
+                        continue
+                    self.requests.setdefault(row[1], {})[row[0]] = row[2]
+                counts[kind] += 1
+        return counts
+
+    def export_records(self):
+        with self.lock:
+            users = [(email, *user) for email, user in self.users.items()]
+            friends = [(email1, email2) for email1, emails in self.friends.items() for email2 in emails if email1 < email2]
+            requests = [(inviter, invitee, request_time)
+                        for invitee, inviters in self.requests.items()
+                        for inviter, request_time in inviters.items()]
+        for row in users:
+            yield 'user', row
+        for row in friends:
+            yield 'friend', row
+        for row in requests:
+            yield 'request', row
+
+    def expire_friend_requests(self, before, batch_size=500):
+        count = 0
+        with self.lock:
+            for invitee, inviters in list(self.requests.items()):
+                for inviter, request_time in list(inviters.items()):
+                    if count == batch_size:
+                        return count
+                    if request_time < before:
+                        del inviters[inviter]
+                        count += 1
+                if len(inviters) == 0:
+                    del self.requests[invitee]
+        return count
+
+    def optimize(self):
+        pass
+
+    def backup(self, dest_dir):
+        # Nothing on disk to back up
+        return []
+
+
+class ShardedSQLiteStorage(Storage):
+    """按邮件地址哈希把用户分到多个 SQLite 文件的后端
+
+    每个分片保存归属于它的用户、以该用户为 email1 的有向好友边，
+    以及发给该用户的好友请求。好友关系两端各存一条边，因此
+    好友列表只查本分片，用户名再按分片批量补齐。
+    """
+
+    def __init__(self, db_paths: list[str]):
+        self.db_paths = list(db_paths)
+        self.locks = [Lock() for _ in self.db_paths]
+
+    def shard(self, email: str) -> int:
+        return zlib.crc32(email.encode('utf-8')) % len(self.db_paths)
+
+    def __execute(self, index: int, *statements: tuple[str, tuple]) -> list[tuple]:
+        # 同一事务内依次执行，返回第一条语句的结果
+        with self.locks[index]:
+            with sqlite3.connect(self.db_paths[index]) as db_conn:
+                results = [db_conn.execute(sql, params).fetchall() for sql, params in statements]
+                db_conn.commit()
+        return results[0]
+
+    def __execute_many(self, rows_by_shard: dict[int, list[tuple]], sql: str) -> None:
+        # One transaction per shard, not atomic across shards
+        for index, rows in rows_by_shard.items():
+            with self.locks[index]:
+                with sqlite3.connect(self.db_paths[index]) as db_conn:
+                    db_conn.executemany(sql, rows)
+                    db_conn.commit()
+
+    def __edges(self, pairs: list[tuple[str, str]]) -> dict[int, list[tuple[str, str]]]:
+        # Both directed edges of each friendship, grouped by the owning shard
+        edges: dict[int, list[tuple[str, str]]] = {}
+        for email1, email2 in pairs:
+            edges.setdefault(self.shard(email1), []).append((email1, email2))
+            edges.setdefault(self.shard(email2), []).append((email2, email1))
+        return edges
+
+    def __usernames(self, emails: list[str]) -> dict[str, str]:
+        groups: dict[int, list[str]] = {}
+        for email in emails:
+            groups.setdefault(self.shard(email), []).append(email)
+        usernames = {}
+        for index, group in groups.items():
+            for start in range(0, len(group), 500):
+                chunk = tuple(group[start:start + 500])
+                marks = ', '.join('?' * len(chunk))
+                rows = self.__execute(index, (f'SELECT email, username FROM UserTable WHERE email IN ({marks})', chunk))
+                usernames.update(rows)
+        return usernames
+
+    def init(self):
+        for db_path in self.db_paths:
+            Database.init(db_path)
+
+    def find_user(self, email):
+        rows = self.__execute(self.shard(email), ('SELECT username FROM UserTable WHERE email = ?', (email,)))
+        return rows[0][0] if rows else None
+
+    def get_pwdhash(self, email):
+        rows = self.__execute(self.shard(email), ('SELECT pwdhash FROM UserTable WHERE email = ?', (email,)))
+        return rows[0][0] if rows else None
+
+    def register(self, email, username, pwdhash):
+        self.__execute(self.shard(email), ('INSERT INTO UserTable VALUES (?, ?, ?)', (email, username, pwdhash)))
+
+    def raise_friend_request(self, inviter, invitee):
+        self.__execute(self.shard(invitee), ('INSERT OR IGNORE INTO FriendRequest VALUES (?, ?, ?)', (inviter, invitee, time.time())))
+
+    def get_friend_request(self, invitee):
+        rows = self.__execute(self.shard(invitee),
+                              ('SELECT inviter FROM FriendRequest WHERE invitee = ?', (invitee,)),
+                              ('DELETE FROM FriendRequest WHERE invitee = ?', (invitee,)))
+        usernames = self.__usernames([row[0] for row in rows])
+        return [(row[0], usernames[row[0]]) for row in rows if row[0] in usernames]
+
+    def add_friend(self, email1, email2):
+        # 两个分片各写一次，不跨分片保证原子性
+        self.__execute(self.shard(email1), ('INSERT OR IGNORE INTO FriendTable VALUES (?, ?)', (email1, email2)))
+        self.__execute(self.shard(email2), ('INSERT OR IGNORE INTO FriendTable VALUES (?, ?)', (email2, email1)))
+
+    def get_friend_list(self, email):
+        rows = self.__execute(self.shard(email), ('SELECT email2 FROM FriendTable WHERE email1 = ?', (email,)))
+        usernames = self.__usernames([row[0] for row in rows])
+        return [(friend, usernames[friend]) for friend in sorted(usernames)]
+
+    def judge_friend(self, email1, email2):
+        rows = self.__execute(self.shard(email1),
+                              ('SELECT 1 FROM FriendTable WHERE email1 = ? AND email2 = ?', (email1, email2)))
+        return len(rows) == 1
+
+    def del_friend(self, user, friend):
+        self.__execute(self.shard(user), ('DELETE FROM FriendTable WHERE email1 = ? AND email2 = ?', (user, friend)))
+        self.__execute(self.shard(friend), ('DELETE FROM FriendTable WHERE email1 = ? AND email2 = ?', (friend, user)))
+
+    def find_users(self, emails):
+        return self.__usernames(emails)
+
+    def raise_friend_requests(self, inviter, invitees):
+        request_time = time.time()
+        rows_by_shard: dict[int, list[tuple]] = {}
+        for invitee in invitees:
+            rows_by_shard.setdefault(self.shard(invitee), []).append((inviter, invitee, request_time))
+        self.__execute_many(rows_by_shard, Database.record_sql['request'])
+
+    def add_friends(self, pairs):
+        self.__execute_many(self.__edges(pairs), Database.record_sql['friend'])
+
+    def del_friends(self, pairs):
+        self.__execute_many(self.__edges(pairs), 'DELETE FROM FriendTable WHERE email1 = ? AND email2 = ?')
+
+    def __flush(self, db_conns, buffers) -> Counter:
+        counts = Counter()
+        for index, db_conn in enumerate(db_conns):
+            with self.locks[index]:
+                counts.update(Database.write_records(db_conn, buffers[index], Database.directed_record_sql))
+        return counts
+
+    def import_records(self, records, chunk_size=50000, defer_index=False):
+        counts = Counter(dict.fromkeys(Database.record_sql, 0))
+        buffers = [{kind: [] for kind in Database.record_sql} for _ in self.db_paths]
+        db_conns = [sqlite3.connect(db_path) for db_path in self.db_paths]
+        try:
+            for index, db_conn in enumerate(db_conns):
+                db_conn.execute('PRAGMA synchronous = NORMAL')
+                if defer_index:
+                    with self.locks[index]:
+                        Database.drop_indexes(db_conn)
+            pending = 0
+            for kind, row in records:
+                if kind == 'user':
+                    buffers[self.shard(row[0])]['user'].append(row)
+                elif kind == 'friend':
+                    buffers[self.shard(row[0])]['friend'].append((row[0], row[1]))
+                    buffers[self.shard(row[1])]['friend'].append((row[1], row[0]))
+                else:
+                    buffers[self.shard(row[1])]['request'].append(row)
+                pending += 1
+                if pending >= chunk_size:
+                    counts.update(self.__flush(db_conns, buffers))
+                    pending = 0
+            counts.update(self.__flush(db_conns, buffers))
+        finally:
+            for index, db_conn in enumerate(db_conns):
+                if defer_index:
+                    with self.locks[index]:
+                        Database.create_indexes(db_conn)
+                db_conn.close()
+        # Each friendship is written as two directed edges
+        counts['friend'] //= 2
+        return dict(counts)
+
+    def export_records(self):
+        for kind, sql in (('user', 'SELECT email, username, pwdhash FROM UserTable'),
+                          ('friend', 'SELECT email1, email2 FROM FriendTable WHERE email1 < email2'),
+                          ('request', 'SELECT inviter, invitee, request_time FROM FriendRequest')):
+            for db_path in self.db_paths:
+                db_conn = sqlite3.connect(db_path)
+                try:
+                    for row in db_conn.execute(sql):
+                        yield kind, row
+                finally:
+                    db_conn.close()
+
+    def expire_friend_requests(self, before, batch_size=500):
+        count = 0
+        for index, db_path in enumerate(self.db_paths):
+            with self.locks[index]:
+                with sqlite3.connect(db_path) as db_conn:
+                    cursor = db_conn.execute(
+                        'DELETE FROM FriendRequest WHERE rowid IN '
+                        '(SELECT rowid FROM FriendRequest WHERE request_time < ? LIMIT ?)',
+                        (before, batch_size - count))
+                    db_conn.commit()
+                    count += cursor.rowcount
+            if count == batch_size:
+                break
+        return count
+
+    def optimize(self):
+        for db_path in self.db_paths:
+            Database.optimize(db_path)
+
+    def backup(self, dest_dir):
+        return [Database.backup(db_path, dest_dir) for db_path in self.db_paths]
@@ -0,0 +1,185 @@
+import heapq
+import random
+import time
+from collections import Counter
+from collections.abc import Iterable
+from threading import Lock
+
+try:
+    import numpy
+    import scipy.sparse
+except ImportError:
+    numpy = None
+
+
+# Latency targets (ms) for a user with thousands of friends, checked by the benchmark below
+target_ms = {
+    'suggest': 50.0,
+    'suggest_cached': 1.0,
+    'add_friend': 20.0,
+    'del_friend': 20.0,
+}
+
+
+class SuggestionIndex:
+    """好友推荐索引，按共同好友数排序候选人
+
+    全量重建时为每个用户预先算好前 cache_size 名候选人；加删好友只影响
+    两人及两人的好友，这些用户的候选表被作废，下次查询时按好友的好友重新计数。
+    """
+
+    def __init__(self, cache_size: int = 20):
+        """初始化推荐索引
+
+        Args:
+            cache_size (int): 每个用户预先计算的候选人数量
+        """
+        self.lock = Lock()
+        self.friends: dict[str, set[str]] = {}
+        self.cache_size = cache_size
+        self.__top: dict[str, list[tuple[str, int]]] = {}
+
+    def rebuild(self, pairs: Iterable[tuple[str, str]], batch_size: int = 4096) -> None:
+        """从好友关系全量重建索引，安装了 NumPy 与 SciPy 时用稀疏矩阵乘法分批计算
+
+        Args:
+            pairs (Iterable[tuple[str, str]]): 好友关系，每对出现一次即可
+            batch_size (int): 每批相乘的矩阵行数
+        """
+        friends: dict[str, set[str]] = {}
+        for email1, email2 in pairs:
+            if email1 == email2:
+                continue
+            friends.setdefault(email1, set()).add(email2)
+            friends.setdefault(email2, set()).add(email1)
+        if numpy is None:
+            # Without NumPy every list is computed on first query instead
+            top = {}
+        else:
+            top = self.__rank_sparse(friends, batch_size)
+        with self.lock:
+            self.friends = friends
+            self.__top = top
+
+    def __rank_sparse(self, friends: dict[str, set[str]], batch_size: int) -> dict[str, list[tuple[str, int]]]:
+        # Ids follow email order so that ties break the same way as __rank
+        emails = sorted(friends)
+        ids = {email: i for i, email in enumerate(emails)}
+        n_edges = sum(len(emails2) for emails2 in friends.values())
+        rows = numpy.fromiter((ids[email1] for email1 in emails for _ in friends[email1]),
+                              dtype=numpy.int32, count=n_edges)
+        cols = numpy.fromiter((ids[email2] for email1 in emails for email2 in friends[email1]),
+                              dtype=numpy.int32, count=n_edges)
+        adjacency = scipy.sparse.csr_matrix((numpy.ones(n_edges, dtype=numpy.int32), (rows, cols)),
+                                            shape=(len(emails), len(emails)))
+        top = {}
+        for start in range(0, len(emails), batch_size):
+            block = (adjacency[start:start + batch_size] @ adjacency).tocsr()
+            for offset in range(block.shape[0]):
+                i = start + offset
+                candidates = block.indices[block.indptr[offset]:block.indptr[offset + 1]]
+                counts = block.data[block.indptr[offset]:block.indptr[offset + 1]]
+                known = adjacency.indices[adjacency.indptr[i]:adjacency.indptr[i + 1]]
+                keep = ~numpy.isin(candidates, known) & (candidates != i)
+                candidates, counts = candidates[keep], counts[keep]
+                if len(counts) > self.cache_size:
+                    threshold = numpy.partition(counts, len(counts) - self.cache_size)[len(counts) - self.cache_size]
+                    keep = counts >= threshold
+                    candidates, counts = candidates[keep], counts[keep]
+                order = numpy.lexsort((candidates, -counts))[:self.cache_size]
+                top[emails[i]] = [(emails[j], count) for j, count in zip(candidates[order].tolist(), counts[order].tolist())]
+        return top
+
+    def __rank(self, email: str, limit: int) -> list[tuple[str, int]]:
+        friends = self.friends.get(email, set())
+        mutual = Counter()
+        for friend in friends:
+            mutual.update(self.friends[friend])
+        for known in (email, *friends):
+            mutual.pop(known, None)
+        if len(mutual) == 0:
+            return []
+        # Cut at the limit-th best count first, then sort only the survivors
+        threshold = heapq.nlargest(limit, mutual.values())[-1]
+        candidates = [(candidate, count) for candidate, count in mutual.items() if count >= threshold]
+        candidates.sort(key=lambda item: (-item[1], item[0]))
+        return candidates[:limit]
+
+    def rank(self, email: str, limit: int) -> list[tuple[str, int]]:
+        """不经缓存直接计算推荐，结果与 `suggest` 相同，用于核对"""
+        with self.lock:
+            return self.__rank(email, limit)
+
+    def add_friend(self, email1: str, email2: str) -> None:
+        """增量加入一对好友"""
+        if email1 == email2:
+            return
+        with self.lock:
+            friends1 = self.friends.setdefault(email1, set())
+            friends2 = self.friends.setdefault(email2, set())
+            friends1.add(email2)
+            friends2.add(email1)
+            for email in (*friends1, *friends2):
+                self.__top.pop(email, None)
+
+    def del_friend(self, email1: str, email2: str) -> None:
+        """增量删除一对好友"""
+        with self.lock:
+            friends1 = self.friends.get(email1, set())
+            friends2 = self.friends.get(email2, set())
+            for email in (*friends1, *friends2):
+                self.__top.pop(email, None)
+            friends1.discard(email2)
+            friends2.discard(email1)
+
+    def suggest(self, email: str, limit: int = 10) -> list[tuple[str, int]]:
+        """推荐好友
+
+        Args:
+            email (str): 邮件地址
+            limit (int): 最多返回的候选人数
+
+        Returns:
+            list[tuple[str, int]]: (候选人邮件地址, 共同好友数) 列表，按共同好友数降序
+        """
+        with self.lock:
+            if limit > self.cache_size:
+                return self.__rank(email, limit)
+            top = self.__top.get(email, None)
+            if top is None:
+                top = self.__rank(email, self.cache_size)
+                self.__top[email] = top
+            return top[:limit]
+
+
+if __name__ == '__main__':
+    rand = random.Random(0)
+    n_users, degree, hub_friends = 100000, 20, 5000
+    pairs = {(f'user{i}', f'user{rand.randrange(n_users)}') for i in range(n_users) for _ in range(degree // 2)}
+    pairs |= {('hub', f'user{i}') for i in rand.sample(range(n_users), hub_friends)}
+    index = SuggestionIndex()
+    start = time.perf_counter()
+    index.rebuild(pairs)
+    print(f'rebuild ({"sparse" if numpy is not None else "lazy"}): {len(pairs)} pairs in {time.perf_counter() - start:.2f}s')
+
+    check = SuggestionIndex()
+    check.rebuild(pairs)
+    for email in ['hub'] + [f'user{i}' for i in rand.sample(range(n_users), 50)]:
+        assert index.suggest(email, index.cache_size) == check.rank(email, check.cache_size), email
+
+    timings = {}
+    index.add_friend('hub', 'user0')
+    start = time.perf_counter()
+    index.suggest('hub')
+    timings['suggest'] = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    index.suggest('hub')
+    timings['suggest_cached'] = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    index.del_friend('hub', 'user0')
+    timings['del_friend'] = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    index.add_friend('hub', 'user0')
+    timings['add_friend'] = (time.perf_counter() - start) * 1000
+    for op, ms in timings.items():
+        print(f'{op.ljust(15)} {ms:8.3f}ms  target {target_ms[op]:6.1f}ms  {"ok" if ms <= target_ms[op] else "MISSED"}')
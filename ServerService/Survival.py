@@ -1 +1,3 @@
-Vericode = 600
\ No newline at end of file
+Vericode = 600
+FriendRequest = 30 * 24 * 3600
+Session = 60
@@ -16,6 +16,7 @@ class BuptChat(QMainWindow, Ui_MainWindow):
     updateFriendList = QtCore.pyqtSignal()
     clearTextBrowser = QtCore.pyqtSignal()
     setFriendName = QtCore.pyqtSignal()
+    connectionLost = QtCore.pyqtSignal()
 
     def __init__(self, username):
         super().__init__()
@@ -29,6 +30,7 @@ class BuptChat(QMainWindow, Ui_MainWindow):
         self.updateFriendList.connect(self.front_update_friend_ls)
         self.clearTextBrowser.connect(self.textBrowser.clear)
         self.setFriendName.connect(lambda: self.friend_name.setText(''))
+        self.connectionLost.connect(self.showConnectionLost)
 
         self.chatObject = ''
         self.add.clicked.connect(self.showMessageBox)
@@ -44,6 +46,25 @@ class BuptChat(QMainWindow, Ui_MainWindow):
         self.friend_list.setLayout(self.chatlayout)
         self.layout = QGridLayout()
         self.rqwindow.setLayout(self.layout)
+
+        # 搜索框停止输入150ms后才向服务器查询，结果列表覆盖在好友列表上方
+        self.search_next = None
+        self.search_timer = QtCore.QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        self.search_timer.timeout.connect(self.search_users)
+        self.search_edit.textChanged.connect(self.search_timer.start)
+        self.search_result = QListWidget(self.send)
+        self.search_result.setGeometry(QtCore.QRect(0, 50, 211, 200))
+        self.search_result.hide()
+        self.search_result.itemClicked.connect(self.choose_search_result)
+        self.search_result.verticalScrollBar().valueChanged.connect(self.search_more_users)
+
+        # 定时核对好友在线状态，漏掉的status推送最多滞后一分钟
+        self.presence_timer = QtCore.QTimer(self)
+        self.presence_timer.setInterval(60000)
+        self.presence_timer.timeout.connect(control.refresh_presence)
+        self.presence_timer.start()
         self.initUI()
 
     def createButton(self, friend):
@@ -172,6 +193,11 @@ class BuptChat(QMainWindow, Ui_MainWindow):
         else:
             event.ignore()
 
+    def showConnectionLost(self):
+        # 监督线程无法恢复会话，之后的请求都会失败
+        self.presence_timer.stop()
+        QMessageBox.warning(self, 'Warning', "与服务器的连接无法恢复，请重新登录")
+
     def showMessageBox(self):
         # print('1')
         text = self.search_edit.toPlainText()
@@ -183,6 +209,40 @@ class BuptChat(QMainWindow, Ui_MainWindow):
         else:
             QMessageBox.information(self, 'Message', "该用户不存在")
 
+    def search_users(self):
+        users, self.search_next = control.search_users(self.search_edit.toPlainText())
+        self.search_result.clear()
+        self.append_search_result(users)
+
+    def search_more_users(self, value):
+        """
+        结果列表滚动到底部时加载下一页
+        """
+        if self.search_next is None or value < self.search_result.verticalScrollBar().maximum():
+            return
+        users, self.search_next = control.search_users(self.search_edit.toPlainText(), self.search_next)
+        self.append_search_result(users)
+
+    def append_search_result(self, users):
+        for user in users:
+            item = QListWidgetItem(f"{user.username}\n{user.email}")
+            item.setData(Qt.UserRole, user.email)
+            self.search_result.addItem(item)
+        if self.search_result.count() > 0:
+            self.search_result.show()
+            self.search_result.raise_()
+        else:
+            self.search_result.hide()
+
+    def choose_search_result(self, item):
+        """
+        选中搜索结果后把email填入search_edit，再点add即可发送好友申请
+        """
+        self.search_edit.blockSignals(True)
+        self.search_edit.setPlainText(item.data(Qt.UserRole))
+        self.search_edit.blockSignals(False)
+        self.search_result.hide()
+
     def deleteMessageBox(self):
         reply = QMessageBox.question(self, 'Warning', '确认删除此好友吗?',
                                      QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
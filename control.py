@@ -1,6 +1,6 @@
 from Communication import *
 from Model import *
-from threading import Lock
+from threading import Lock, Thread
 import sqlite3
 import base64
 import time
@@ -14,36 +14,75 @@ friend_new_ls = []
 client_account = ''
 ver_code = ''
 P_sender = None
+peer_pool = PeerPool()
+# 发不出去的消息存入消息库，对方上线后由后台线程按顺序补发
+outbox = Outbox(lambda email, msg: peer_pool.send(email, msg, lambda: sc.start_chat(email)),
+                expired_callback=lambda email, messages: outbox_expired(email, messages))
+key_store = KeyStore()
 message = Message()
 front_entity = None
 friend = None
 P_listener = None
+client_listener = None  # 好友推送与伙伴消息共用的监听器
 initialized=0
+bound = 0  # 登录时是否已一并绑定监听器
 
 def init():
     global sc
     global friend
     global P_listener
+    global client_listener
     sc.connect()
     friend = FriendListener(callbak_update_friend_status,
                             callbak_new_friend_request,
                             callbak_add_new_friend,
-                            callbak_delete_friend, callbak_init_friend_list)
+                            callbak_delete_friend, callbak_init_friend_list,
+                            callbak_delta_friend_list)
 
-    friend.run()
+    client_listener = ClientListener(friend)
+    client_listener.run()
     #print("friend_ran")
+    cover_pool.preload()  # 后台解码载体图片，发第一条消息时不必再读盘
+    key_store.prepare()  # 在用户输入密码时生成备用密钥，新账号登录时不必等待
 
 
 def init_after_login(real_one):
     global friend
     global P_listener
     global sc
+    global friend_ls
     update_front_entity(real_one)
+    outbox.open(client_account)
+    if bound:
+        # 登录时已绑定监听器并取得好友列表，只需刷新界面
+        update_front_friend_ls()
+        return
+    # 先载入本地缓存的好友列表，服务器只需发来增量
+    friend_ls_lock.acquire()
+    friend_ls, friend.version = load_friend_cache(client_account)
+    friend_ls_lock.release()
     sc.bind_friend_listener(friend)
     #print('friend_bind')
-    P_listener = PeerListener(recv_message)
-    P_listener.run()
-    sc.bind_peer_listener(P_listener)
+    bind_peer_later(client_account)
+    sc.supervise(on_reconnect)  # 断线后自动重连并恢复会话
+
+
+def use_peer_key(private_key):  # 伙伴监听器换用private_key，还没有伙伴监听器时创建
+    global P_listener
+    if P_listener is None:
+        P_listener = PeerListener(recv_message, private_key=private_key)
+        client_listener.serve_peer(P_listener)
+    else:
+        P_listener.use_key(private_key)
+
+
+def bind_peer_later(email):  # 登录成功后在后台取出或生成本账号的私钥并绑定伙伴监听器，不阻塞界面
+    def bind():
+        use_peer_key(key_store.load(email))
+        sc.bind_peer_listener(P_listener)
+    bind_thread = Thread(target=bind)
+    bind_thread.daemon = True
+    bind_thread.start()
 
 
 # new_friend_cnt=0
@@ -55,12 +94,24 @@ def update_front_entity(real_one):
 
 def update_front_friend_ls():  # 提醒前端更新friend_list
     global front_entity
+    if front_entity is None:  # 登录时界面还没建好
+        return
     front_entity.updateFriendList.emit()
     return
 
 
+def update_front_connection_lost():  # 提醒前端与服务器的连接已无法恢复
+    global front_entity
+    if front_entity is None:
+        return
+    front_entity.connectionLost.emit()
+    return
+
+
 def update_front_friend_new_ls():  # 提醒前端更新好友申请列表
     global front_entity
+    if front_entity is None:
+        return
     front_entity.front_update_friend_new_ls()
     return
 
@@ -73,6 +124,11 @@ def update_communication(username,email, message_str):
     return
 
 
+def outbox_expired(email, messages):  # 待发送消息箱放弃补发时调用，在与对方的聊天窗口中提示
+    update_communication('系统', email, f'{len(messages)}条消息多次发送失败，已放弃发送')
+    return
+
+
 def build_message(message_str):  # 前后端信息格式转换
     global message
     message.attributes = {}
@@ -111,6 +167,7 @@ def login(email, pwd):  # 如果成功返回1，错误返回0，后面跟返回
     global friend_new_ls
     global P_listener
     global friend
+    global bound
 
     client_account = email
     # 清空list
@@ -118,11 +175,23 @@ def login(email, pwd):  # 如果成功返回1，错误返回0，后面跟返回
     friend_new_ls = []
     sc = ServerConnection()
     sc.connect()
+    route_cache.clear()  # 离线期间可能漏掉了状态推送
+    # 沿用本账号保存的密钥，好友缓存的公钥仍然有效；登录前只读取，不生成也不写盘，
+    # 本机还没有本账号的密钥时先只绑定好友监听器，登录成功后再生成并绑定
+    private_key = key_store.find(email)
+    if private_key is not None:
+        use_peer_key(private_key)
+    peer_listener = P_listener if private_key is not None else None
+    # 先载入本地缓存的好友列表，服务器只需发来增量
+    friend_ls_lock.acquire()
+    friend_ls, friend.version = load_friend_cache(client_account)
+    friend_ls_lock.release()
+    # 登录、绑定两个监听器并取得好友列表，一次往返完成
     if pwd == '':
         # 验证码登录
         # 验证码发送正确
         # ver_code=get_verify()
-        response_lo = sc.vericode_login(email, ver_code)
+        response_lo = sc.login_and_bind(email, friend, peer_listener, vericode=ver_code)
         if response_lo.status != Response.Status.Positive:
             # 连接错误或者验证码错误
             # if response==Response.Status.NegativeClose:
@@ -132,10 +201,16 @@ def login(email, pwd):  # 如果成功返回1，错误返回0，后面跟返回
             return 0, response_lo.status
         else:
             # 登陆成功
+            bound = 1
+            if private_key is None:
+                bind_peer_later(email)
+            else:
+                key_store.load(email)  # 密钥用得太久时在后台换新，下次登录换用
+            sc.supervise(on_reconnect)  # 断线后自动重连并恢复会话
             return 1, 0
     else:
         # 密码登录
-        response_lo = sc.password_login(email, pwd)
+        response_lo = sc.login_and_bind(email, friend, peer_listener, password=pwd)
         if response_lo.status != Response.Status.Positive:
             # 连接错误或者密码错误
             sc.close()
@@ -143,6 +218,12 @@ def login(email, pwd):  # 如果成功返回1，错误返回0，后面跟返回
             sc.connect()
             return 0, response_lo.status
         else:
+            bound = 1
+            if private_key is None:
+                bind_peer_later(email)
+            else:
+                key_store.load(email)  # 密钥用得太久时在后台换新，下次登录换用
+            sc.supervise(on_reconnect)  # 断线后自动重连并恢复会话
             return 1, 0
 
 
@@ -179,6 +260,10 @@ def callbak_update_friend_status(user):
             # friend_ls[i].username=user.username
             break
     friend_ls_lock.release()
+    # 对方下线或重新登录后原连接已失效，路由缓存由FriendListener作废
+    peer_pool.discard(user.email)
+    if user.status == User.Status.Online.value:
+        outbox.wake(user.email)  # 补发对方离线期间没发出去的消息
     update_front_friend_ls()
     return
 
@@ -234,6 +319,50 @@ def callbak_delete_friend(user):
     return
 
 
+def create_friend_cache(cursor):
+    # 没有表就建表
+    cursor.execute('''CREATE TABLE IF NOT EXISTS friend_T
+                        (account CHAR(50)   NOT NULL,
+                        email CHAR(50)      NOT NULL,
+                        username CHAR(50)   NOT NULL);''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS friend_version_T
+                        (account CHAR(50)   PRIMARY KEY,
+                        version CHAR(50)    NOT NULL);''')
+
+
+def load_friend_cache(account):
+    # 读取本地缓存的好友列表及其版本号
+    message_db_con = sqlite3.connect('message.db')
+    cursor = message_db_con.cursor()
+    create_friend_cache(cursor)
+    cursor.execute("SELECT version FROM friend_version_T WHERE account=?", (account,))
+    result = cursor.fetchone()
+    if result is None:
+        message_db_con.close()
+        return [], None
+    cached_ls = []
+    for email, username in cursor.execute("SELECT email, username FROM friend_T WHERE account=?", (account,)):
+        user = User()
+        user.email = email
+        user.username = username
+        user.status = User.Status.Offline.value
+        cached_ls.append(user)
+    message_db_con.close()
+    return cached_ls, result[0]
+
+
+def save_friend_cache(account, version, cached_ls):
+    message_db_con = sqlite3.connect('message.db')
+    cursor = message_db_con.cursor()
+    create_friend_cache(cursor)
+    cursor.execute("DELETE FROM friend_T WHERE account=?", (account,))
+    cursor.executemany("INSERT INTO friend_T (account, email, username) VALUES (?, ?, ?)",
+                       [(account, user.email, user.username) for user in cached_ls])
+    cursor.execute("INSERT OR REPLACE INTO friend_version_T (account, version) VALUES (?, ?)", (account, version))
+    message_db_con.commit()
+    message_db_con.close()
+
+
 def callbak_init_friend_list(acquired_friend_ls):
     global friend_ls
     global initialized
@@ -242,6 +371,7 @@ def callbak_init_friend_list(acquired_friend_ls):
     friend_ls_lock.acquire()
     friend_ls = acquired_friend_ls
     friend_ls_lock.release()
+    save_friend_cache(client_account, friend.version, acquired_friend_ls)
     #u=User()
     #u.email='555'
     #friend_new_ls.append(u)
@@ -251,6 +381,28 @@ def callbak_init_friend_list(acquired_friend_ls):
     return
 
 
+def callbak_delta_friend_list(added, removed, renamed, online):
+    # 把增量应用到本地好友列表
+    global friend_ls
+    friend_ls_lock.acquire()
+    by_email = {user.email: user for user in friend_ls}
+    for user in removed:
+        by_email.pop(user.email, None)
+    for user in added + renamed:
+        if user.email in by_email:
+            by_email[user.email].username = user.username
+        else:
+            by_email[user.email] = user
+    for user in by_email.values():
+        user.status = User.Status.Online.value if user.email in online else User.Status.Offline.value
+    friend_ls = list(by_email.values())
+    synced_ls = list(friend_ls)
+    friend_ls_lock.release()
+    save_friend_cache(client_account, friend.version, synced_ls)
+    update_front_friend_ls()
+    return
+
+
 def recv_message(email, time_stamp, message_recv):
     #global message_db_con
     global client_account
@@ -287,7 +439,6 @@ def send_message(target_email):
     global message
     #global message_db_con
     global client_account
-    global P_sender
     global sc
     message_db_con = sqlite3.connect('message.db')
     cursor = message_db_con.cursor()
@@ -304,22 +455,14 @@ def send_message(target_email):
     #print("before_base64")
     base64_string = base64.b64encode(message.content).decode()
     #print("after_base64")
-    response=sc.start_chat(target_email)
-    #print("p_sender_status:")
-    #print(response.status)
-    P_sender = PeerSender(response)
-    #print("peer_sender_sucess")
-    P_sender.send(message)
-    #print("send_sucess")
-    #print(response_in.status)
-    #if response_in.status == Response.Status.Positive:
-        # base64_string = base64.b64encode(message.content).decode("utf8")
+    # 先记入聊天记录，发不出去时消息留在待发送消息箱中，不会丢失
     cursor.execute("INSERT INTO message_T (sender, recver, timestamp, message) VALUES (?, ?, ?, ?)",
                     (client_account, target_email, time.time(), base64_string))
     #print('sql_sucess')
     message_db_con.commit()
-    P_sender.close()
-    return
+    message_db_con.close()
+    # 复用到对方的连接，没有可用连接时才经服务器发起对话
+    return outbox.send(target_email, message)
 
 
 def get_message(from_email):
@@ -366,52 +509,114 @@ def request_add_friend(target_email):  # 如果成功就返回1，不然就返
     global client_account
     if target_email==client_account:
         return 0
-    sc.find_user(target_email)
-    if sc.last_response.status != Response.Status.Positive:
-    # 用户已存在
-        return 0
-    sc.add_friend(target_email)
+    # 查找用户与发送申请由服务器一并完成，只需一次往返
+    sc.add_friends([target_email])
     #print(sc.last_response.__dict__)
     if sc.last_response.status != Response.Status.Positive:
         return 0
+    elif not sc.last_response.content['results'][0]['ok']:
+        # 用户不存在或已是好友
+        return 0
     else:
         return 1
 
 
+def on_reconnect(response):  # 监督线程重连结束后调用，失败时会话已无法恢复，需要重新登录
+    if response.status != Response.Status.Positive:
+        update_front_connection_lost()
+        return
+    route_cache.clear()  # 断线期间可能漏掉了状态推送
+    refresh_presence()
+
+
+def refresh_presence(chunk_size=50):  # 重新查询全部好友的在线状态，补上漏掉的status推送
+    global sc
+    global friend_ls
+    friend_ls_lock.acquire()
+    emails = [user.email for user in friend_ls]
+    friend_ls_lock.release()
+    online = set()
+    offline = set()
+    for i in range(0, len(emails), chunk_size):  # 分批查询，使请求不超过buf_len
+        sc.presence_query(emails[i:i + chunk_size])
+        if sc.last_response.status != Response.Status.Positive:
+            return 0
+        online.update(sc.last_response.content['online'])
+        offline.update(sc.last_response.content['offline'])
+    changed = False
+    friend_ls_lock.acquire()
+    for user in friend_ls:
+        if user.email in online:
+            status = User.Status.Online.value
+        elif user.email in offline:
+            status = User.Status.Offline.value
+        else:
+            continue
+        if user.status != status:
+            user.status = status
+            route_cache.invalidate(user.email)
+            peer_pool.discard(user.email)
+            if status == User.Status.Online.value:
+                outbox.wake(user.email)
+            changed = True
+    friend_ls_lock.release()
+    if changed:
+        update_front_friend_ls()
+    return 1
+
+
+def search_users(query, offset=0):  # 返回(匹配的用户列表, 下一页的offset)，失败或没有下一页时offset为None
+    global sc
+    if query.strip() == '':
+        return [], None
+    sc.search_users(query, offset)
+    if sc.last_response.status != Response.Status.Positive:
+        return [], None
+    users = []
+    for user_dict in sc.last_response.content['users']:
+        user = User()
+        user.email = user_dict['email']
+        user.username = user_dict['username']
+        users.append(user)
+    return users, sc.last_response.content['next']
+
+
 def ctrl_confirm_add_friend(target_email):  # 如果成功就返回1，不然就返回0和错误码
+    if len(ctrl_confirm_add_friends([target_email])) == 0:
+        return 0
+    return 1
+
+
+def ctrl_confirm_add_friends(target_emails):  # 批量通过好友申请，返回通过了的邮件地址列表
     global sc
-    global friend_new_ls
     global front_entity
-    sc.confirm_friend(target_email)
+    sc.confirm_friends(target_emails)
     if sc.last_response.status != Response.Status.Positive:
-        return 0
-    else:
-        for i in range(len(friend_new_ls)):
-            pass
-            #if friend_new_ls[i].email == target_email:
-                #del friend_new_ls[i]
-                #break
-        #update_front_friend_new_ls()
+        return []
+    confirmed = [result['email'] for result in sc.last_response.content['results'] if result['ok']]
+    for target_email in confirmed:
         front_entity.confirm_add_friend(target_email)
-        # update_front_friend_ls()
-        return 1
+    return confirmed
 
 
 def delete_friend(target_email):
+    if len(delete_friends([target_email])) == 0:
+        return 0
+    return 1
+
+
+def delete_friends(target_emails):  # 批量删除好友，返回删除了的邮件地址列表
     global sc
     global friend_ls
-    sc.delete_friend(target_email)
+    sc.delete_friends(target_emails)
     if sc.last_response.status != Response.Status.Positive:
-        return 0
-    else:
-        friend_ls_lock.acquire()
-        for i in range(len(friend_ls)):
-            if friend_ls[i].email==target_email:
-                del friend_ls[i]
-                break
-        friend_ls_lock.release()
-        update_front_friend_ls()
-        return 1
+        return []
+    deleted = {result['email'] for result in sc.last_response.content['results'] if result['ok']}
+    friend_ls_lock.acquire()
+    friend_ls = [friend for friend in friend_ls if friend.email not in deleted]
+    friend_ls_lock.release()
+    update_front_friend_ls()
+    return list(deleted)
 
 #client_account='222'
 #get_message('111')
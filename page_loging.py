@@ -8,6 +8,7 @@ import  page_code_loging
 import page_error
 import page_finishi_loging
 from control import *
+import multiprocessing
 
 
 class WinGUI(Tk):
@@ -226,6 +227,7 @@ class Win(WinGUI):
         self.widget_dic["tk_button_code_loging"].bind('<Button-1>',self.code_loging)
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # 打包后消息解码进程也从这里启动
     control.init()
     win = Win()
     win.mainloop()
@@ -1,5 +1,5 @@
 from ClientService import Const, Model
-from ServerService import Database, Survival
+from ServerService import FriendSync, KeyDirectory, Maintenance, Presence, Search, Session, Storage, Suggestion, Survival
 import socket
 import threading
 import json
@@ -11,9 +11,19 @@ import smtplib
 from email.mime.text import MIMEText
 from email.header import Header
 import base64
+import Framing
 
 
 db_path = os.path.abspath('server.db')
+storage: Storage.Storage = Storage.SQLiteStorage(db_path)
+suggestion_index = Suggestion.SuggestionIndex()
+user_index = Search.UserIndex()
+presence_index = Presence.PresenceIndex()
+session_table = Session.SessionTable()
+key_directory = KeyDirectory.KeyDirectory(os.path.abspath('keys.db'))
+friend_log = FriendSync.FriendLog()
+maintainer = Maintenance.Maintainer(storage, backup_dir=os.path.abspath('backup'))
+max_search_offset = 200  # 搜索结果最多翻到的位置，更靠后的结果请改用更精确的关键字
 localhost = '0.0.0.0'
 port = Const.server_port
 vericode_dict = {'email@demo.domain': ('123456', time.time())}
@@ -21,12 +31,12 @@ online_dict = {'email@demo.domain': (False, time.time())}
 friend_listener_dict = {'email@demo.domain': (Const.server_ip, Const.server_port)}
 peer_listener_dict = {'email@demo.domain': (Const.server_ip, Const.server_port)}
 username_dict = {'email@demo.domain': 'demoname'}
-public_key_dict = {}
 vericode_dict_lock = threading.Lock()
 online_dict_lock = threading.Lock()
 friend_listener_dict_lock = threading.Lock()
 peer_listener_dict_lock = threading.Lock()
-public_key_dict_lock = threading.Lock()
+request_context = threading.local()
+"""Per connection thread: id of the request being handled, echoed in its response"""
 
 
 def respond(conn, positive: bool = True, close: bool = False, **kwargs):
@@ -38,11 +48,53 @@ def respond(conn, positive: bool = True, close: bool = False, **kwargs):
         status = Model.Response.Status.Negative.value
     elif positive == False and close == True:
         status = Model.Response.Status.NegativeClose.value
-    conn.send(json.dumps({'status': status, 'content': kwargs}).encode())
+    reply = {'status': status, 'content': kwargs}
+    request_id = getattr(request_context, 'id', None)
+    if request_id is not None:
+        reply['id'] = request_id
+    conn.sendall(json.dumps(reply).encode())
+
+
+def next_message(conn, requests: Framing.JsonReader) -> dict:
+    # Clients may pipeline requests, so one recv can hold several messages or part of one
+    while True:
+        msg = requests.next()
+        if msg is not None:
+            if not isinstance(msg, dict):
+                raise ValueError('Expected a JSON object.')
+            return msg
+        if len(requests.buffer) > 1024 * 1024:
+            raise ValueError('Message too long.')
+        chunk = conn.recv(Const.buf_len)
+        if not chunk:
+            raise ConnectionError('Connection closed by client.')
+        requests.feed(chunk)
 
 
 def operate(conn, op: str, **kwargs):
-    conn.send(json.dumps({'op': op, 'content': kwargs}).encode())
+    conn.sendall(json.dumps({'op': op, 'content': kwargs}).encode())
+
+
+def push(target: str, op: str, **kwargs) -> bool:
+    # Push to the friend listener of target, False if it is not bound or unreachable
+    with friend_listener_dict_lock:
+        listener_addr = friend_listener_dict.get(target, None)
+    if listener_addr is None:
+        return False
+    try:
+        listener_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener_conn.connect(listener_addr)
+        operate(listener_conn, op, **kwargs)
+        listener_conn.close()
+    except OSError:
+        return False
+    return True
+
+
+def push_status(email: str, status: Model.User.Status) -> None:
+    # Watchers are online users subscribed to email, no friend list lookup needed
+    for watcher in presence_index.watchers_of(email):
+        push(watcher, 'status', email=email, status=status.value)
 
 
 def send_email(email: str, vericode: str) -> bool:
@@ -117,61 +169,89 @@ def handle_register(conn, addr, email: str, username: str, password: str, verico
         if vericode_dict[email][1] + Survival.Vericode < current_time:
             respond(conn, False, close=True, message='Vericode expired')
             return False
-    if Database.find_user(db_path, email) != None:
+    if storage.find_user(email) != None:
         respond(conn, False, close=True, message='Email already registered')
         return False
-    Database.register(db_path, email, username, password)
+    storage.register(email, username, password)
+    user_index.add(email, username)
     respond(conn)
     return True
 
 
-def handle_password_login(conn, addr, email: str, password: str) -> bool:
-    pwdhash = Database.get_pwdhash(db_path, email)
+def check_password(email: str, password: str) -> str | None:
+    pwdhash = storage.get_pwdhash(email)
     if pwdhash == None:
-        respond(conn, False, close=True, message='Email not registered')
-        return False
+        return 'Email not registered'
     if pwdhash != password:
-        respond(conn, False, close=True, message='Wrong password')
-        return False
-    username = Database.find_user(db_path, email)
-    with online_dict_lock:
-        if online_dict.get(email, (False, None))[0]:
-            respond(conn, False, close=True, message='Already online')
-            return False
-        online_dict[email] = (True, time.time())
-    respond(conn, name=username)
-    return True
+        return 'Wrong password'
+    return None
 
 
-def handle_vericode_login(conn, addr, email: str, vericode: str) -> bool:
-    username = Database.find_user(db_path, email)
-    if username == None:
-        respond(conn, False, close=True, message='Email not registered')
-        return False
+def check_vericode(email: str, vericode: str) -> str | None:
+    if storage.find_user(email) == None:
+        return 'Email not registered'
     with vericode_dict_lock:
         if vericode_dict.get(email, None) is None:
-            respond(conn, False, close=True, message='Vericode not requested')
-            return False
+            return 'Vericode not requested'
         if vericode_dict[email][0] != vericode:
-            respond(conn, False, close=True, message='Wrong vericode')
-            return False
+            return 'Wrong vericode'
         if vericode_dict[email][1] + Survival.Vericode < time.time():
-            respond(conn, False, close=True, message='Vericode expired')
-            return False
+            return 'Vericode expired'
+    return None
+
+
+def go_online(email: str) -> str | None:
     with online_dict_lock:
-        if online_dict.get(email, (False, None))[0]:
-            respond(conn, False, close=True, message='Already online')
-            return False
+        # A session in its grace period may be taken over by a fresh login
+        if online_dict.get(email, (False, None))[0] and not session_table.take_over(email):
+            return 'Already online'
         online_dict[email] = (True, time.time())
-    respond(conn, name=username)
-    return True
+    return None
+
+
+def handle_password_login(conn, addr, email: str, password: str) -> str | None:
+    error = check_password(email, password) or go_online(email)
+    if error is not None:
+        respond(conn, False, close=True, message=error)
+        return None
+    token = session_table.issue(email)
+    respond(conn, name=storage.find_user(email), token=token)
+    return token
+
+
+def handle_resume(conn, addr, token: str) -> tuple[str, str] | None:
+    resumed = session_table.resume(token)
+    if resumed is None:
+        respond(conn, False, close=True, message='Invalid token')
+        return None
+    email, token = resumed
+    # Listeners keep their ports across a reconnect, only the address may change
+    with friend_listener_dict_lock:
+        if friend_listener_dict.get(email, None) is not None:
+            friend_listener_dict[email] = (addr[0], friend_listener_dict[email][1])
+    with peer_listener_dict_lock:
+        if peer_listener_dict.get(email, None) is not None:
+            peer_listener_dict[email] = (addr[0], peer_listener_dict[email][1])
+    print(f'\033[32m{addr[0].rjust(15)}:{addr[1]:5}\033[0m Resumed session of <{email}>')
+    respond(conn, name=storage.find_user(email), token=token)
+    return email, token
 
 
-def handle_bind_friend_listener(conn, addr, email, friend_listener_port: int):
+def handle_vericode_login(conn, addr, email: str, vericode: str) -> str | None:
+    error = check_vericode(email, vericode) or go_online(email)
+    if error is not None:
+        respond(conn, False, close=True, message=error)
+        return None
+    token = session_table.issue(email)
+    respond(conn, name=storage.find_user(email), token=token)
+    return token
+
+
+def bind_friend_listener(addr, email, friend_listener_port: int, version: str | None = None) -> tuple[str, dict, list[tuple[str, str]]]:
+    # Returns the friend list sync op ('init' or 'delta'), its content and pending friend requests
     with friend_listener_dict_lock:
         friend_listener_dict[email] = (addr[0], friend_listener_port)
-    # Broadcast online status to friends
-    friend_list = Database.get_friend_list(db_path, email)
+    friend_list = storage.get_friend_list(email)
     friends: list[Model.User] = []
     with online_dict_lock:
         for friend_tuple in friend_list:
@@ -183,26 +263,35 @@ def handle_bind_friend_listener(conn, addr, email, friend_listener_port: int):
             else:
                 friend.status = Model.User.Status.Offline
             friends.append(friend)
-    for friend in friends:
-        if friend.status == Model.User.Status.Online:
-            with friend_listener_dict_lock:
-                friend_addr = friend_listener_dict.get(friend.email, None)
-            if friend_addr is None:
-                continue
-            friend_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            friend_conn.connect(friend_addr)
-            operate(friend_conn, 'status', email=email, status=Model.User.Status.Online.value)
-            friend_conn.close()
+    # Subscribe to all friends and broadcast online status to watchers
+    presence_index.subscribe(email, (friend.email for friend in friends))
+    push_status(email, Model.User.Status.Online)
+    new_friend_requests = storage.get_friend_request(email)
+    current_version, delta = friend_log.delta(email, version)
+    if delta is None:
+        return 'init', {'friends': [{'email': friend.email,
+                                     'username': friend.username,
+                                     'status': friend.status.value}
+                                    for friend in friends],
+                        'version': current_version}, new_friend_requests
+    # Only changed entries carry usernames, statuses come as the list of online friends
+    return 'delta', {'added': [{'email': friend.email,
+                                'username': friend.username,
+                                'status': friend.status.value}
+                               for friend in friends if friend.email in delta['added']],
+                     'removed': delta['removed'],
+                     'renamed': [{'email': friend_email, 'username': username}
+                                 for friend_email, username in delta['renamed'].items()],
+                     'online': [friend.email for friend in friends if friend.status == Model.User.Status.Online],
+                     'version': current_version}, new_friend_requests
+
+
+def handle_bind_friend_listener(conn, addr, email, friend_listener_port: int, version: str | None = None):
+    op, content, new_friend_requests = bind_friend_listener(addr, email, friend_listener_port, version)
     # Feedback
-    new_friend_requests = Database.get_friend_request(db_path, email)
     self_listener_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     self_listener_conn.connect((addr[0], friend_listener_port))
-    operate(self_listener_conn,
-            'init',
-            friends=[{'email': friend.email,
-                      'username': friend.username,
-                      'status': friend.status.value}
-                      for friend in friends])
+    operate(self_listener_conn, op, **content)
     self_listener_conn.close()
     for new_tuple in new_friend_requests:
         self_listener_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -215,16 +304,44 @@ def handle_bind_friend_listener(conn, addr, email, friend_listener_port: int):
     respond(conn)
 
 
-def handle_bind_peer_listener(conn, addr, email, peer_listener_port: int, public_key):
+def bind_peer_listener(addr, email, peer_listener_port: int, public_key) -> None:
+    # The key goes first, a published address always has a key to go with it
+    key_directory.put(email, public_key)
     with peer_listener_dict_lock:
         peer_listener_dict[email] = (addr[0], peer_listener_port)
-    with public_key_dict_lock:
-        public_key_dict[email] = public_key
+
+
+def handle_bind_peer_listener(conn, addr, email, peer_listener_port: int, public_key):
+    bind_peer_listener(addr, email, peer_listener_port, public_key)
     respond(conn)
 
 
+def handle_login_and_bind(conn, addr, content: dict) -> str | None:
+    email = content['email']
+    if content.get('pwdhash', None) is not None:
+        error = check_password(email, content['pwdhash'])
+    else:
+        error = check_vericode(email, content.get('vericode', None))
+    error = error or go_online(email)
+    if error is not None:
+        respond(conn, False, close=True, message=error)
+        return None
+    token = session_table.issue(email)
+    # Peer listener first, so friends notified of the login can start chats right away;
+    # a client without a key for this account yet binds it once the login succeeded
+    if content.get('peer_port', None) is not None:
+        bind_peer_listener(addr, email, content['peer_port'], content['public_key'])
+    op, sync, new_friend_requests = bind_friend_listener(addr, email, content['friend_port'], content.get('version', None))
+    respond(conn,
+            name=storage.find_user(email),
+            token=token,
+            sync={'op': op, 'content': sync},
+            requests=[{'email': request_email, 'username': username} for request_email, username in new_friend_requests])
+    return token
+
+
 def handle_find_user(conn, addr, email: str) -> bool:
-    username = Database.find_user(db_path, email)
+    username = storage.find_user(email)
     if username == None:
         respond(conn, False, message='Email not registered')
         return False
@@ -233,7 +350,7 @@ def handle_find_user(conn, addr, email: str) -> bool:
 
 
 def handle_add_friend(conn, addr, user_email, friend_email: str):
-    if Database.judge_friend(db_path, user_email, friend_email):
+    if storage.judge_friend(user_email, friend_email):
         respond(conn, False, message='Already friends')
         return False
     # Check if friend online
@@ -249,16 +366,16 @@ def handle_add_friend(conn, addr, user_email, friend_email: str):
         operate(friend_conn,
                 'new',
                 email=user_email,
-                username=Database.find_user(db_path, user_email))
+                username=storage.find_user(user_email))
         friend_conn.close()
     else:
-        Database.raise_friend_request(db_path, user_email, friend_email)
+        storage.raise_friend_request(user_email, friend_email)
     respond(conn)
     return True
 
 
 def handle_confirm_friend(conn, addr, user_email, friend_email: str):
-    if Database.judge_friend(db_path, user_email, friend_email):
+    if storage.judge_friend(user_email, friend_email):
         respond(conn, False, message='Already friends')
         return False
     # Check if friend online
@@ -274,7 +391,7 @@ def handle_confirm_friend(conn, addr, user_email, friend_email: str):
         operate(friend_conn,
                 'add',
                 email=user_email,
-                username=Database.find_user(db_path, user_email),
+                username=storage.find_user(user_email),
                 status=Model.User.Status.Online.value)
         friend_conn.close()
     self_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -284,10 +401,16 @@ def handle_confirm_friend(conn, addr, user_email, friend_email: str):
     operate(self_conn,
             'add',
             email=friend_email,
-            username=Database.find_user(db_path, friend_email),
+            username=storage.find_user(friend_email),
             status=Model.User.Status.Online.value if online else Model.User.Status.Offline.value)
     self_conn.close()
-    Database.add_friend(db_path, user_email, friend_email)
+    storage.add_friend(user_email, friend_email)
+    suggestion_index.add_friend(user_email, friend_email)
+    presence_index.subscribe(user_email, [friend_email])
+    if online:
+        presence_index.subscribe(friend_email, [user_email])
+    friend_log.record(user_email, 'add', friend_email, storage.find_user(friend_email))
+    friend_log.record(friend_email, 'add', user_email, storage.find_user(user_email))
     respond(conn)
     return True
 
@@ -298,7 +421,7 @@ def handle_delete_friend(conn, addr, user_email, friend_email: str):
     with online_dict_lock:
         online = online_dict.get(friend_email, (False, None))[0]
     if online:
-        if not Database.judge_friend(db_path, user_email, friend_email):
+        if not storage.judge_friend(user_email, friend_email):
             respond(conn, True, message='Not friends')
             return False
         # Send delete request
@@ -318,11 +441,184 @@ def handle_delete_friend(conn, addr, user_email, friend_email: str):
             'delete',
             email=user_email)
     self_conn.close()
-    Database.del_friend(db_path, user_email, friend_email)
+    storage.del_friend(user_email, friend_email)
+    suggestion_index.del_friend(user_email, friend_email)
+    presence_index.unsubscribe(user_email, [friend_email])
+    presence_index.unsubscribe(friend_email, [user_email])
+    friend_log.record(user_email, 'remove', friend_email)
+    friend_log.record(friend_email, 'remove', user_email)
     respond(conn)
 
 
-def handle_start_chat(conn, addr, user_email, friend_email: str):
+def bounded_int(value, default: int, low: int, high: int) -> int:
+    # Client-supplied counts, anything that is not an int falls back to the default
+    if not isinstance(value, int) or isinstance(value, bool):
+        value = default
+    return max(low, min(value, high))
+
+
+def handle_suggest_friends(conn, addr, user_email, limit: int = 10) -> bool:
+    if user_email is None:
+        respond(conn, False, message='Not logged in')
+        return False
+    suggestions = suggestion_index.suggest(user_email, bounded_int(limit, 10, 1, 50))
+    usernames = storage.find_users([email for email, _ in suggestions])
+    respond(conn, users=[{'email': email, 'username': usernames.get(email, None), 'mutual': mutual}
+                         for email, mutual in suggestions])
+    return True
+
+
+def handle_search_users(conn, addr, user_email, query: str, offset: int = 0, limit: int = 20) -> bool:
+    if user_email is None:
+        respond(conn, False, message='Not logged in')
+        return False
+    offset = bounded_int(offset, 0, 0, max_search_offset + 1)
+    if offset > max_search_offset:
+        # Past the last page served, the client stops scrolling
+        respond(conn, users=[], next=None)
+        return True
+    users, more = user_index.search(query, offset, bounded_int(limit, 20, 1, 50))
+    next_offset = offset + len(users)
+    respond(conn, users=[{'email': email, 'username': username} for email, username in users],
+            next=next_offset if more and next_offset <= max_search_offset else None)
+    return True
+
+
+def handle_find_users(conn, addr, emails: list[str]) -> bool:
+    usernames = storage.find_users(list(dict.fromkeys(emails)))
+    respond(conn, results=[{'email': email, 'ok': True, 'username': usernames[email]} if email in usernames
+                           else {'email': email, 'ok': False, 'message': 'Email not registered'}
+                           for email in emails])
+    return True
+
+
+def check_friend_batch(user_email, emails: list[str], want_friends: bool) -> tuple[list[str], dict[str, str], list[dict]]:
+    # Splits emails into accepted ones and per-item failures, using one user lookup and one friend list read
+    usernames = storage.find_users(list(dict.fromkeys(emails + [user_email])))
+    friend_emails = {friend_email for friend_email, _ in storage.get_friend_list(user_email)}
+    accepted, results = [], []
+    for email in dict.fromkeys(emails):
+        if email == user_email:
+            message = 'Cannot befriend yourself'
+        elif email not in usernames:
+            message = 'Email not registered'
+        elif want_friends and email not in friend_emails:
+            message = 'Not friends'
+        elif not want_friends and email in friend_emails:
+            message = 'Already friends'
+        else:
+            accepted.append(email)
+            results.append({'email': email, 'ok': True})
+            continue
+        results.append({'email': email, 'ok': False, 'message': message})
+    return accepted, usernames, results
+
+
+def handle_add_friends(conn, addr, user_email, emails: list[str]) -> bool:
+    if user_email is None:
+        respond(conn, False, message='Not logged in')
+        return False
+    accepted, usernames, results = check_friend_batch(user_email, emails, False)
+    # Online invitees get their request pushed right away, the rest are stored in one transaction
+    offline = [email for email in accepted
+               if not push(email, 'new', email=user_email, username=usernames[user_email])]
+    if len(offline) > 0:
+        storage.raise_friend_requests(user_email, offline)
+    respond(conn, results=results)
+    return True
+
+
+def handle_confirm_friends(conn, addr, user_email, emails: list[str]) -> bool:
+    if user_email is None:
+        respond(conn, False, message='Not logged in')
+        return False
+    accepted, usernames, results = check_friend_batch(user_email, emails, False)
+    storage.add_friends([(user_email, email) for email in accepted])
+    with online_dict_lock:
+        online = {email for email in accepted if online_dict.get(email, (False, None))[0]}
+    for email in accepted:
+        suggestion_index.add_friend(user_email, email)
+        friend_log.record(user_email, 'add', email, usernames[email])
+        friend_log.record(email, 'add', user_email, usernames[user_email])
+    presence_index.subscribe(user_email, accepted)
+    # Each new friend is notified once, the user once for the whole batch
+    for email in online:
+        presence_index.subscribe(email, [user_email])
+        push(email, 'add', email=user_email, username=usernames[user_email], status=Model.User.Status.Online.value)
+    if len(accepted) > 0:
+        push(user_email, 'batch', ops=[{'op': 'add',
+                                        'content': {'email': email,
+                                                    'username': usernames[email],
+                                                    'status': (Model.User.Status.Online if email in online
+                                                               else Model.User.Status.Offline).value}}
+                                       for email in accepted])
+    respond(conn, results=results)
+    return True
+
+
+def handle_delete_friends(conn, addr, user_email, emails: list[str]) -> bool:
+    if user_email is None:
+        respond(conn, False, message='Not logged in')
+        return False
+    accepted, usernames, results = check_friend_batch(user_email, emails, True)
+    storage.del_friends([(user_email, email) for email in accepted])
+    for email in accepted:
+        suggestion_index.del_friend(user_email, email)
+        friend_log.record(user_email, 'remove', email)
+        friend_log.record(email, 'remove', user_email)
+        presence_index.unsubscribe(user_email, [email])
+        presence_index.unsubscribe(email, [user_email])
+        push(email, 'delete', email=user_email)
+    if len(accepted) > 0:
+        push(user_email, 'batch', ops=[{'op': 'delete', 'content': {'email': email}} for email in accepted])
+    respond(conn, results=results)
+    return True
+
+
+def friend_presence(user_email, emails: list[str]) -> tuple[list[str], list[str], list[str]]:
+    # Only friends' statuses are disclosed, everything else is reported as unknown
+    friend_emails = {friend_email for friend_email, _ in storage.get_friend_list(user_email)}
+    online, offline, unknown = [], [], []
+    with online_dict_lock:
+        for email in emails:
+            if email not in friend_emails:
+                unknown.append(email)
+            elif online_dict.get(email, (False, None))[0]:
+                online.append(email)
+            else:
+                offline.append(email)
+    return online, offline, unknown
+
+
+def handle_presence_query(conn, addr, user_email, emails: list[str]) -> bool:
+    if user_email is None:
+        respond(conn, False, message='Not logged in')
+        return False
+    online, offline, unknown = friend_presence(user_email, emails)
+    respond(conn, online=online, offline=offline, unknown=unknown)
+    return True
+
+
+def handle_subscribe(conn, addr, user_email, emails: list[str]) -> bool:
+    if user_email is None:
+        respond(conn, False, message='Not logged in')
+        return False
+    online, offline, unknown = friend_presence(user_email, emails)
+    presence_index.subscribe(user_email, online + offline)
+    respond(conn, online=online, offline=offline, unknown=unknown)
+    return True
+
+
+def handle_unsubscribe(conn, addr, user_email, emails: list[str]) -> bool:
+    if user_email is None:
+        respond(conn, False, message='Not logged in')
+        return False
+    presence_index.unsubscribe(user_email, emails)
+    respond(conn)
+    return True
+
+
+def handle_start_chat(conn, addr, user_email, friend_email: str, fingerprint: str | None = None):
     print(f'\033[32m{addr[0].rjust(15)}:{addr[1]:5}\033[0m Start chat from <{user_email}> to <{friend_email}>')
     with online_dict_lock:
         if not online_dict.get(friend_email, (False, None))[0]:
@@ -333,26 +629,49 @@ def handle_start_chat(conn, addr, user_email, friend_email: str):
             respond(conn, False, message='Friend not listening')
             return False
         peer_listener_addr = peer_listener_dict[friend_email]
-    with public_key_dict_lock:
-        public_key = public_key_dict[friend_email]
-    respond(conn, ip=peer_listener_addr[0], port=peer_listener_addr[1], email=friend_email, public_key=public_key)
+    key = key_directory.get(friend_email)
+    if key is None:
+        respond(conn, False, message='Friend not listening')
+        return False
+    key_fingerprint, public_key = key
+    if fingerprint == key_fingerprint:
+        # The client already holds this key, send no key material
+        respond(conn, ip=peer_listener_addr[0], port=peer_listener_addr[1], email=friend_email, fingerprint=key_fingerprint)
+    else:
+        respond(conn, ip=peer_listener_addr[0], port=peer_listener_addr[1], email=friend_email, fingerprint=key_fingerprint, public_key=public_key)
+    return True
+
+
+def logout(email: str) -> None:
+    with online_dict_lock:
+        online_dict[email] = (False, time.time())
+    with friend_listener_dict_lock:
+        friend_listener_dict[email] = None
+    with peer_listener_dict_lock:
+        peer_listener_dict[email] = None
+    presence_index.drop(email)
+    push_status(email, Model.User.Status.Offline)
 
 
 def server_thread(conn: socket.socket, addr):
     hold_conn = True
     email = None
+    token = None
+    closed = False
+    requests = Framing.JsonReader()
     print(f'\033[32m{addr[0].rjust(15)}:{addr[1]:5}\033[0m Connected')
     while hold_conn:
         try:
-            msg_bytes = conn.recv(Const.buf_len)
-            msg = json.loads(msg_bytes.decode('utf-8'))
+            msg = next_message(conn, requests)
         except:
             hold_conn = False
             break
+        request_context.id = msg.get('id', None)
         if msg['op'] == 'hello':
             handle_hello(conn, addr)
         elif msg['op'] == 'close':
             handle_close(conn, addr)
+            closed = True
             hold_conn = False
         elif msg['op'] == 'register':
             if handle_register(conn, addr, msg['content']['email'], msg['content']['username'], msg['content']['pwdhash'], msg['content']['vericode']):
@@ -361,20 +680,34 @@ def server_thread(conn: socket.socket, addr):
         elif msg['op'] == 'update_vericode':
             handle_update_vericode(conn, addr, msg['content']['email'])
         elif msg['op'] == 'password_login':
-            if handle_password_login(conn, addr, msg['content']['email'], msg['content']['pwdhash']):
+            token = handle_password_login(conn, addr, msg['content']['email'], msg['content']['pwdhash'])
+            if token is not None:
                 email = msg['content']['email']
             else:
                 hold_conn = False
         elif msg['op'] == 'vericode_login':
-            if handle_vericode_login(conn, addr, msg['content']['email'], msg['content']['vericode']):
+            token = handle_vericode_login(conn, addr, msg['content']['email'], msg['content']['vericode'])
+            if token is not None:
                 email = msg['content']['email']
             else:
                 hold_conn = False
+        elif msg['op'] == 'login_and_bind':
+            token = handle_login_and_bind(conn, addr, msg['content'])
+            if token is not None:
+                email = msg['content']['email']
+            else:
+                hold_conn = False
+        elif msg['op'] == 'resume':
+            resumed = handle_resume(conn, addr, msg['content']['token'])
+            if resumed is not None:
+                email, token = resumed
+            else:
+                hold_conn = False
         elif msg['op'] == 'bind_friend_listener':
             if email is None:
                 respond(conn, False, close=True, message='Not logged in')
                 hold_conn = False
-            handle_bind_friend_listener(conn, addr, email, msg['content']['port'])
+            handle_bind_friend_listener(conn, addr, email, msg['content']['port'], msg['content'].get('version', None))
         elif msg['op'] == 'bind_peer_listener':
             handle_bind_peer_listener(conn, addr, email, msg['content']['port'], msg['content']['public_key'])
         elif msg['op'] == 'find_user':
@@ -386,43 +719,53 @@ def server_thread(conn: socket.socket, addr):
         elif msg['op'] == 'delete_friend':
             handle_delete_friend(conn, addr, email, msg['content']['email'])
         elif msg['op'] == 'start_chat':
-            handle_start_chat(conn, addr, email, msg['content']['email'])
+            handle_start_chat(conn, addr, email, msg['content']['email'], msg['content'].get('fingerprint', None))
+        elif msg['op'] == 'suggest_friends':
+            handle_suggest_friends(conn, addr, email, msg['content'].get('limit', 10))
+        elif msg['op'] == 'presence_query':
+            handle_presence_query(conn, addr, email, msg['content']['emails'])
+        elif msg['op'] == 'subscribe':
+            handle_subscribe(conn, addr, email, msg['content']['emails'])
+        elif msg['op'] == 'unsubscribe':
+            handle_unsubscribe(conn, addr, email, msg['content']['emails'])
+        elif msg['op'] == 'find_users':
+            handle_find_users(conn, addr, msg['content']['emails'])
+        elif msg['op'] == 'add_friends':
+            handle_add_friends(conn, addr, email, msg['content']['emails'])
+        elif msg['op'] == 'confirm_friends':
+            handle_confirm_friends(conn, addr, email, msg['content']['emails'])
+        elif msg['op'] == 'delete_friends':
+            handle_delete_friends(conn, addr, email, msg['content']['emails'])
+        elif msg['op'] == 'search_users':
+            handle_search_users(conn, addr, email, msg['content']['query'], msg['content'].get('offset', 0), msg['content'].get('limit', 20))
         else:
             respond(conn, False, message='Unknown operation')   
     conn.close()
     if email is not None:
-        with online_dict_lock:
-            online_dict[email] = (False, time.time())
-        with friend_listener_dict_lock:
-            friend_listener_dict[email] = None
-        with peer_listener_dict_lock:
-            peer_listener_dict[email] = None
-            friend_list = Database.get_friend_list(db_path, email)
-        friends: list[Model.User] = []
-        with online_dict_lock:
-            for friend_tuple in friend_list:
-                friend = Model.User()
-                friend.email = friend_tuple[0]
-                friend.username = friend_tuple[1]
-                if online_dict.get(friend_tuple[0], (False, None))[0]:
-                    friend.status = Model.User.Status.Online
-                else:
-                    friend.status = Model.User.Status.Offline
-                friends.append(friend)
-        for friend in friends:
-            if friend.status == Model.User.Status.Online:
-                with friend_listener_dict_lock:
-                    friend_addr = friend_listener_dict.get(friend.email, None)
-                if friend_addr is None:
-                    continue
-                friend_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                friend_conn.connect(friend_addr)
-                operate(friend_conn, 'status', email=email, status=Model.User.Status.Offline.value)
-                friend_conn.close()
+        if token is None:
+            logout(email)
+        elif closed:
+            if session_table.revoke(email, token):
+                logout(email)
+        else:
+            # Dropped without close, keep the session for a resume during the grace period
+            session_table.detach(email, token, logout)
     print(f'\033[32m{addr[0].rjust(15)}:{addr[1]:5}\033[0m closed')
 
 
 if __name__ == '__main__':
+    storage.init()
+    key_directory.init()
+    users, pairs = [], []
+    for kind, row in storage.export_records():
+        if kind == 'user':
+            users.append((row[0], row[1]))
+        elif kind == 'friend':
+            pairs.append(row)
+    user_index.rebuild(users)
+    suggestion_index.rebuild(pairs)
+    os.makedirs(maintainer.backup_dir, exist_ok=True)
+    maintainer.run()
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.bind((localhost, port))
     sock.listen(16)